@@ -7,6 +7,9 @@ from pyehr.ehr.services.dbmanager.errors import CascadeDeleteError, RedundantUpd
 from pyehr.ehr.services.dbmanager.dbservices.version_manager import VersionManager
 
 from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+import threading, sys
 
 
 class DBServices(object):
@@ -26,12 +29,13 @@ class DBServices(object):
       records are stored
     :ivar logger: logger for the DBServices class, if no logger is provided a new one
       is created
+    :ivar driver_options: (optional) driver specific options, passed to the drivers' constructors
     """
 
     def __init__(self, driver, host, database, versioning_database=None,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None, port=None, user=None,
-                 passwd=None, logger=None):
+                 passwd=None, logger=None, driver_options=None):
         self.driver = driver
         self.host = host
         self.database = database
@@ -43,8 +47,18 @@ class DBServices(object):
         self.user = user
         self.passwd = passwd
         self.index_service = None
+        self.bitmap_index = None
         self.logger = logger or get_logger('db_services')
+        # options passed to the drivers (i.e. patient_routing for Elasticsearch), also used by bulk ingest sessions
+        self.driver_options = dict(driver_options or {})
         self.version_manager = self._set_version_manager()
+        self.bulk_ingest_lock = threading.Lock()
+        self.bulk_ingest_count = 0
+        self.bulk_ingest_driver = None
+        # number of patients loaded together by iter_patients and number of clinical records
+        # retrieved with a single request
+        self.patients_chunk_size = 500
+        self.records_batch_size = 1000
 
     def _get_drivers_factory(self, repository):
         return DriversFactory(
@@ -56,7 +70,8 @@ class DBServices(object):
             user=self.user,
             passwd=self.passwd,
             index_service=self.index_service,
-            logger=self.logger
+            logger=self.logger,
+            driver_options=dict(self.driver_options)
         )
 
     def _set_version_manager(self):
@@ -71,7 +86,8 @@ class DBServices(object):
             port=self.port,
             user=self.user,
             passwd=self.passwd,
-            logger=self.logger
+            logger=self.logger,
+            driver_options=dict(self.driver_options)
         )
 
     def _check_index_service(self):
@@ -95,6 +111,90 @@ class DBServices(object):
         # update version manager as well
         self.version_manager = self._set_version_manager()
 
+    def set_bitmap_index(self, bitmap_index):
+        """
+        Keep the given :class:`pyehr.ehr.services.dbmanager.querymanager.bitmap_index.PatientsBitmapIndex`
+        up to date when new clinical records are saved. The same index should be used by the
+        :class:`pyehr.ehr.services.dbmanager.querymanager.QueryManager` running in this process.
+
+        :param bitmap_index: the patients bitmap index or None to stop updating it
+        """
+        self.bitmap_index = bitmap_index
+
+    def _update_bitmap_index(self, structure_id, patient_ids, generation):
+        # all the patients of a single write generation increase must be added at once
+        if self.bitmap_index is not None and generation is not None:
+            self.bitmap_index.add_patients(structure_id, patient_ids, generation)
+
+    def _get_structures_factories(self):
+        # drivers factories of the repositories used by the service, by kind of stored records
+        factories = [('patients', self._get_drivers_factory(self.patients_repository)),
+                     ('ehr', self._get_drivers_factory(self.ehr_repository))]
+        if self.ehr_versioning_repository:
+            factories.append(('ehr_versioning', self.version_manager._get_drivers_factory(write_on_archive=True)))
+        return factories
+
+    def init_structures(self):
+        """
+        Create the data structures (i.e. the indexes of MongoDB collections) needed by the
+        repositories used by the service, if they are missing.
+
+        :return: a dictionary with the kinds of repositories (*patients*, *ehr* and *ehr_versioning*)
+                 as keys and the lists of the created structures as values
+        :rtype: dict
+        """
+        created_structures = dict()
+        for structure_def, drf in self._get_structures_factories():
+            with drf.get_driver() as driver:
+                created_structures[structure_def] = driver.init_structure(structure_def) or list()
+        return created_structures
+
+    def check_structures(self):
+        """
+        Check the data structures needed by the repositories used by the service.
+
+        :return: a dictionary with the kinds of repositories (*patients*, *ehr* and *ehr_versioning*)
+                 as keys and the lists of the missing structures as values
+        :rtype: dict
+        """
+        missing_structures = dict()
+        for structure_def, drf in self._get_structures_factories():
+            with drf.get_driver() as driver:
+                missing_structures[structure_def] = driver.check_structure(structure_def)
+        return missing_structures
+
+    @contextmanager
+    def bulk_ingest(self):
+        """
+        Context manager used to save large amounts of patients and clinical records, the records saved
+        within the context are written using the bulk ingest session of the driver (if the driver
+        supports it, i.e. Elasticsearch's indexes are refreshed only when the context is closed).
+        Nested (or concurrent) contexts share the same session, that ends when the last context is closed.
+
+        :return: the bulk ingest session of the driver or None
+        """
+        with self.bulk_ingest_lock:
+            if self.bulk_ingest_count == 0:
+                driver = self._get_drivers_factory(self.patients_repository).get_driver()
+                driver.connect()
+                session = driver.bulk_ingest_session()
+                if session:
+                    session.__enter__()
+                    self.driver_options['ingest_session'] = session
+                self.bulk_ingest_driver = driver
+            self.bulk_ingest_count += 1
+        try:
+            yield self.driver_options.get('ingest_session')
+        finally:
+            with self.bulk_ingest_lock:
+                self.bulk_ingest_count -= 1
+                if self.bulk_ingest_count == 0:
+                    session = self.driver_options.pop('ingest_session', None)
+                    if session:
+                        session.__exit__(None, None, None)
+                    self.bulk_ingest_driver.disconnect()
+                    self.bulk_ingest_driver = None
+
     def save_patient(self, patient_record):
         """
         Save a patient record to the DB.
@@ -148,7 +248,8 @@ class DBServices(object):
                     # if a new structure was created, delete it (reference counter is 0)
                     self.index_service.check_structure_counter(ehr_record.structure_id)
                     raise e
-                self.index_service.increase_structure_counter(ehr_record.structure_id)
+                generation = self.index_service.increase_structure_counter(ehr_record.structure_id)
+            self._update_bitmap_index(ehr_record.structure_id, [patient_record.record_id], generation)
         patient_record = self._add_ehr_record(patient_record, ehr_record)
         return ehr_record, patient_record
 
@@ -190,13 +291,115 @@ class DBServices(object):
                 saved_struct_counter[rec.structure_id] += 1
         error_struct_counter = set([rec.record_id for rec in errors])
         for struct, counter in saved_struct_counter.iteritems():
-            self.index_service.increase_structure_counter(struct, counter)
+            generation = self.index_service.increase_structure_counter(struct, counter)
+            self._update_bitmap_index(struct, [patient_record.record_id], generation)
         for struct in error_struct_counter:
             self.index_service.check_structure_counter(struct)
         saved_ehr_records = [ehr for ehr in ehr_records if ehr.record_id in saved]
         patient_record = self._add_ehr_records(patient_record, saved_ehr_records)
         return saved_ehr_records, patient_record, errors
 
+    def save_patients_with_records(self, patients):
+        """
+        Save a batch of new patient records together with their new clinical records. All the patient
+        documents are written with a single bulk insert, with their *ehr_records* lists already set,
+        and the clinical records of all the patients with unordered bulk inserts; structure IDs and
+        structures' references counters are handled once for the whole batch. A patient fails if its
+        record or one of its clinical records can't be saved (i.e. duplicated IDs), in that case the
+        data already saved for the patient are removed and the other patients are not affected.
+        If the clinical records bulk insert fails with an unexpected error, all the patients of the
+        batch are removed before the error is raised again.
+
+        :param patients: the patient records that are going to be saved, their clinical records must
+          be in the *ehr_records* lists
+        :type patients: list of :class:`PatientRecord` objects
+        :return: a list with the saved :class:`PatientRecord` objects and a list of
+          (:class:`PatientRecord`, error message) tuples for the patients that were not saved
+        """
+        self._check_index_service()
+        failures = list()
+        accepted = list()
+        patient_ids = set()
+        ehr_ids = set()
+        # IDs duplicated within the batch are rejected in advance, the DB detects the other duplicates
+        for patient in patients:
+            rec_ids = Counter(ehr.record_id for ehr in patient.ehr_records)
+            duplicated_ids = sorted(r for r, count in rec_ids.iteritems() if count > 1 or r in ehr_ids)
+            if patient.record_id in patient_ids:
+                failures.append((patient, 'Duplicated key error for PatientRecord with ID %s' %
+                                 patient.record_id))
+            elif duplicated_ids:
+                failures.append((patient, 'The following IDs have one or more duplicated in this batch: %s' %
+                                 duplicated_ids))
+            elif any(ehr.is_persistent for ehr in patient.ehr_records):
+                failures.append((patient, 'An already mapped record can\'t be assigned to a patient'))
+            else:
+                accepted.append(patient)
+                patient_ids.add(patient.record_id)
+                ehr_ids.update(rec_ids)
+        ehr_records = [ehr for p in accepted for ehr in p.ehr_records]
+        structure_ids = self.index_service.get_structure_ids([ehr.ehr_data.to_json() for ehr in ehr_records])
+        for ehr, structure_id in zip(ehr_records, structure_ids):
+            ehr.structure_id = structure_id
+        for patient in accepted:
+            for ehr in patient.ehr_records:
+                ehr.bind_to_patient(patient)
+                # new records, this is the first revision
+                ehr.increase_version()
+        patients_drf = self._get_drivers_factory(self.patients_repository)
+        ehr_drf = self._get_drivers_factory(self.ehr_repository)
+        with patients_drf.get_driver() as patients_driver, ehr_drf.get_driver() as ehr_driver:
+            saved_ids, errors = patients_driver.add_records_unordered([patients_driver.encode_record(p)
+                                                                       for p in accepted])
+            failed = dict((p.record_id, 'Unable to save PatientRecord with ID %s: %s' %
+                           (p.record_id, errors[p.record_id])) for p in accepted if p.record_id in errors)
+            try:
+                saved_ehr_ids, ehr_errors = ehr_driver.add_records_unordered(
+                    [ehr_driver.encode_record(ehr) for p in accepted if p.record_id not in failed
+                     for ehr in p.ehr_records]
+                )
+            except:
+                # the patients just inserted would reference clinical records that were not saved
+                exc_info = sys.exc_info()
+                self.logger.error('Unable to save ClinicalRecords, removing %d PatientRecords', len(saved_ids))
+                patients_driver.delete_records_by_id(list(saved_ids))
+                raise exc_info[0], exc_info[1], exc_info[2]
+            saved_ehr_ids = set(saved_ehr_ids)
+            for patient in accepted:
+                rec_errors = [(ehr.record_id, ehr_errors[ehr.record_id]) for ehr in patient.ehr_records
+                              if ehr.record_id in ehr_errors]
+                if rec_errors and patient.record_id not in failed:
+                    # rollback, patient's data are removed
+                    failed[patient.record_id] = 'Unable to save ClinicalRecords for PatientRecord with ID %s: %s' % \
+                                                (patient.record_id, '; '.join('%s %s' % e for e in rec_errors))
+                    ehr_driver.delete_records_by_id([ehr.record_id for ehr in patient.ehr_records
+                                                     if ehr.record_id in saved_ehr_ids])
+                    patients_driver.delete_record(patient.record_id)
+        saved_struct_counter = Counter()
+        for patient in accepted:
+            if patient.record_id in failed:
+                failures.append((patient, failed[patient.record_id]))
+                for ehr in patient.ehr_records:
+                    ehr.unbind_from_patient()
+                    ehr.reset_version()
+            else:
+                for ehr in patient.ehr_records:
+                    saved_struct_counter[ehr.structure_id] += 1
+        saved_patients = [p for p in accepted if p.record_id not in failed]
+        generations = dict()
+        for struct, counter in saved_struct_counter.iteritems():
+            generations[struct] = self.index_service.increase_structure_counter(struct, counter)
+        struct_patients = dict()
+        for patient in saved_patients:
+            for ehr in patient.ehr_records:
+                struct_patients.setdefault(ehr.structure_id, set()).add(patient.record_id)
+        for struct, patient_ids in struct_patients.iteritems():
+            self._update_bitmap_index(struct, patient_ids, generations[struct])
+        # if new structures were created only for records that were not saved, delete them
+        for struct in set(structure_ids) - set(saved_struct_counter):
+            self.index_service.check_structure_counter(struct)
+        return saved_patients, failures
+
     def _add_ehr_record(self, patient_record, ehr_record):
         """
         Add an already saved :class:`ClinicalRecord` to the given :class:`PatientRecord`
@@ -388,26 +591,50 @@ class DBServices(object):
     def _get_active_records(self, driver):
         return driver.get_records_by_value('active', True)
 
-    def _fetch_patient_data_full(self, patient_doc, fetch_ehr_records=True,
-                                 fetch_hidden_ehr=False):
+    def _get_records_by_ids(self, driver, record_ids, active_only=False, fields=None):
+        # fetch records in batches of self.records_batch_size IDs, return a dictionary mapping IDs to records
+        record_ids = list(record_ids)
+        records = dict()
+        for i in xrange(0, len(record_ids), self.records_batch_size):
+            for doc in driver.get_records_by_ids(record_ids[i:i+self.records_batch_size], active_only, fields):
+                records[doc['_id']] = doc
+        return records
+
+    def _fetch_patients_data_full(self, patient_docs, fetch_ehr_records=True,
+                                  fetch_hidden_ehr=False, lazy_ehr_records=False):
+        """
+        Decode the given patient documents and load their clinical records, the clinical records
+        of all the patients are retrieved together with a few batched requests; hidden records are
+        filtered out by the DB unless *fetch_hidden_ehr* is True. If *fetch_ehr_records* is False
+        only the metadata fields of the clinical records are retrieved.
+
+        :return: a list of :class:`PatientRecord` objects
+        """
         drf = self._get_drivers_factory(self.ehr_repository)
         with drf.get_driver() as driver:
-            patient_record = driver.decode_record(patient_doc)
-            ehr_records = []
-            for ehr in patient_record.ehr_records:
-                ehr_doc = driver.get_record_by_id(ehr.record_id)
-                if fetch_hidden_ehr or (not fetch_hidden_ehr and ehr_doc['active']):
-                    self.logger.debug('fetch_hidden_ehr: %s --- ehr_doc[\'active\']: %s',
-                                      fetch_hidden_ehr, ehr_doc['active'])
-                    ehr_records.append(driver.decode_record(ehr_doc, fetch_ehr_records))
-                    self.logger.debug('ehr_records: %r', ehr_records)
-                else:
-                    self.logger.debug('Ignoring hidden EHR record %r', ehr_doc['_id'])
-            patient_record.ehr_records = ehr_records
-            return patient_record
+            patient_records = [driver.decode_record(doc) for doc in patient_docs]
+            fields = None if fetch_ehr_records else driver.CLINICAL_RECORD_METADATA_FIELDS
+            ehr_docs = self._get_records_by_ids(driver, [ehr.record_id for p in patient_records
+                                                         for ehr in p.ehr_records],
+                                                active_only=not fetch_hidden_ehr, fields=fields)
+            for patient_record in patient_records:
+                ehr_records = []
+                for ehr in patient_record.ehr_records:
+                    if ehr.record_id in ehr_docs:
+                        ehr_records.append(driver.decode_record(ehr_docs[ehr.record_id], fetch_ehr_records,
+                                                                lazy_ehr_records))
+                    else:
+                        self.logger.debug('Ignoring hidden EHR record %r', ehr.record_id)
+                patient_record.ehr_records = ehr_records
+        return patient_records
+
+    def _fetch_patient_data_full(self, patient_doc, fetch_ehr_records=True,
+                                 fetch_hidden_ehr=False, lazy_ehr_records=False):
+        return self._fetch_patients_data_full([patient_doc], fetch_ehr_records, fetch_hidden_ehr,
+                                              lazy_ehr_records)[0]
 
     def get_patients(self, active_records_only=True, fetch_ehr_records=True,
-                     fetch_hidden_ehr=False):
+                     fetch_hidden_ehr=False, lazy_ehr_records=False):
         """
         Get all patients from the DB.
 
@@ -415,30 +642,70 @@ class DBServices(object):
           patient records from the DB
         :type active_records_only: boolean
         :param fetch_ehr_records: if True fetch connected EHR records  as well, if False only EHR records'
-          IDs will be retrieved
+          metadata will be retrieved
         :type fetch_ehr_records: boolean
+        :param lazy_ehr_records: if True the clinical data of the EHR records are decoded only when they
+          are accessed for the first time, see :class:`LazyClinicalRecord`
+        :type lazy_ehr_records: boolean
         :param fetch_hidden_ehr: if False only fetch active EHR records, if True fetch all EHR records
           connected to the given patient record
         :type fetch_hidden_ehr: boolean
         :return: a list of :class:`PatientRecord` objects
         """
+        return list(self.iter_patients(active_records_only, fetch_ehr_records, fetch_hidden_ehr,
+                                       lazy_ehr_records=lazy_ehr_records))
+
+    def iter_patients(self, active_records_only=True, fetch_ehr_records=True,
+                      fetch_hidden_ehr=False, chunk_size=None, lazy_ehr_records=False):
+        """
+        Iterate over all patients from the DB. Patients are loaded in chunks and the clinical records
+        of each chunk are retrieved with a few batched requests, so that the patients don't need to
+        be kept in memory all together.
+
+        :param active_records_only: if True fetch only active patient records, if False get all
+          patient records from the DB
+        :type active_records_only: boolean
+        :param fetch_ehr_records: if True fetch connected EHR records  as well, if False only EHR records'
+          metadata will be retrieved
+        :type fetch_ehr_records: boolean
+        :param lazy_ehr_records: if True the clinical data of the EHR records are decoded only when they
+          are accessed for the first time, see :class:`LazyClinicalRecord`
+        :type lazy_ehr_records: boolean
+        :param fetch_hidden_ehr: if False only fetch active EHR records, if True fetch all EHR records
+          connected to the given patient record
+        :type fetch_hidden_ehr: boolean
+        :param chunk_size: the number of patients loaded together, if None *self.patients_chunk_size* is used
+        :type chunk_size: int
+        :return: a generator of :class:`PatientRecord` objects
+        """
+        chunk_size = chunk_size or self.patients_chunk_size
         drf = self._get_drivers_factory(self.patients_repository)
         with drf.get_driver() as driver:
             if not active_records_only:
-                patient_records = driver.get_all_records()
+                patient_docs = driver.get_all_records()
             else:
-                patient_records = self._get_active_records(driver)
-        return [self._fetch_patient_data_full(r, fetch_ehr_records,
-                                              fetch_hidden_ehr) for r in patient_records]
-
-    def get_patient(self, patient_id, fetch_ehr_records=True, fetch_hidden_ehr=False):
+                patient_docs = self._get_active_records(driver)
+            patient_docs = iter(patient_docs or [])
+            while True:
+                chunk = list(islice(patient_docs, chunk_size))
+                if not chunk:
+                    break
+                for patient_record in self._fetch_patients_data_full(chunk, fetch_ehr_records,
+                                                                     fetch_hidden_ehr, lazy_ehr_records):
+                    yield patient_record
+
+    def get_patient(self, patient_id, fetch_ehr_records=True, fetch_hidden_ehr=False,
+                    lazy_ehr_records=False):
         """
         Load the :class:`PatientRecord` that matches the given ID from the DB.
 
         :param patient_id: the ID of the record
         :param fetch_ehr_records: if True fetch connected EHR records  as well, if False only EHR records'
-          IDs will be retrieved
+          metadata will be retrieved
         :type fetch_ehr_records: boolean
+        :param lazy_ehr_records: if True the clinical data of the EHR records are decoded only when they
+          are accessed for the first time, see :class:`LazyClinicalRecord`
+        :type lazy_ehr_records: boolean
         :param fetch_hidden_ehr: if False only fetch active EHR records, if True fetch all EHR records
           connected to the given patient record
         :type fetch_hidden_ehr: boolean
@@ -450,7 +717,7 @@ class DBServices(object):
             if not patient_record:
                 return None
             return self._fetch_patient_data_full(patient_record, fetch_ehr_records,
-                                                 fetch_hidden_ehr)
+                                                 fetch_hidden_ehr, lazy_ehr_records)
 
     def get_ehr_record(self, ehr_record_id, patient_id):
         """
@@ -473,19 +740,23 @@ class DBServices(object):
             else:
                 return ehr_record
 
-    def load_ehr_records(self, patient):
+    def load_ehr_records(self, patient, lazy_ehr_records=False):
         """
         Load all :class:`ClinicalRecord` objects connected to the given :class:`PatientRecord` object
 
         :param patient: the patient record object
         :type patient: :class:`PatientRecord`
+        :param lazy_ehr_records: if True the clinical data of the EHR records are decoded only when they
+          are accessed for the first time, see :class:`LazyClinicalRecord`
+        :type lazy_ehr_records: boolean
         :return: the :class:`PatientRecord` object with loaded :class:`ClinicalRecord`
         :type: :class:`PatientRecord`
         """
         drf = self._get_drivers_factory(self.ehr_repository)
         with drf.get_driver() as driver:
-            ehr_records = [driver.get_record_by_id(ehr.record_id) for ehr in patient.ehr_records]
-            patient.ehr_records = [driver.decode_record(ehr) for ehr in ehr_records]
+            ehr_docs = self._get_records_by_ids(driver, [ehr.record_id for ehr in patient.ehr_records])
+            patient.ehr_records = [driver.decode_record(ehr_docs[ehr.record_id], lazy=lazy_ehr_records)
+                                   for ehr in patient.ehr_records if ehr.record_id in ehr_docs]
         return patient
 
     def hide_patient(self, patient):
@@ -128,6 +128,9 @@ class IndexService(object):
         # the reference counter will be increased only after the record will
         # actually be saved on the DB
         record_root.append(etree.Element('references_counter', {'hits': '0'}))
+        # the write generation is increased every time a clinical record with
+        # this structure is saved, updated or deleted
+        record_root.append(etree.Element('write_generation', {'value': '0'}))
         record_root.append(etree.Element('structure_id', {'str_hash': record_hash,
                                                           'uid': record_id}))
         return record_root, record_id
@@ -175,6 +178,33 @@ class IndexService(object):
         self.disconnect()
         return str_id
 
+    def get_structure_ids(self, ehr_records):
+        """
+        Return the STRUCTURE_IDs related to the given EHRs using a single connection, EHRs sharing
+        the same structure are looked up only once; if no ID is related to a structure, a new entry
+        is created in the DB
+
+        :param ehr_records: the EHRs as dictionaries
+        :type ehr_records: list
+        :return: the STRUCTURE_IDs, in the same order of the given EHRs
+        :rtype: list
+        """
+        if not self.basex_client:
+            self.connect()
+        structure_ids = dict()
+        str_ids = list()
+        for ehr_record in ehr_records:
+            xml_structure = IndexService.get_structure(ehr_record)
+            record_hash = self._get_record_hash(xml_structure)
+            if record_hash not in structure_ids:
+                str_id = self._get_structure_id(xml_structure)
+                if not str_id:
+                    str_id = self.create_entry(xml_structure)
+                structure_ids[record_hash] = str_id
+            str_ids.append(structure_ids[record_hash])
+        self.disconnect()
+        return str_ids
+
     def _get_document_reference_counter(self, doc):
         return int(doc.find("references_counter").get("hits"))
 
@@ -182,6 +212,20 @@ class IndexService(object):
         doc.find("references_counter").set("hits", str(update_value))
         return doc
 
+    def _get_document_write_generation(self, doc):
+        generation = doc.find('write_generation')
+        if generation is None:
+            # structures created before write generations were introduced
+            return 0
+        return int(generation.get('value'))
+
+    def _increase_document_write_generation(self, doc):
+        generation = doc.find('write_generation')
+        if generation is None:
+            generation = etree.SubElement(doc, 'write_generation', {'value': '0'})
+        generation.set('value', str(int(generation.get('value')) + 1))
+        return doc
+
     def check_structure_counter(self, structure_id):
         """
         Check if a structure with ID *structure_id* has a references counter equal to 0.
@@ -205,6 +249,7 @@ class IndexService(object):
 
         :param structure_id: the ID of the structure
         :param increase_value: the value that will be added to structure's references counter
+        :return: the new write generation of the structure or None if the structure doesn't exist
         """
         if increase_value < 1:
             raise ValueError("increase_value must be an integer greater than 0")
@@ -213,9 +258,11 @@ class IndexService(object):
             doc_count = self._get_document_reference_counter(doc)
             self.logger.debug("Current counter for %s is %d", structure_id, doc_count)
             doc = self._update_document_references_counter(doc, (doc_count + increase_value))
+            doc = self._increase_document_write_generation(doc)
             self.basex_client.delete_document(structure_id)
             self.basex_client.add_document(doc, structure_id)
             self.logger.debug("Documents %s updated", structure_id)
+            return self._get_document_write_generation(doc)
         else:
             self.logger.warn("There is no document with structure ID %s", structure_id)
 
@@ -238,12 +285,32 @@ class IndexService(object):
                 self.basex_client.delete_document(structure_id)
             else:
                 doc = self._update_document_references_counter(doc, (doc_count - decrease_value))
+                doc = self._increase_document_write_generation(doc)
                 self.basex_client.delete_document(structure_id)
                 self.basex_client.add_document(doc, structure_id)
                 self.logger.debug("Document %s updated", structure_id)
         else:
             self.logger.warn("There is no document with structure ID %s", structure_id)
 
+    def increase_structure_generation(self, structure_id):
+        """
+        Increase the write generation of the structure with the given *structure_id*. The
+        write generation must be increased every time a clinical record with this structure
+        is modified, it is used to check if results of a query involving the structure are
+        still valid. Saving or deleting a record already increases the write generation
+        when the references counter is updated.
+
+        :param structure_id: the ID of the structure
+        """
+        doc = self._get_structure_by_id(structure_id)
+        if doc is not None:
+            doc = self._increase_document_write_generation(doc)
+            self.basex_client.delete_document(structure_id)
+            self.basex_client.add_document(doc, structure_id)
+            self.logger.debug("Write generation for structure %s updated", structure_id)
+        else:
+            self.logger.warn("There is no document with structure ID %s", structure_id)
+
     def _container_to_xpath(self, aql_container):
         if aql_container.class_expression.predicate:
             archetype_class = aql_container.class_expression.predicate.archetype_id
@@ -283,6 +350,52 @@ class IndexService(object):
                     v.insert(0, node.get('path_from_parent'))
         return node.find('structure_id').get('uid'), paths_map
 
+    def get_contains_key(self, aql_containers):
+        """
+        Get a key that identifies the given AQL containers, queries with the same key share
+        the results of :meth:`map_aql_contains` and :meth:`get_structures_generations`
+
+        :param aql_containers: the CONTAINS statement of an AQL query, as a list of containers
+        :return: a hashable key
+        """
+        return (self._build_xpath_query(aql_containers),
+                tuple(c.class_expression.variable_name for c in aql_containers))
+
+    def get_structures_generations(self, aql_containers):
+        """
+        Get the write generations of all the structures that match the given AQL containers
+
+        :param aql_containers: the CONTAINS statement of an AQL query, as a list of containers
+        :return: a dictionary with structure IDs as keys and write generations as values
+        :rtype: dict
+        """
+        if not self.basex_client:
+            self.connect()
+        res = self._execute_query(self._build_xpath_query(aql_containers))
+        self.disconnect()
+        return dict((doc.find('structure_id').get('uid'), self._get_document_write_generation(doc))
+                    for doc in res.findall('archetype_structure'))
+
+    def get_structures_references(self, structure_ids):
+        """
+        Get the references counters of the given structures, that is the number of clinical records
+        saved with each structure. Structures that don't exist are not included in the results.
+
+        :param structure_ids: a list of structure IDs
+        :type structure_ids: list
+        :return: a dictionary with structure IDs as keys and references counters as values
+        :rtype: dict
+        """
+        if not structure_ids:
+            return dict()
+        if not self.basex_client:
+            self.connect()
+        uids = ', '.join('"%s"' % sid for sid in structure_ids)
+        res = self._execute_query('/archetype_structure[structure_id/@uid=(%s)]' % uids)
+        self.disconnect()
+        return dict((doc.find('structure_id').get('uid'), self._get_document_reference_counter(doc))
+                    for doc in res.findall('archetype_structure'))
+
     def map_aql_contains(self, aql_containers):
         if not self.basex_client:
             self.connect()
@@ -20,7 +20,7 @@ class VersionManager(object):
     def __init__(self, driver, host, database, versioning_database=None,
                  ehr_repository=None, ehr_versioning_repository=None,
                  index_service=None, port=None, user=None, passwd=None,
-                 logger=None):
+                 logger=None, driver_options=None):
         self.driver = driver
         self.host = host
         self.database = database
@@ -32,6 +32,7 @@ class VersionManager(object):
         self.user = user
         self.passwd = passwd
         self.logger = logger or get_logger('version_manager')
+        self.driver_options = driver_options or dict()
 
     def _get_drivers_factory(self, write_on_archive=False):
         if write_on_archive:
@@ -50,12 +51,18 @@ class VersionManager(object):
             passwd=self.passwd,
             logger=self.logger,
             index_service=self.index_service,
+            driver_options=dict(self.driver_options)
         )
 
     def _check_index_service(self):
         if not self.index_service:
             raise ConfigurationError('Operation not allowed, missing IndexService')
 
+    def _increase_structure_generation(self, structure_id):
+        # notify the IndexService that records with the given structure changed
+        if self.index_service and structure_id:
+            self.index_service.increase_structure_generation(structure_id)
+
     def _check_redundant_update(self, new_record, old_record):
         new_record_hash = md5()
         new_record_hash.update(json.dumps(new_record.to_json()))
@@ -135,6 +142,8 @@ class VersionManager(object):
             if new_record.structure_id != old_structure_id:
                 self.index_service.increase_structure_counter(new_record.structure_id)
                 self.index_service.decrease_structure_counter(old_structure_id)
+            else:
+                self._increase_structure_generation(new_record.structure_id)
             new_record.last_update = last_update
         return new_record
 
@@ -149,6 +158,7 @@ class VersionManager(object):
         drf = self._get_drivers_factory()
         with drf.get_driver() as driver:
             last_update = driver.update_field(record.record_id, field, value, last_update_label, True)
+        self._increase_structure_generation(current_revision.structure_id)
         record.last_update = last_update
         record.increase_version()
         setattr(record, field, value)
@@ -162,6 +172,7 @@ class VersionManager(object):
         with drf.get_driver() as driver:
             last_update = driver.add_to_list(record.record_id, list_label, element,
                                              last_update_label, True)
+        self._increase_structure_generation(current_revision.structure_id)
         record.last_update = last_update
         record.increase_version()
         return record
@@ -174,6 +185,7 @@ class VersionManager(object):
         with drf.get_driver() as driver:
             last_update = driver.extend_list(record.record_id, list_label, elements,
                                              last_update_label, True)
+        self._increase_structure_generation(current_revision.structure_id)
         record.last_update = last_update
         record.increase_version()
         return record
@@ -186,6 +198,7 @@ class VersionManager(object):
         with drf.get_driver() as driver:
             last_update = driver.remove_from_list(record.record_id, list_label, element,
                                                   last_update_label, True)
+        self._increase_structure_generation(current_revision.structure_id)
         record.last_update = last_update
         record.increase_version()
         return record
@@ -204,6 +217,8 @@ class VersionManager(object):
             if old_rec_struct != original_record.structure_id:
                 self.index_service.decrease_structure_counter(old_rec_struct)
                 self.index_service.increase_structure_counter(original_record.structure_id)
+            else:
+                self._increase_structure_generation(original_record.structure_id)
         drf = self._get_drivers_factory(True)
         with drf.get_driver() as driver:
             del_count = driver.delete_later_versions(record_id, revision-1)
@@ -266,6 +266,49 @@ class ClinicalRecord(Record):
         )
 
 
+class LazyClinicalRecord(ClinicalRecord):
+    """
+    Class representing a clinical record whose clinical data are decoded only when the
+    *ehr_data* attribute is accessed for the first time, record's metadata are available
+    immediately
+
+    :ivar ehr_data_loader: a callable with no arguments that returns the :class:`ArchetypeInstance`
+      with the clinical data of the record
+    """
+
+    def __init__(self, ehr_data_loader, creation_time=None, last_update=None,
+                 active=True, record_id=None, structure_id=None,
+                 version=0):
+        self._ehr_data = None
+        super(LazyClinicalRecord, self).__init__(None, creation_time, last_update,
+                                                 active, record_id, structure_id, version)
+        self._ehr_data_loader = ehr_data_loader
+
+    def __eq__(self, other):
+        # a lazy record is equal to the loaded ClinicalRecord with the same ID
+        if type(other) in (ClinicalRecord, LazyClinicalRecord):
+            return (self.record_id == other.record_id) and \
+                   (not self.record_id is None and not other.record_id is None)
+        else:
+            return False
+
+    @property
+    def ehr_data(self):
+        if self._ehr_data_loader is not None:
+            self._ehr_data = self._ehr_data_loader()
+            self._ehr_data_loader = None
+        return self._ehr_data
+
+    @ehr_data.setter
+    def ehr_data(self, ehr_data):
+        self._ehr_data = ehr_data
+        self._ehr_data_loader = None
+
+    @property
+    def is_loaded(self):
+        return self._ehr_data_loader is None
+
+
 class ClinicalRecordRevision(ClinicalRecord):
 
     def __init__(self, ehr_data, record_id, patient_id, creation_time=None, last_update=None,
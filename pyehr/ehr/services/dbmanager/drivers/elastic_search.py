@@ -1,13 +1,16 @@
 from pyehr.aql.parser import *
 from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import *
+from pyehr.ehr.services.dbmanager.querymanager.query_control import QueryControl
+from pyehr.ehr.services.dbmanager.drivers import elastic_search_dsl as dsl
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
 from itertools import izip
+from functools import partial
 from hashlib import md5
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
     ResultColumnDef, ResultRow
-from multiprocessing import Pool
+from multiprocessing import Pool, Value
 
 try:
     import simplejson as json
@@ -18,10 +21,42 @@ import elasticsearch
 import time
 import re
 
+# scripts used by the _update API to change a single document in place, params are bound to
+# variables in groovy (ES 2.x) scripts and are available in the params map in painless (ES >= 5) ones.
+# Items are removed from lists one occurrence at a time, a missing item stops the update with an
+# error containing MISSING_LIST_ITEM_ERROR
+MISSING_LIST_ITEM_ERROR = 'pyehr_missing_list_item'
+UPDATE_SCRIPTS = {
+    'groovy': {
+        'set_field': 'ctx._source[field_label] = field_value; '
+                     'if (timestamp_label) { ctx._source[timestamp_label] = last_update }; '
+                     'if (increase_version) { ctx._source.version += 1 }',
+        'update_list': 'ctx._source[field_label].addAll(add_items); '
+                       'for (item in remove_items) { '
+                       'int i = ctx._source[field_label].indexOf(item); '
+                       'if (i < 0) { throw new IllegalArgumentException("%s: " + item) }; '
+                       'ctx._source[field_label].remove(i) }; '
+                       'if (timestamp_label) { ctx._source[timestamp_label] = last_update }; '
+                       'if (increase_version) { ctx._source.version += 1 }' % MISSING_LIST_ITEM_ERROR,
+    },
+    'painless': {
+        'set_field': 'ctx._source[params.field_label] = params.field_value; '
+                     'if (params.timestamp_label != null) { ctx._source[params.timestamp_label] = params.last_update } '
+                     'if (params.increase_version) { ctx._source.version += 1 }',
+        'update_list': 'ctx._source[params.field_label].addAll(params.add_items); '
+                       'for (def item : params.remove_items) { '
+                       'int i = ctx._source[params.field_label].indexOf(item); '
+                       'if (i < 0) { throw new IllegalArgumentException("%s: " + item) } '
+                       'ctx._source[params.field_label].remove(i) } '
+                       'if (params.timestamp_label != null) { ctx._source[params.timestamp_label] = params.last_update } '
+                       'if (params.increase_version) { ctx._source.version += 1 }' % MISSING_LIST_ITEM_ERROR,
+    }
+}
+
 class MultiprocessQueryRunner(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, deadline=None):
         self.host = host
         self.database = database
         self.collection = collection
@@ -29,18 +64,92 @@ class MultiprocessQueryRunner(object):
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.deadline = deadline
 
     def __call__(self, query_description):
         driver_instance = ElasticSearchDriver(
             self.host, self.database, self.collection_name,
             self.port, self.user, self.passwd
         )
-        results = driver_instance._run_aql_query(
-            query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
-        )
+        if self.deadline is not None:
+            driver_instance.query_control = QueryControl(deadline=self.deadline)
+        results = driver_instance._run_sub_query(query_description, self.collection_name)
         return results
 
+class BulkIngestSession(object):
+    """
+    Context manager used to load large amounts of records. When the session starts the automatic
+    refresh of the records index and of the lookup table is disabled (refresh_interval set to -1), on
+    exit the original refresh interval is restored, both indexes are refreshed once and the number of
+    documents in the records index is compared with the number of records written during the session.
+    Drivers created with the *ingest_session* option don't refresh indexes on each write and register
+    the records they write in the session. The counter of the written records lives in shared memory,
+    so the session can be used by worker processes forked after it started.
+    """
+
+    DEFAULT_REFRESH_INTERVAL = '1s'
+
+    def __init__(self, driver):
+        """
+        :param driver: a connected :class:`ElasticSearchDriver` used to change indexes' settings
+        """
+        self.driver = driver
+        self.indexes = [driver.database]
+        if driver.lookup_table_enabled:
+            self.indexes.append(driver.database_ids)
+        self.refresh_intervals = dict()
+        self.initial_count = 0
+        self.written_records_counter = Value('l', 0)
+        self.consistent = None
+
+    @property
+    def written_records(self):
+        return self.written_records_counter.value
+
+    def register_writes(self, records_count):
+        with self.written_records_counter.get_lock():
+            self.written_records_counter.value += records_count
+
+    def _get_refresh_interval(self, index):
+        settings = self.driver.client.indices.get_settings(index=index, name='index.refresh_interval')
+        refresh_interval = settings.get(index, {}).get('settings', {}).get('index', {}).get('refresh_interval')
+        # -1 means that another ingest session is running, restore the default value when done
+        if refresh_interval in (None, '-1'):
+            return self.DEFAULT_REFRESH_INTERVAL
+        return refresh_interval
+
+    def _set_refresh_interval(self, index, refresh_interval):
+        self.driver.client.indices.put_settings(index=index, body={'index': {'refresh_interval': refresh_interval}})
+
+    def __enter__(self):
+        client = self.driver.client
+        for index in self.indexes:
+            if not client.indices.exists(index=index):
+                client.indices.create(index=index)
+            self.refresh_intervals[index] = self._get_refresh_interval(index)
+            self._set_refresh_interval(index, '-1')
+        self.initial_count = client.count(index=self.driver.database)['count']
+        self.driver.logger.info('Bulk ingest session started, automatic refresh disabled for %s',
+                                ', '.join(self.indexes))
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        client = self.driver.client
+        for index in self.indexes:
+            self._set_refresh_interval(index, self.refresh_intervals[index])
+        client.indices.refresh(index=','.join(self.indexes))
+        final_count = client.count(index=self.driver.database)['count']
+        self.consistent = (final_count == self.initial_count + self.written_records)
+        if self.consistent:
+            self.driver.logger.info('Bulk ingest session completed, %d records written', self.written_records)
+        else:
+            self.driver.logger.warning('Bulk ingest session completed, %d records written but index %s '
+                                       'contains %d records (%d expected)', self.written_records,
+                                       self.driver.database, final_count,
+                                       self.initial_count + self.written_records)
+        return None
+
+
 class ElasticSearchDriver(DriverInterface):
     """
     Creates a driver to handle I\O with a ElasticSearch (ES) server.
@@ -56,15 +165,40 @@ class ElasticSearchDriver(DriverInterface):
     needed and will interrogate a specific *document type* stored in one *index*  within the server.
     If no *logger* object is passed to constructor, a new one is created.
     *port*, *user* and *password* are currently not used
+    By default records are located using the lookup table. If *record_routing* is True, revisions are
+    routed with the ID of their clinical record and records are located by their routing keys, without
+    the lookup table; revisions written with the lookup table layout are not routed, repositories must
+    be reindexed when the option is enabled.
+    If *patient_routing* is True, clinical records and their revisions are routed by patient ID and
+    queries on a single patient (EHR predicates) are sent to a single shard. The routing of existing
+    records doesn't change, repositories must be reindexed when the option is enabled.
+    *aql_query_mode* is a MongoDB driver option, it is accepted (so that the same driver options can
+    be used with both drivers) and ignored.
+    Lists and versions are updated in place by inline scripts (see UPDATE_SCRIPTS), ES 2.x disables
+    inline groovy scripts by default: enable them with *script.inline: true* in elasticsearch.yml
+    (or *script.engine.groovy.inline.update: true* for update scripts only). If scripts are rejected,
+    the driver falls back to reading and indexing the whole document again.
     """
 
     # This map is used to encode\decode data when writing\reading to\from ElasticSearch
     #ENCODINGS_MAP = {'.': '-'}   I NEED TO SEE THE QUERIES
     ENCODINGS_MAP = {}
+    # fields of the clinical records that are enough to build their metadata, used as a projection when
+    # clinical data are not required
+    CLINICAL_RECORD_METADATA_FIELDS = ('_id', 'creation_time', 'last_update', 'active', 'version', 'patient_id',
+                                       'ehr_structure_id', 'ehr_data.archetype_class')
+    # subtrees of clinical data that are only stored as payload, they are not indexed
+    NOT_INDEXED_PATHS = ('*.integrity_check', '*.thumbnail')
+    # longer strings are stored but not indexed by the catch-all strings template, ES rejects
+    # not analyzed terms bigger than 32766 bytes (8191 characters take up to 32764 bytes in UTF-8)
+    STRINGS_IGNORE_ABOVE = 8191
+    # databases whose index template was already checked by the current process
+    _checked_templates = set()
 
     def __init__(self, host, database,collection,
                  port=None, user=None, passwd=None,
-                 index_service=None, logger=None):
+                 index_service=None, logger=None, ingest_session=None, patient_routing=False,
+                 aql_query_mode=None, record_routing=False):
         self.client = None
         self.host = host
         self.database = database
@@ -76,23 +210,35 @@ class ElasticSearchDriver(DriverInterface):
         self.transportclass=elasticsearch.Urllib3HttpConnection
         self.index_service = index_service
         self.logger = logger or get_logger('elasticsearch-db-driver')
-        self.regtrue = re.compile("([ :])True([ \]},])")
-        self.regfalse = re.compile("([ :])False([ \]},])")
+        if aql_query_mode not in (None, 'find'):
+            self.logger.warning('AQL query mode %s is not supported by ElasticSearch driver, ignoring it',
+                                aql_query_mode)
         self.database_ids_suffix="lookup"
         baseidids=self.database.rsplit('_', 1)[0]
         self.database_ids=baseidids+"_"+self.database_ids_suffix
+        #alias shared by the current and the versioning databases, indexes are added by the index template
+        self.database_alias=baseidids+"_records"
         self.doc_ids="table"
         #scan settings: threshold, timeout for scroll life
         self.threshold = 1000
         self.scrolltime="1m"
         #method in get records by query:"scan" or "from"
         self.grbq="scan"
-        #method in get_record_by_id: "current" or "lookuptable"
-        self.grbi = "current"
-        #method in delete_record: "search" or "lookuptable"
-        self.dere="lookuptable"
-        #method in delete_later_versions:"search" or "lookuptable"
-        self.dlv="lookuptable"
+        #max number of searches in a single multi search request
+        self.msearch_size=100
+        #route revisions with the ID of their clinical record and locate records without the lookup table
+        self.record_routing=record_routing
+        location_method="routing" if self.record_routing else "lookuptable"
+        #method in get_record_by_id: "routing", "current" or "lookuptable"
+        self.grbi = location_method
+        #method in delete_record: "routing", "search" or "lookuptable"
+        self.dere=location_method
+        #method in delete_later_versions: "routing", "search" or "lookuptable"
+        self.dlv=location_method
+        #keep the lookup table updated even if no "lookuptable" method is used
+        self.use_lookup_table=False
+        #route clinical records and their revisions by patient ID, queries on a single patient hit a single shard
+        self.patient_routing=patient_routing
         #refresh for insertion. put to false for long bulk insertion
         self.refresh='true'
         #timeout for insertion
@@ -101,6 +247,20 @@ class ElasticSearchDriver(DriverInterface):
         self.global_timeout=60
         #refresh for deletion. put to false for long bulk deletion
         self.drefresh='true'
+        #limits of a single bulk insertion request
+        self.bulk_max_actions=1000
+        self.bulk_max_bytes=10*1024*1024
+        #language of the update scripts: "groovy" (ES 2.x) or "painless" (ES >= 5)
+        self.script_lang="groovy"
+        #use update scripts, disabled when the server rejects inline scripts
+        self.script_updates=True
+        #retries of a scripted update when the document is changed by a concurrent request
+        self.update_retries=3
+        #bulk ingest session, if any, indexes will be refreshed when the session ends
+        self.ingest_session=ingest_session
+        if self.ingest_session:
+            self.refresh='false'
+            self.drefresh='false'
     def __enter__(self):
         self.connect()
         return self
@@ -123,6 +283,7 @@ class ElasticSearchDriver(DriverInterface):
                 raise DBManagerNotConnectedError('Unable to connect to ElasticSearch at %s:%s' %
                                                 (self.host[0]['host'], self.host[0]['port']))
             self.logger.debug('binding to database %s', self.database)
+            self._ensure_index_template()
             #there is no authentication/authorization layer in elasticsearch
             self.logger.debug('using collection %s', self.collection)
         else:
@@ -138,11 +299,96 @@ class ElasticSearchDriver(DriverInterface):
         self.collection = None
         self.client = None
 
+    def _get_template_name(self):
+        return 'pyehr_%s' % self.database
+
+    def get_index_template(self):
+        """
+        Return the index template used for the current database. Strings (IDs, archetype classes,
+        coded text values...) are mapped as not analyzed fields, so that they can be matched using
+        term filters; apart from the ID fields, strings longer than STRINGS_IGNORE_ABOVE characters are
+        not indexed. Magnitudes are always mapped as numbers and payload only subtrees
+        (see NOT_INDEXED_PATHS) are not indexed. New indexes are added to the alias shared by the
+        current and the versioning databases.
+
+        :return: the index template
+        :rtype: dict
+        """
+        keyword = {'type': 'string', 'index': 'not_analyzed'}
+        dynamic_templates = list()
+        for i, path in enumerate(self.NOT_INDEXED_PATHS):
+            dynamic_templates.append({'payload_object_%d' % i: {'path_match': path, 'match_mapping_type': 'object',
+                                                                'mapping': {'type': 'object', 'enabled': False}}})
+            dynamic_templates.append({'payload_value_%d' % i: {'path_match': path,
+                                                               'mapping': {'index': 'no'}}})
+        dynamic_templates.extend([
+            {'magnitudes': {'path_match': '*.magnitude', 'mapping': {'type': 'double'}}},
+            {'strings': {'match_mapping_type': 'string',
+                         'mapping': dict(keyword, ignore_above=self.STRINGS_IGNORE_ABOVE)}}
+        ])
+        return {
+            'template': self.database,
+            'aliases': {self.database_alias: {}},
+            'mappings': {
+                '_default_': {
+                    'dynamic_templates': dynamic_templates,
+                    'properties': {
+                        'patient_id': keyword,
+                        'ehr_structure_id': keyword,
+                        'ehr_records': keyword
+                    }
+                }
+            }
+        }
+
+    def _ensure_index_template(self):
+        """
+        Install the index template of the current database before any index is created, the check
+        is done once per process. Templates are applied only to new indexes: queries use term filters
+        on not analyzed strings, so an index created without the template must be reindexed.
+        """
+        if self.database in ElasticSearchDriver._checked_templates:
+            return
+        template_name = self._get_template_name()
+        if not self.client.indices.exists_template(name=template_name):
+            if self.client.indices.exists(index=self.database):
+                self.logger.warning('Index %s was created without template %s, it must be reindexed to be '
+                                    'queried by this driver', self.database, template_name)
+            self.logger.info('Installing index template %s', template_name)
+            self.client.indices.put_template(name=template_name, body=self.get_index_template())
+        ElasticSearchDriver._checked_templates.add(self.database)
+
     def init_structure(self, structure_def):
         """
-        ElasticSearch  doesn't need structure initialization
+        Install the index template of the current database, if missing. Templates are applied when an
+        index is created, existing indexes must be reindexed in order to use the new mappings.
+
+        :param structure_def: the kind of records stored in the collection, all the kinds of records
+                              share the same template
+        :return: the names of the created templates
+        :rtype: list
         """
-        pass
+        self.__check_connection()
+        template_name = self._get_template_name()
+        if self.client.indices.exists_template(name=template_name):
+            return []
+        self.logger.info('Installing index template %s', template_name)
+        self.client.indices.put_template(name=template_name, body=self.get_index_template())
+        return [template_name]
+
+    def check_structure(self, structure_def):
+        """
+        Return the index templates needed by the current database that are missing
+
+        :param structure_def: the kind of records stored in the collection
+        :return: the names of the missing templates
+        :rtype: list
+        """
+        self.__check_connection()
+        template_name = self._get_template_name()
+        if self.client.indices.exists_template(name=template_name):
+            return []
+        return [template_name]
 
     @property
     def is_connected(self):
@@ -329,26 +575,55 @@ class ElasticSearchDriver(DriverInterface):
                 normalized_doc[k] = self._decode_keys(v, encoded, original)
         return normalized_doc
 
+    def _decode_ehr_data(self, ehr_data):
+        """
+        decode the clinical data of a record, i.e. transform ES to openehr representation
+        :param ehr_data: clinical data in ES representation
+        :type: dict
+        :return: clinical data entity
+        :type: ArchetypeInstance
+        """
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ArchetypeInstance
+        ehr_data = decode_dict(ehr_data)
+        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
+            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
+        return ArchetypeInstance.from_json(ehr_data)
+
 #    @profile
-    def _decode_clinical_record(self, record, loaded):
+    def _decode_clinical_record(self, record, loaded, lazy=False):
         """
         decode clinical record, i.e. transform ES to openehr representation
         :param record : clinical record in ES representation
         :type: dict
         :param loaded: all fields are inserted
         :type loaded: bool
+        :param lazy: if True and *loaded* is True, clinical data are decoded on first access
+        :type lazy: bool
         :return:clinical record entity
         :type: ClinicalRecord
         """
         from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecord,\
-            ArchetypeInstance
+            LazyClinicalRecord, ArchetypeInstance
+        if loaded and lazy:
+            # only metadata are decoded now, clinical data are kept in their raw form
+            ehr_data = record['ehr_data']
+            record = decode_dict(dict((k, v) for k, v in record.iteritems() if k != 'ehr_data'))
+            crec = LazyClinicalRecord(
+                ehr_data_loader=partial(self._decode_ehr_data, ehr_data),
+                creation_time=record['creation_time'],
+                last_update=record['last_update'],
+                active=record['active'],
+                record_id=record.get('_id'),
+                structure_id=record.get('ehr_structure_id'),
+                version=record['version']
+            )
+            if 'patient_id' in record:
+                crec._set_patient_id(record['patient_id'])
+            return crec
         record = decode_dict(record)
         if loaded:
-            ehr_data = record['ehr_data']
-            for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-                ehr_data = self.decode_keys(ehr_data, encoded_value, original_value)
             crec = ClinicalRecord(
-                ehr_data=ArchetypeInstance.from_json(ehr_data),
+                ehr_data=self._decode_ehr_data(record['ehr_data']),
                 creation_time=record['creation_time'],
                 last_update=record['last_update'],
                 active=record['active'],
@@ -385,14 +660,10 @@ class ElasticSearchDriver(DriverInterface):
         :return:clinical revision record entity
         :type: ClinicalRecordRevision
         """
-        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision, \
-            ArchetypeInstance
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision
         record = decode_dict(record)
-        ehr_data = record['ehr_data']
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
         return ClinicalRecordRevision(
-            ehr_data=ArchetypeInstance.from_json(ehr_data),
+            ehr_data=self._decode_ehr_data(record['ehr_data']),
             patient_id=record['patient_id'],
             creation_time=record['creation_time'],
             last_update=record['last_update'],
@@ -403,7 +674,7 @@ class ElasticSearchDriver(DriverInterface):
         )
 
 #    @profile
-    def decode_record(self, record, loaded=True):
+    def decode_record(self, record, loaded=True, lazy=False):
         """
         Create a :class:`Record` object from data retrieved from ES
 
@@ -412,10 +683,13 @@ class ElasticSearchDriver(DriverInterface):
         :param loaded: if True, return a :class:`Record` with all values, if False all fields with
           the exception of the record_id one will have a None value
         :type loaded: boolean
+        :param lazy: if True, clinical records are returned as :class:`LazyClinicalRecord` objects
+          whose clinical data are decoded on first access
+        :type lazy: boolean
         :return: the ES document encoded as a :class:`Record` object
         """
         if self._is_clinical_record(record):
-            return self._decode_clinical_record(record, loaded)
+            return self._decode_clinical_record(record, loaded, lazy)
         else:
             if self._is_clinical_record_revision(record):
                 return self._decode_clinical_record_revision(record)
@@ -434,6 +708,136 @@ class ElasticSearchDriver(DriverInterface):
     def _is_patient_record(self,record):
         return 'ehr_data' not in record
 
+    @property
+    def lookup_table_enabled(self):
+        return self.use_lookup_table or 'lookuptable' in (self.grbi, self.dere, self.dlv)
+
+    def _get_routing(self, record):
+        """
+        if *self.record_routing* is enabled, revisions are routed with the ID of the clinical record they come
+        from, so that all the versions of a record are stored in the same shard, other records use the default
+        routing (their ID). If *self.patient_routing* is enabled, clinical records and revisions are routed
+        with their patient ID.
+
+        :param record: the record that is going to be saved
+        :type record: dict
+        :return: the routing key or None for the default routing
+        """
+        if self.patient_routing and not self._is_patient_record(record):
+            return record['patient_id']
+        if self._is_clinical_record_revision(record):
+            return self._get_lookup_routing(record['_id'].rsplit('_', 1)[0])
+        return None
+
+    def _get_lookup_routing(self, baseid):
+        # the routing key of the revisions found in the lookup table, None for the default routing
+        return baseid if self.record_routing else None
+
+    def _get_revisions_routing(self, baseid):
+        # the routing key of the revisions of a clinical record, None if the record has no revisions
+        if not self.patient_routing:
+            return baseid
+        location = self._get_record_location(self._get_revision_id(baseid, 1))
+        if location is None:
+            return None
+        return location[1]
+
+    def _get_revision_id(self, baseid, version):
+        return '%s_%d' % (baseid, version)
+
+    def _get_records_locations(self, record_ids, fetch_source=False):
+        """
+        find records of the current database without knowing their doc types: the routing keys
+        that are compatible with the IDs (the ID itself and, for revisions, the ID of the clinical record)
+        are tried with a single multi get request. If *self.patient_routing* is enabled the records
+        that were not found are searched on all the shards with a single ids query. Unlike multi get
+        requests, searches only see refreshed documents: within a bulk ingest session the index is
+        refreshed before searching.
+
+        :param record_ids: the IDs of the records
+        :type record_ids: list
+        :param fetch_source: if True, the sources of the records are retrieved as well, a list of
+                             fields can be used to retrieve only part of the sources
+        :return: a dictionary with the IDs of the records found as keys and, as values, the responses
+                 of the get requests (_index, _type, _id and, if required, _source) and the routing keys
+        :rtype: dict
+        """
+        locations = dict()
+        record_ids = list(set(record_ids))
+        if not record_ids:
+            return locations
+        docs = list()
+        for record_id in record_ids:
+            docs.append(({'_id': record_id}, None))
+            if '_' in record_id:
+                baseid = record_id.rsplit('_', 1)[0]
+                docs.append(({'_id': record_id, '_routing': baseid}, baseid))
+        try:
+            res = self.client.mget(index=self.database, body={'docs': [d for d, _ in docs]},
+                                   _source=fetch_source)['docs']
+        except elasticsearch.NotFoundError:
+            # the index doesn't exist yet
+            return locations
+        for doc, (_, routing) in izip(res, docs):
+            if doc.get('found') and doc['_id'] not in locations:
+                locations[doc['_id']] = (doc, routing)
+        missing_ids = [rid for rid in record_ids if rid not in locations]
+        if missing_ids and self.patient_routing:
+            # the patient ID, used as routing key, is read from the source
+            if isinstance(fetch_source, (list, tuple)):
+                source = list(fetch_source) + ['patient_id']
+            else:
+                source = True if fetch_source else 'patient_id'
+            if self.ingest_session:
+                # automatic refresh is disabled, make the records written so far searchable
+                self.client.indices.refresh(index=self.database)
+            hits = self.client.search(index=self.database, body=dsl.search_body(dsl.ids(missing_ids)),
+                                      size=len(missing_ids), _source=source)['hits']['hits']
+            for hit in hits:
+                locations[hit['_id']] = (hit, hit['_source'].get('patient_id'))
+        return locations
+
+    def _get_record_location(self, record_id, fetch_source=False):
+        """
+        find a record of the current database without knowing its doc type,
+        see :meth:`_get_records_locations`
+
+        :return: the response of the get request and the routing key of the record,
+                 or None if the record doesn't exist
+        :rtype: tuple or None
+        """
+        return self._get_records_locations([record_id], fetch_source).get(record_id)
+
+    def _get_revisions_docs(self, baseid, routing, fetch_source=True):
+        """
+        retrieve the revisions of the clinical record with ID *baseid* from the current database,
+        versions are contiguous and start from 1 so their IDs are requested in chunks of
+        *self.msearch_size* with multi get requests routed to the shard of the clinical record
+
+        :param baseid: the ID of the clinical record
+        :type baseid: str
+        :param routing: the routing key of the revisions, see :meth:`_get_revisions_routing`
+        :param fetch_source: if True, the sources of the revisions are retrieved as well
+        :return: the responses of the get requests of the revisions
+        :rtype: list
+        """
+        revisions = list()
+        if routing is None:
+            return revisions
+        first_version = 1
+        while True:
+            ids = [self._get_revision_id(baseid, v) for v in xrange(first_version, first_version+self.msearch_size)]
+            try:
+                docs = self.client.mget(index=self.database, body={'ids': ids}, routing=routing,
+                                        _source=fetch_source)['docs']
+            except elasticsearch.NotFoundError:
+                return revisions
+            found = [d for d in docs if d.get('found')]
+            revisions.extend(found)
+            if len(found) < len(ids):
+                return revisions
+            first_version += len(ids)
+
     @property
     def documents_count(self):
         """
@@ -459,12 +863,15 @@ class ElasticSearchDriver(DriverInterface):
         :type: str
         """
         def clinical_add_withid():
-            if self._is_id_taken(self.database,record['_id']):
+            # the create operation type only detects IDs already used within the same doc type
+            # and shard, records with other doc types (or routing keys) are looked up first
+            if self._get_records_locations([record['_id']]):
                 raise DuplicatedKeyError('A record with ID %s already exists' % record['_id'])
             myid = str(self.client.index(index=self.database,doc_type=self.collection_name,id=record['_id'],
                                 body=self._to_json(record),op_type='create',refresh=self.refresh,
-                                         timeout=self.insert_timeout)['_id'])
+                                         routing=self._get_routing(record),timeout=self.insert_timeout)['_id'])
             self._store_ids(record)
+            self._register_writes(1)
             return myid
 
         def clinical_add_withoutid():
@@ -472,6 +879,7 @@ class ElasticSearchDriver(DriverInterface):
                                 op_type='create',refresh=self.refresh,timeout=self.insert_timeout)['_id'])
             record['_id']=myid
             self._store_ids(record)
+            self._register_writes(1)
             return myid
 
         self.__check_connection()
@@ -505,12 +913,60 @@ class ElasticSearchDriver(DriverInterface):
         :type   : dict
         """
         try:
-            if self.client.exists(index=self.database_ids,doc_type=self.doc_ids,id=baseid):
-                return self.client.get_source(index=self.database_ids,doc_type=self.doc_ids,id=baseid)
-            return None
+            return self.client.get_source(index=self.database_ids,doc_type=self.doc_ids,id=baseid)
         except elasticsearch.NotFoundError:
             return None
 
+    def _get_ids_multi(self, baseids):
+        """
+        search for the given baseids in the lookup table with a single multi get request
+
+        :param baseids: base ids without the version part
+        :type  baseids: list
+        :return: a dictionary with the baseids found in the lookup table as keys and their sources as values
+        :type   : dict
+        """
+        baseids = list(set(baseids))
+        if not baseids:
+            return dict()
+        try:
+            docs = self.client.mget(index=self.database_ids, doc_type=self.doc_ids,
+                                    body={'ids': baseids})['docs']
+        except elasticsearch.NotFoundError:
+            # the lookup index doesn't exist yet
+            return dict()
+        return dict((d['_id'], d['_source']) for d in docs if d.get('found'))
+
+    def _get_lookup_action(self, baseid, existing_record):
+        # bulk actions used to write (or delete, if it has no more ids) a document of the lookup table
+        if existing_record['ids']:
+            return [{'index': {'_index': self.database_ids, '_type': self.doc_ids, '_id': baseid}},
+                    existing_record]
+        return [{'delete': {'_index': self.database_ids, '_type': self.doc_ids, '_id': baseid}}]
+
+    def _check_bulk_response(self, bulkanswer):
+        """
+        Raise an error if some of the actions of a bulk request failed, bulk requests
+        don't raise exceptions for failures of the single items
+
+        :param bulkanswer: the response of the bulk request
+        :type bulkanswer: dict
+        """
+        if bulkanswer['errors']:
+            failures = list()
+            for item in bulkanswer['items']:
+                for action, result in item.iteritems():
+                    if 'error' in result:
+                        self.logger.error('unable to %s %s document: %r', action, result['_id'], result['error'])
+                        failures.append({'action': action, '_id': result['_id'], 'error': result['error']})
+            raise elasticsearch.TransportError(500, '%d actions of the bulk request failed' % len(failures),
+                                               failures)
+
+    def _run_lookup_bulk(self, actions, refresh):
+        if actions:
+            bulkanswer = self.client.bulk(body=actions, refresh=refresh, timeout=self.insert_timeout)
+            self._check_bulk_response(bulkanswer)
+
     def _store_ids(self,record):
         """
         store a record in the lookup table by its baseid
@@ -518,27 +974,34 @@ class ElasticSearchDriver(DriverInterface):
         :param record: record to store in the lookup table
         :type  record: dict
         """
-        if self._is_patient_record(record):
-            baseid=record['_id']
-        else:
-            baseid=record['_id'].rsplit('_', 1)[0]
-        ind=self.database
-        doct=self.collection_name
-        existing_record=self._get_ids(baseid)
-#        self._select_lookup_db(self.database)
-        if existing_record:
-            old_value=existing_record['ids']
-            old_value.append([record['_id'],ind,doct])
-            existing_record['ids']=old_value
-            self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh=self.refresh,timeout=self.insert_timeout)
-        else:
-            existing_record=dict()
-            existing_record['ids']=[[record['_id'],ind,doct]]
-            self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,op_type='create',refresh=self.refresh,
-                              timeout=self.insert_timeout)
+        self._store_ids_bulk([record])
 
+    def _store_ids_bulk(self, records, refresh=None):
+        """
+        store a list of records in the lookup table: the existing documents are read with a
+        single multi get request and the lookup table is updated with a single bulk request
+
+        :param records: records to store in the lookup table
+        :type  records: list of dict
+        :param refresh: the refresh parameter of the bulk request, if None self.refresh is used
+        """
+        if not self.lookup_table_enabled:
+            return
+        entries = list()
+        for record in records:
+            if self._is_patient_record(record):
+                baseid=record['_id']
+            else:
+                baseid=record['_id'].rsplit('_', 1)[0]
+                self._select_doc_type(record['ehr_structure_id'])
+            entries.append((baseid, [record['_id'], self.database, self.collection_name]))
+        existing_records = self._get_ids_multi([baseid for baseid, _ in entries])
+        for baseid, entry in entries:
+            existing_records.setdefault(baseid, {'ids': []})['ids'].append(entry)
+        actions = list()
+        for baseid in set(baseid for baseid, _ in entries):
+            actions.extend(self._get_lookup_action(baseid, existing_records[baseid]))
+        self._run_lookup_bulk(actions, self.refresh if refresh is None else refresh)
 
     def _erase_ids(self,id2e):
         """
@@ -547,30 +1010,35 @@ class ElasticSearchDriver(DriverInterface):
         :param id2e: id or baseid in the lookup table
         :type  id2e: str
         """
-        existing_record=self._get_ids(id2e)
-        if existing_record:
-            old_value=existing_record['ids']
-            new_value=[ov for ov in old_value if ov[0] != id2e]
-            if new_value:
-                existing_record['ids']=new_value
-                self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=id2e,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
-            else:
-                self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=id2e,refresh=self.drefresh)
-        else:
-            baseid=id2e.rsplit('_', 1)[0]
-            existing_record=self._get_ids(baseid)
-            if existing_record:
-                old_value=existing_record['ids']
-                new_value=[ov for ov in old_value if ov[0] != id]
-                if new_value:
-                    existing_record['ids']=new_value
-                    self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
-                else:
-                    self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=baseid,refresh=self.drefresh)
+        self._erase_ids_bulk([id2e])
+
+    def _erase_ids_bulk(self, ids, refresh=None):
+        """
+        delete a list of records from the lookup table given their ids or baseids, the existing
+        documents are read with a single multi get request and the lookup table is updated with
+        a single bulk request
+
+        :param ids: ids or baseids in the lookup table
+        :type  ids: list
+        :param refresh: the refresh parameter of the bulk request, if None self.drefresh is used
+        """
+        if not self.lookup_table_enabled:
+            return
+        existing_records = self._get_ids_multi(list(ids) + [id2e.rsplit('_', 1)[0] for id2e in ids])
+        updated = set()
+        for id2e in ids:
+            if id2e in existing_records:
+                baseid = id2e
+            elif id2e.rsplit('_', 1)[0] in existing_records:
+                baseid = id2e.rsplit('_', 1)[0]
             else:
-                raise MissingRevisionError("A record with ID %s does not exist in archive" % id)
+                raise MissingRevisionError("A record with ID %s does not exist in archive" % id2e)
+            existing_records[baseid]['ids'] = [ov for ov in existing_records[baseid]['ids'] if ov[0] != id2e]
+            updated.add(baseid)
+        actions = list()
+        for baseid in updated:
+            actions.extend(self._get_lookup_action(baseid, existing_records[baseid]))
+        self._run_lookup_bulk(actions, self.drefresh if refresh is None else refresh)
 
     def pack_records(self,records,rectype_clinical):
         """
@@ -593,6 +1061,9 @@ class ElasticSearchDriver(DriverInterface):
             if rectype_clinical:
                 self._select_doc_type(dox['ehr_structure_id'])
             puzzle=puzzle+first+"\",\"_type\":\""+self.collection_name+"\""
+            routing = self._get_routing(dox)
+            if routing:
+                puzzle = puzzle+",\"_routing\":\""+routing+"\""
             if(dox.has_key('_id')):
                 puzzle = puzzle+",\"_id\":\""+dox['_id']+"\"}}\n"
             else:
@@ -620,6 +1091,23 @@ class ElasticSearchDriver(DriverInterface):
             return self.client.exists(index=indextc,id=idtc)
 
 
+    def _get_taken_ids(self, ids):
+        """
+        given a list of ids returns the set of the ones already used in the current database, records
+        are looked up with :meth:`_get_records_locations` (so that routed records are found as well),
+        one chunk of *self.threshold* ids at a time
+
+        :param ids: ids to check
+        :type ids: list
+        :return: the ids already in use
+        :rtype: set
+        """
+        taken_ids = set()
+        ids = list(ids)
+        for i in xrange(0, len(ids), self.threshold):
+            taken_ids.update(self._get_records_locations(ids[i:i+self.threshold]))
+        return taken_ids
+
     def add_records(self,records,skip_existing_duplicated=False):
         """
         Save a list of records in ES and return records' IDs
@@ -640,6 +1128,7 @@ class ElasticSearchDriver(DriverInterface):
         notduplicatedlist=[]
         duplicatedlistid=[]
         records_map={}
+        taken_ids=self._get_taken_ids(set(r['_id'] for r in records))
         for r in records:
             myid=r['_id']
             if myid in records_map:
@@ -647,43 +1136,131 @@ class ElasticSearchDriver(DriverInterface):
                 duplicatedlistid.append(myid)
             else:
                 records_map[myid]=r
-                if(not self._is_patient_record(r)):
-                    self._select_doc_type(r['ehr_structure_id'])
-                if(self._is_id_taken(self.database,myid)):
+                if(myid in taken_ids):
                     duplicatedlist.append(r)
                     duplicatedlistid.append(myid)
                 else:
                     notduplicatedlist.append(r)
         if duplicatedlist and not skip_existing_duplicated:
             raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicatedlistid)
-        bulklist = self.pack_records(notduplicatedlist,rectype_clinical)
-        bulkanswer = self.client.bulk(body=bulklist,index=self.database,refresh=self.refresh,
-                                      timeout=self.insert_timeout)
+        bulkitems=[]
+        bulkerrors=False
+        for bulklist in self._pack_bulk_chunks(notduplicatedlist,rectype_clinical):
+            # indexes are refreshed once, after the lookup table has been updated
+            bulkanswer = self.client.bulk(body=bulklist,index=self.database,refresh='false',
+                                          timeout=self.insert_timeout)
+            bulkitems.extend(bulkanswer['items'])
+            bulkerrors = bulkerrors or bulkanswer['errors']
         failuresid=[]
         errtype=[]
         nerrors=0
         successfulid=[]
-        if(bulkanswer['errors']): # there are errors
-            for b in bulkanswer['items']:
+        if(bulkerrors): # there are errors
+            for b in bulkitems:
                 if(b['create'].has_key('error')):
                     failuresid.append(str(b['create']['_id']))
                     errtype.append(str(b['create']['error']))
                     nerrors += 1
                 else:
                     successfulid.append(b['create']['_id'])
+            # rollback, successful records are removed
+            self._store_ids_bulk([records_map[s] for s in successfulid], refresh='false')
+            self._refresh_indexes()
+            self._register_writes(len(successfulid))
             for s in successfulid:
-                r=records_map[s]
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
                 self.delete_record(s)
             return [],duplicatedlist
         else:
-            for r in notduplicatedlist:
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
-            return [b['create']['_id'] for b in bulkanswer['items']],duplicatedlist
+            self._store_ids_bulk(notduplicatedlist, refresh='false')
+            self._refresh_indexes()
+            self._register_writes(len(bulkitems))
+            return [b['create']['_id'] for b in bulkitems],duplicatedlist
+
+    def add_records_unordered(self, records):
+        """
+        Save a list of records in ES with bulk requests: records that can't be created (i.e. records
+        with an ID already in use) are reported without stopping the other ones and without rolling
+        back the saved ones. Since clinical records with different doc types (or routing keys) can
+        share the same ID, IDs already in use are looked up in advance with batched multi get requests.
+        IDs must be unique within the given list and records must be all patient records or all
+        clinical records.
+
+        :param records: the list of records that is going to be saved
+        :type records: list
+        :return: a list of records' IDs and a dictionary mapping the IDs of the records that were
+          not saved to the related error messages
+        """
+        if not records:
+            return [], {}
+        self._check_batch(records, '_id')
+        self.__check_connection()
+        rectype_clinical = not self._is_patient_record(records[0])
+        saved = []
+        taken_ids = self._get_taken_ids(set(r['_id'] for r in records))
+        errors = dict((r['_id'], 'A record with ID %s already exists' % r['_id'])
+                      for r in records if r['_id'] in taken_ids)
+        for bulklist in self._pack_bulk_chunks([r for r in records if r['_id'] not in errors],
+                                               rectype_clinical):
+            # indexes are refreshed once, after the lookup table has been updated
+            bulkanswer = self.client.bulk(body=bulklist, index=self.database, refresh='false',
+                                          timeout=self.insert_timeout)
+            for b in bulkanswer['items']:
+                if 'error' in b['create']:
+                    errors[str(b['create']['_id'])] = str(b['create']['error'])
+                else:
+                    saved.append(str(b['create']['_id']))
+        if saved:
+            records_map = dict((r['_id'], r) for r in records)
+            self._store_ids_bulk([records_map[s] for s in saved], refresh='false')
+            self._refresh_indexes()
+            self._register_writes(len(saved))
+        return saved, errors
+
+    def _pack_bulk_chunks(self, records, rectype_clinical):
+        """
+        pack records for the bulk insertion in chunks of at most *self.bulk_max_actions* records
+        and *self.bulk_max_bytes* bytes
+
+        :param records: records to be packed
+        :type records : list of dict
+        :param rectype_clinical: whether the records are clinical records
+        :type rectype_clinical: bool
+        :return: a generator of bulk request bodies
+        """
+        chunk=[]
+        chunk_size=0
+        for r in records:
+            packed = self.pack_records([r],rectype_clinical)
+            if chunk and (len(chunk) >= self.bulk_max_actions or chunk_size+len(packed) > self.bulk_max_bytes):
+                yield ''.join(chunk)
+                chunk=[]
+                chunk_size=0
+            chunk.append(packed)
+            chunk_size += len(packed)
+        if chunk:
+            yield ''.join(chunk)
+
+    def _register_writes(self, records_count):
+        if self.ingest_session:
+            self.ingest_session.register_writes(records_count)
+
+    def bulk_ingest_session(self):
+        """
+        Return a :class:`BulkIngestSession` for the current database, drivers that write records
+        during the session must be created with the *ingest_session* option
+
+        :return: a :class:`BulkIngestSession` object
+        """
+        self.__check_connection()
+        return BulkIngestSession(self)
+
+    def _refresh_indexes(self):
+        # refresh records' index and lookup table, if refresh is enabled
+        if self.refresh == 'true':
+            indexes = [self.database]
+            if self.lookup_table_enabled:
+                indexes.append(self.database_ids)
+            self.client.indices.refresh(index=','.join(indexes))
 
     def get_record_by_id(self, record_id):
         """
@@ -694,19 +1271,41 @@ class ElasticSearchDriver(DriverInterface):
         :param limit:
         :return:
         """
-        if self.grbi == "current":
+        if self.grbi == "routing":
+            res=self.get_record_by_id_routing(record_id)
+        elif self.grbi == "current":
             res=self.get_record_by_id_current(record_id)
         elif self.grbi == "lookuptable":
             res=self.get_record_by_id_lookup(record_id)
         else:
-            print "\nbad grbi:"+self.grbi+" using \"current\" instead"
-            res=self.get_record_by_id_current(record_id)
+            self.logger.warning('Unknown record location method %s, using "routing" instead', self.grbi)
+            res=self.get_record_by_id_routing(record_id)
         return res
 
+    def get_record_by_id_routing(self, record_id):
+        """
+        Retrieve a record using its ID
+        Approach 1: compute the routing keys compatible with the ID and look for the record in the current database
+
+        :param record_id: the ID of the record
+        :type record_id: str
+        :return: the record or None if no match was found for the given record
+        :rtype: dictionary or None
+        """
+        self.__check_connection()
+        if isinstance(record_id,dict):
+            rid=record_id['_id']['_id']+"_"+str(record_id['_id']['_version'])
+        else:
+            rid=record_id
+        location = self._get_record_location(rid, fetch_source=True)
+        if location is None:
+            return None
+        return decode_dict(location[0]['_source'])
+
     def get_record_by_id_current(self, record_id):
         """
         Retrieve a record using its ID
-        Approach 1: look for the id in the current database
+        Approach 2: look for the id in the current database, using the default routing
 
         :param record_id: the ID of the record
         :type record_id: str
@@ -718,7 +1317,7 @@ class ElasticSearchDriver(DriverInterface):
         try:
             if(isinstance(record_id,dict)):
                 newid=record_id['_id']['_id']+"_"+str(record_id['_id']['_version'])
-                res = self.client.get_source(index=self.database,id=newid)
+                res = self.client.get_source(index=self.database,id=newid,routing=record_id['_id']['_id'])
             else:
                 res =self.client.get_source(index=self.database,id=record_id)
             return decode_dict(res)
@@ -730,7 +1329,7 @@ class ElasticSearchDriver(DriverInterface):
     def get_record_by_id_lookup(self, record_id):
         """
         Retrieve a record using its ID
-        Approach 2: look for the id in the lookup table then with the coordinates found there get the record
+        Approach 3: look for the id in the lookup table then with the coordinates found there get the record
 
         :param record_id: the ID of the record
         :return: the record of None if no match was found for the given record
@@ -761,15 +1360,73 @@ class ElasticSearchDriver(DriverInterface):
                     if not f:
                         return None
                     found=f[0]
-                    return decode_dict(self.client.get_source(index=found[1],doc_type=found[2],id=found[0]))
+                    return decode_dict(self.client.get_source(index=found[1],doc_type=found[2],id=found[0],
+                                                              routing=self._get_lookup_routing(baseid)))
                 else:
                     return None
         except elasticsearch.NotFoundError:
             return None
 
     def get_record_by_version(self, record_id, version):
+        """
+        Retrieve a record using its ID and version number, the lookup table is used only
+        if it is the method selected for get_record_by_id
+
+        :param record_id: the ID of the record
+        :param version: the version number of the record
+        :type version: int
+        :return: the record or None if no match was found
+        :rtype: dict or None
+        """
+        if self.grbi == "lookuptable":
+            return self.get_record_by_version_lookup(record_id, version)
+        return self.get_record_by_version_routing(record_id, version)
+
+    def _get_current_record(self, record_id):
+        # search the alias shared by current and versioning databases, routed to the shard of the record
+        try:
+            hits = self.client.search(index=self.database_alias, body=dsl.search_body(dsl.ids([record_id])),
+                                      routing=None if self.patient_routing else record_id)['hits']['hits']
+        except elasticsearch.NotFoundError:
+            return None
+        records = [h['_source'] for h in hits if not self._is_clinical_record_revision(h['_source'])]
+        if records:
+            return records[0]
+        return None
+
+    def get_record_by_version_routing(self, record_id, version):
         """
         Retrieve a record using its ID and version number
+        Approach 1: get the revision from the shard of the clinical record, if no revision
+        exists look for the current version of the record using the repository alias
+
+        :param record_id: the ID of the record
+        :param version: the version number of the record
+        :type version: int
+        :return: the record or None if no match was found
+        :rtype: dict or None
+        """
+        self.__check_connection()
+        if isinstance(record_id,dict):
+            rid=record_id['_id']+"_"+str(record_id['_version'])
+        else:
+            rid=self._get_revision_id(record_id, version)
+        baseid=rid.rsplit('_', 1)[0]
+        routing=self._get_revisions_routing(baseid)
+        try:
+            if routing is None:
+                raise elasticsearch.NotFoundError(404, 'No revisions for record %s' % baseid)
+            rec=self.client.get_source(index=self.database,id=rid,routing=routing)
+        except elasticsearch.NotFoundError:
+            rec=self._get_current_record(baseid)
+        if rec and rec.get('version') == version:
+            return decode_dict(rec)
+        return None
+
+    def get_record_by_version_lookup(self, record_id, version):
+        """
+        Retrieve a record using its ID and version number
+        Approach 2: use the lookup table to find the coordinates of the record
 
         :param record_id: the ID of the record
         :param version: the version number of the record
@@ -799,7 +1456,8 @@ class ElasticSearchDriver(DriverInterface):
                             return decode_dict(rec)
                     return None
                 found=f[0]
-                rec=self.client.get_source(index=found[1],doc_type=found[2],id=found[0])
+                rec=self.client.get_source(index=found[1],doc_type=found[2],id=found[0],
+                                           routing=self._get_lookup_routing(baseid))
                 if rec.has_key('version'):
                     if rec['version'] == version:
                         return decode_dict(rec)
@@ -809,8 +1467,42 @@ class ElasticSearchDriver(DriverInterface):
 
 #    @profile
     def get_revisions_by_ehr_id(self, ehr_id):
+        """
+        Retrieve all revisions for the given EHR ID, the lookup table is used only
+        if it is the method selected for get_record_by_id
+
+        :param ehr_id: the EHR ID that will be used to retrieve revisions
+        :return: all revisions matching given ID
+        :rtype: list
+        """
+        if self.grbi == "lookuptable":
+            return self.get_revisions_by_ehr_id_lookup(ehr_id)
+        return self.get_revisions_by_ehr_id_routing(ehr_id)
+
+    def get_revisions_by_ehr_id_routing(self, ehr_id):
         """
         Retrieve all revisions for the given EHR ID
+        Approach 1: compute the IDs of the revisions and get them from the shard of the clinical record
+
+        :param ehr_id: the EHR ID that will be used to retrieve revisions
+        :return: all revisions matching given ID
+        :rtype: list
+        """
+        self.__check_connection()
+        if isinstance(ehr_id,dict):
+            rid=ehr_id['_id']+"_"+str(ehr_id['_version'])
+        else:
+            rid=ehr_id
+        baseid=rid.rsplit('_', 1)[0]
+        docs=self._get_revisions_docs(baseid, self._get_revisions_routing(baseid))
+        if not docs:
+            return None
+        return ( decode_dict(d['_source']) for d in docs )
+
+    def get_revisions_by_ehr_id_lookup(self, ehr_id):
+        """
+        Retrieve all revisions for the given EHR ID
+        Approach 2: use the lookup table to find the coordinates of all record revisions
 
         :param ehr_id: the EHR ID that will be used to retrieve revisions
         :return: all revisions matching given ID
@@ -829,51 +1521,84 @@ class ElasticSearchDriver(DriverInterface):
                 ff=[elem for elem in er if elem[0]!=baseid]
                 if not ff:
                     return None
-                results=[]
-                for f in ff:
-                    results.append(self.client.get_source(index=f[1],doc_type=f[2],id=f[0]))
-                return ( decode_dict(results[i]) for i in range(0,len(results)) )
+                docs=[{'_index': f[1], '_type': f[2], '_id': f[0]} for f in ff]
+                routing=self._get_lookup_routing(baseid)
+                if routing:
+                    for d in docs:
+                        d['_routing']=routing
+                docs=self.client.mget(body={'docs': docs})['docs']
+                return ( decode_dict(d['_source']) for d in docs if d.get('found') )
             return None
         except (elasticsearch.NotFoundError, elasticsearch.ConflictError,elasticsearch.TransportError) :
             return None
 
+    def get_records_by_ids(self, ids, active_only=False, fields=None):
+        """
+        Retrieve the records with the given IDs from the current database with a single multi get
+        request, IDs that don't match any record are ignored. If only active records are required,
+        a single search filtered by IDs and *active* field is used instead.
+
+        :param ids: the IDs of the records
+        :type ids: list
+        :param active_only: if True, only records whose *active* field is True are retrieved
+        :type active_only: bool
+        :param fields: if not None, only the given fields of the records' sources are retrieved
+        :type fields: list
+        :return: the records, in the same order of the given IDs
+        :rtype: list
+        """
+        self.__check_connection()
+        ids = list(ids)
+        if not ids:
+            return []
+        source = list(fields) if fields else True
+        if active_only:
+            query = dsl.bool_query(filter=[dsl.ids(ids), dsl.term('active', True)])
+            try:
+                hits = self.client.search(index=self.database, body=dsl.search_body(query, _source=source),
+                                          size=len(ids))['hits']['hits']
+            except elasticsearch.NotFoundError:
+                return []
+            records = dict((h['_id'], h['_source']) for h in hits)
+            return [decode_dict(records[i]) for i in ids if i in records]
+        if self.patient_routing:
+            # records routed by patient ID can't be found using their IDs only
+            locations = self._get_records_locations(ids, fetch_source=source)
+            return [decode_dict(locations[i][0]['_source']) for i in ids if i in locations]
+        try:
+            docs = self.client.mget(index=self.database, body={'ids': ids}, _source=source)['docs']
+        except elasticsearch.NotFoundError:
+            return []
+        return [decode_dict(d['_source']) for d in docs if d.get('found')]
+
+    def _get_collection_query(self, *filters):
+        # select the records of the current collection, clinical records' doc types start with the collection's name
+        return dsl.search_body(dsl.bool_query(filter=[dsl.prefix('_type', self.collection)] + list(filters)))
+
     def get_all_records(self):
         """
-        Retrieve all records within current collection.
-        For ES within current database
+        Retrieve all records within current collection, records are streamed so the connection
+        must be kept open until the returned generator is consumed
 
         :return: all the records stored in the current collection
-        :rtype: list
+        :rtype: generator
         """
         self.__check_connection()
-        query="{ \"filter\" : { \"match_all\" : {} } }"
-        restot = self.client.search(index=self.database,body=query)['hits']['hits']
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
+        return self.get_records_by_query(self._get_collection_query())
 
     def get_records_by_value(self, field, value):
         """
-        Retrieve all records whose field *field* matches the given value
+        Retrieve all records of the current collection whose field *field* matches the given value,
+        records are streamed so the connection must be kept open until the returned generator is consumed
 
         :param field: the field used for the selection
         :type field: string
         :param value: the value that must be matched for the given field
-        :return: a list of records
-        :rtype: list
+        :return: a generator of records
+        :rtype: generator
         """
         self.__check_connection()
-        myquery = {
-            "filter" : {
-                    "term" : { field : value }
-                    }
-                }
-        restot = self.client.search(index=self.database,body=myquery)['hits']['hits']
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
+        return self.get_records_by_query(self._get_collection_query(dsl.term(field, value)))
 
     def get_records_by_values(self, field, values):
         """
@@ -906,18 +1631,43 @@ class ElasticSearchDriver(DriverInterface):
         :param limit:
         :return:
         """
-        if self.dere == "search":
-            self.delete_record_current(record_id)
+        if self.dere == "routing":
+            self.delete_record_routing(record_id)
+        elif self.dere == "search":
+            self.delete_record_search(record_id)
         elif self.dere == "lookuptable":
             self.delete_record_lookup(record_id)
         else:
-            print "\nbad dere:"+self.dere+" using \"lookuptable\" instead"
-            self.delete_record_lookup(record_id)
+            self.logger.warning('Unknown record location method %s, using "routing" instead', self.dere)
+            self.delete_record_routing(record_id)
+
+    def delete_record_routing(self, record_id):
+        """
+        Delete an existing record
+        Approach 1: find the record using the routing keys compatible with its ID and delete it,
+        the lookup table is updated only if it is enabled
+
+        :param record_id: record's ID
+        """
+        self.__check_connection()
+        self.logger.debug('deleting document with ID %s', record_id)
+        if isinstance(record_id,dict):
+            rid=record_id['_id']+"_"+str(record_id['_version'])
+        else:
+            rid=record_id
+        location=self._get_record_location(rid)
+        if location is None:
+            raise MissingRevisionError("A record with ID %s does not exist" % record_id)
+        found, routing = location
+        self.client.delete(index=found['_index'],doc_type=found['_type'],id=rid,routing=routing,
+                           refresh=self.drefresh)
+        self._register_writes(-1)
+        self._erase_ids(rid)
 
     def delete_record_lookup(self, record_id):
         """
         Delete an existing record
-        Approach 1:find the coordinates of the record in the lookup table. Delete it and erase it from the lookup table.
+        Approach 2:find the coordinates of the record in the lookup table. Delete it and erase it from the lookup table.
 
         :param record_id: record's ID
         """
@@ -936,6 +1686,7 @@ class ElasticSearchDriver(DriverInterface):
                 raise MissingRevisionError("A record with ID %s does not exist in ids archive" % record_id)
             found=f[0]
             self.client.delete(index=found[1],doc_type=found[2],id=found[0],refresh=self.drefresh)
+            self._register_writes(-1)
             self._erase_ids(found[0])
         else:
             baseid=rid.rsplit('_', 1)[0]
@@ -946,7 +1697,9 @@ class ElasticSearchDriver(DriverInterface):
                 if not f:
                     raise MissingRevisionError("A record with ID %s does not exist in ids archive" % record_id)
                 found=f[0]
-                self.client.delete(index=found[1],doc_type=found[2],id=found[0],refresh=self.drefresh)
+                self.client.delete(index=found[1],doc_type=found[2],id=found[0],
+                                   routing=self._get_lookup_routing(baseid),refresh=self.drefresh)
+                self._register_writes(-1)
                 self._erase_ids(found[0])
             else:
                 raise MissingRevisionError("A record with ID %s does not exist in ids archive" % record_id)
@@ -954,7 +1707,7 @@ class ElasticSearchDriver(DriverInterface):
     def delete_record_search(self, record_id):
         """
         Delete an existing record
-        Approach 2: Use delete by query to search and delete on all databases the record with given id
+        Approach 3: Use delete by query to search and delete on all databases the record with given id
 
         :param record_id: record's ID
         """
@@ -991,19 +1744,52 @@ class ElasticSearchDriver(DriverInterface):
         :param limit:
         :return:
         """
-        if self.dlv == "search":
+        if self.dlv == "routing":
+            return self.delete_later_versions_routing(record_id, version_to_keep)
+        elif self.dlv == "search":
             return self.delete_later_versions_search(record_id, version_to_keep)
         elif self.dlv == "lookuptable":
             return self.delete_later_versions_lookup(record_id, version_to_keep)
         else:
-            print "\nbad dlv:"+self.dlv+" using \"lookuptable\" instead"
-            return self.delete_later_versions_lookup(record_id)
+            self.logger.warning('Unknown record location method %s, using "routing" instead', self.dlv)
+            return self.delete_later_versions_routing(record_id, version_to_keep)
+
+    def delete_later_versions_routing(self, record_id, version_to_keep):
+        """
+        Delete versions newer than version_to_keep for the given record ID.
+        Approach 1: compute the IDs of the record revisions, get them from the shard of the
+        clinical record and delete them with a single bulk request
+
+        :param record_id: ID of the record
+        :param version_to_keep: the older version that will be preserved, if 0
+                                delete all versions for the given record ID
+        :type version_to_keep: int
+        :return: the number of deleted records
+        :rtype: int
+        """
+        self.__check_connection()
+        if(isinstance(record_id,dict)):
+            rid = record_id['_id']+"_"+str(record_id['_version'])
+        else:
+            rid=record_id
+        baseid=rid.rsplit('_', 1)[0]
+        routing=self._get_revisions_routing(baseid)
+        docs=[d for d in self._get_revisions_docs(baseid, routing, fetch_source=False)
+              if int(d['_id'].rsplit('_', 1)[1]) > version_to_keep]
+        if docs:
+            actions=[{'delete': {'_index': d['_index'], '_type': d['_type'], '_id': d['_id'], '_routing': routing}}
+                     for d in docs]
+            bulkanswer = self.client.bulk(body=actions, refresh=self.drefresh, timeout=self.insert_timeout)
+            self._check_bulk_response(bulkanswer)
+            self._register_writes(-len(docs))
+            self._erase_ids_bulk([d['_id'] for d in docs])
+        return len(docs)
 
 
     def delete_later_versions_lookup(self, record_id, version_to_keep):
         """
         Delete versions newer than version_to_keep for the given record ID.
-        Approach 1: use the lookup table to find the coordinates of all record revisions for the given id
+        Approach 2: use the lookup table to find the coordinates of all record revisions for the given id
 
         :param record_id: ID of the record
         :param version_to_keep: the older version that will be preserved, if 0
@@ -1022,21 +1808,27 @@ class ElasticSearchDriver(DriverInterface):
         if existing_record:
             er=existing_record['ids']
             new_er=[]
+            actions=[]
+            routing=self._get_lookup_routing(baseid)
             for elem in er:
                 if "_" in elem[0]:
                     if int(elem[0].rsplit('_',1)[1])>version_to_keep:
-                        self.client.delete(index=elem[1],doc_type=elem[2],id=elem[0],refresh=self.drefresh)
-                        self._erase_ids(elem[0])
+                        action={'_index': elem[1], '_type': elem[2], '_id': elem[0]}
+                        if routing:
+                            action['_routing']=routing
+                        actions.append({'delete': action})
                         counter=counter+1
                     else:
                         new_er.append([elem[0],elem[1],elem[2]])
                 else:
                     new_er.append([elem[0],elem[1],elem[2]])
-            if new_er:
+            if counter:
+                # records and lookup table are updated with a single bulk request
                 existing_record['ids']=new_er
-                self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
-            self.client.indices.refresh(index=self.database_ids)
+                actions.extend(self._get_lookup_action(baseid, existing_record))
+                self._run_lookup_bulk(actions, self.drefresh)
+            if not self.ingest_session:
+                self.client.indices.refresh(index=self.database_ids)
             return counter
         else:
             return 0
@@ -1044,7 +1836,7 @@ class ElasticSearchDriver(DriverInterface):
     def delete_later_versions_search(self, record_id, version_to_keep):
         """
         Delete versions newer than version_to_keep for the given record ID.
-        Approach 2: it use queries to find the record revisions for the given id
+        Approach 3: it use queries to find the record revisions for the given id
 
         :param record_id: ID of the record
         :param version_to_keep: the older version that will be preserved, if 0
@@ -1086,20 +1878,129 @@ class ElasticSearchDriver(DriverInterface):
             if forrestrue:
                 restrue=forrestrue['hits']['total']
             res=self.client.delete_by_query(index=self.database,body=query)
-            self.client.indices.refresh(index=self.database)
+            if not self.ingest_session:
+                self.client.indices.refresh(index=self.database)
             #update ids lookup table
             results=forrestrue['hits']['hits']
-            for r in results:
-                self._erase_ids(r['_id'])
+            self._erase_ids_bulk([r['_id'] for r in results])
             return restrue
         except elasticsearch.NotFoundError:
             return None
 
 
+    def _get_update_body(self, script, params, update_timestamp_label, increase_version):
+        """
+        build the body of an _update request running one of the UPDATE_SCRIPTS
+
+        :return: the body of the request and the timestamp of the update (or None if
+                 *update_timestamp_label* was None)
+        """
+        last_update = time.time() if update_timestamp_label else None
+        params = dict(params, timestamp_label=update_timestamp_label, last_update=last_update,
+                      increase_version=increase_version)
+        body = {
+            'script': {
+                'inline': UPDATE_SCRIPTS[self.script_lang][script],
+                'lang': self.script_lang,
+                'params': params
+            }
+        }
+        return body, last_update
+
+    def _get_field_update_body(self, field_label, field_value, update_timestamp_label, increase_version):
+        # a partial document is enough if the version of the record doesn't change
+        if increase_version:
+            return self._get_update_body('set_field', {'field_label': field_label, 'field_value': field_value},
+                                         update_timestamp_label, increase_version)
+        last_update = time.time() if update_timestamp_label else None
+        doc = {field_label: field_value}
+        if update_timestamp_label:
+            doc[update_timestamp_label] = last_update
+        return {'doc': doc}, last_update
+
+    def _update_record(self, record_id, body):
+        """
+        apply an _update request to the record with ID *record_id*, only the changes are sent to ES
+        and the document is never read by the driver
+
+        :return: True if the record was updated, False if no record with the given ID exists
+        :rtype: bool
+        """
+        self.__check_connection()
+        location = self._get_record_location(record_id)
+        if location is None:
+            self.logger.debug('No record found with ID %r', record_id)
+            return False
+        found, routing = location
+        try:
+            res = self.client.update(index=self.database, doc_type=found['_type'], id=record_id, body=body,
+                                     routing=routing, retry_on_conflict=self.update_retries,
+                                     timeout=self.insert_timeout)
+        except elasticsearch.NotFoundError:
+            self.logger.debug('No record found with ID %r', record_id)
+            return False
+        except elasticsearch.RequestError, re_err:
+            if MISSING_LIST_ITEM_ERROR in str(re_err.info):
+                raise ValueError('Unable to update record %s, item not found in list' % record_id)
+            raise
+        self.logger.debug('updated %s document', res[u'_id'])
+        return True
+
+    def _is_script_rejected(self, error):
+        # ES 2.x: "scripts of type [inline], operation [update] and lang [groovy] are disabled"
+        return 'scripts of type [inline]' in str(error) and 'are disabled' in str(error)
+
+    def _disable_script_updates(self):
+        if self.script_updates:
+            self.logger.warning('Inline %s scripts are disabled on the ElasticSearch server, records will be '
+                                'updated by indexing whole documents again', self.script_lang)
+            self.script_updates = False
+
+    def _update_record_by_script(self, record_id, body, update_document, update_timestamp_label,
+                                 last_update, increase_version):
+        """
+        apply an _update request running a script, if inline scripts are disabled on the server
+        *update_document* is applied to the whole record that is indexed again
+
+        :return: True if the record was updated, False if no record with the given ID exists
+        :rtype: bool
+        """
+        if self.script_updates:
+            try:
+                return self._update_record(record_id, body)
+            except elasticsearch.TransportError, te:
+                if not self._is_script_rejected(te.info):
+                    raise
+                self._disable_script_updates()
+        return self._replace_updated_record(record_id, update_document, update_timestamp_label,
+                                            last_update, increase_version)
+
+    def _replace_updated_record(self, record_id, update_document, update_timestamp_label, last_update,
+                                increase_version):
+        """
+        read the whole record, apply *update_document* to it and index it again
+
+        :return: True if the record was updated, False if no record with the given ID exists
+        :rtype: bool
+        """
+        record = self.get_record_by_id(record_id)
+        if record is None:
+            self.logger.debug('No record found with ID %r', record_id)
+            return False
+        update_document(record)
+        if update_timestamp_label:
+            record[update_timestamp_label] = last_update
+        if increase_version:
+            record['version'] += 1
+        self.replace_record(record_id, record)
+        return True
+
     def update_field(self, record_id, field_label, field_value, update_timestamp_label=None,
                      increase_version=False):
         """
-        Update record's field *field* with given value
+        Update record's field *field* with given value, using a partial document (or a script
+        if the version must be increased) with the _update API. If *self.patient_routing* is enabled
+        and the patient ID of a clinical record changes, the record is moved to the shard of the new patient.
 
         :param record_id: record's ID
         :param field_label: field's label
@@ -1113,42 +2014,92 @@ class ElasticSearchDriver(DriverInterface):
         :type increase_version: bool
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        record_to_update = self.get_record_by_id(record_id)
-        if record_to_update is None:
-            self.logger.debug('No record found with ID %r', record_id)
+        if self.patient_routing and field_label == 'patient_id':
+            return self._move_record(record_id, field_value, update_timestamp_label, increase_version)
+        body, last_update = self._get_field_update_body(field_label, field_value, update_timestamp_label,
+                                                        increase_version)
+        if increase_version:
+            def update_document(record):
+                record[field_label] = field_value
+            if not self._update_record_by_script(record_id, body, update_document, update_timestamp_label,
+                                                 last_update, increase_version):
+                return None
+        elif not self._update_record(record_id, body):
             return None
-        else:
-            if not self._is_patient_record(record_to_update):
-                self._select_doc_type(record_to_update['ehr_structure_id'])
-            record_to_update[field_label]= field_value
-            if update_timestamp_label:
-                last_update = time.time()
-                record_to_update['last_update']=last_update
-            else:
-                last_update=None
-            if increase_version:
-                newversion = record_to_update['version']+1
-                record_to_update['version']=newversion
-                res = self.client.index(index=self.database,doc_type=self.collection_name,body=record_to_update,
-                                        id=record_id,timeout=self.insert_timeout)
-                if(self._is_clinical_record_revision(record_to_update)):
-                    self.logger.debug('updated %s document',res[u'_id'].rsplit('_', 1)[0])
-                else:
-                    self.logger.debug('updated %s document', res[u'_id'])
-            else:
-                if(self._is_clinical_record_revision(record_to_update)):
-                    res = self.client.index(index=self.database,doc_type=self.collection_name,body=record_to_update,
-                                            id=record_id,timeout=self.insert_timeout)
-                    self.logger.debug('updated %s document',res[u'_id'].rsplit('_', 1)[0])
-                else:
-                    res = self.client.index(index=self.database,doc_type=self.collection_name,body=record_to_update,
-                                            id=record_id,timeout=self.insert_timeout)
-                    self.logger.debug('updated %s document', res[u'_id'])
-            return last_update
+        return last_update
+
+    def _move_record(self, record_id, patient_id, update_timestamp_label, increase_version):
+        # the routing key of the record changes, the record must be indexed again
+        def update_document(record):
+            record['patient_id'] = patient_id
+        last_update = time.time() if update_timestamp_label else None
+        if not self._replace_updated_record(record_id, update_document, update_timestamp_label, last_update,
+                                            increase_version):
+            return None
+        return last_update
+
+    def update_field_multi(self, record_ids, field_label, field_value, update_timestamp_label=None,
+                           increase_version=False):
+        """
+        Update the field *field_label* of all the records with the given IDs, doc types and routing
+        keys are read with a single multi get request and the records are changed with bulk _update requests
+
+        :param record_ids: the IDs of the records
+        :type record_ids: list
+        :param field_label: field's label
+        :type field_label: string
+        :param field_value: new value for the selected field
+        :param update_timestamp_label: the label of the *last_update* field of the records if the last update
+          timestamp must be recorded or None
+        :type update_timestamp_label: field label or None
+        :param increase_version: if True, increase records' version number by 1
+        :type increase_version: bool
+        :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
+        """
+        self.__check_connection()
+        if (self.patient_routing and field_label == 'patient_id') or \
+                (increase_version and not self.script_updates):
+            return super(ElasticSearchDriver, self).update_field_multi(record_ids, field_label, field_value,
+                                                                       update_timestamp_label, increase_version)
+        body, last_update = self._get_field_update_body(field_label, field_value, update_timestamp_label,
+                                                        increase_version)
+        locations = self._get_records_locations(record_ids)
+        for rid in set(record_ids) - set(locations):
+            self.logger.debug('No record found with ID %r', rid)
+        actions = list()
+        for rid, (found, routing) in locations.iteritems():
+            action = {'_index': self.database, '_type': found['_type'], '_id': rid,
+                      '_retry_on_conflict': self.update_retries}
+            if routing:
+                action['_routing'] = routing
+            actions.append({'update': action})
+            actions.append(body)
+        # every update takes two lines of the bulk request
+        chunk_length = 2*self.bulk_max_actions
+        rejected_ids = list()
+        for i in xrange(0, len(actions), chunk_length):
+            res = self.client.bulk(body=actions[i:i+chunk_length], refresh=self.refresh,
+                                   timeout=self.insert_timeout)
+            if res['errors']:
+                for item in res['items']:
+                    if 'error' not in item['update']:
+                        continue
+                    if self._is_script_rejected(item['update']['error']):
+                        rejected_ids.append(item['update']['_id'])
+                    else:
+                        self.logger.error('unable to update %s document: %r', item['update']['_id'],
+                                          item['update']['error'])
+        if rejected_ids:
+            # records are updated one by one, indexing whole documents again
+            self._disable_script_updates()
+            return super(ElasticSearchDriver, self).update_field_multi(rejected_ids, field_label, field_value,
+                                                                       update_timestamp_label, increase_version)
+        return last_update
 
     def replace_record(self, record_id, new_record, update_timestamp_label=None):
         """
-        Replace record with *record_id* with the given *new_record*
+        Replace record with *record_id* with the given *new_record*, the record is indexed
+        again with the same ID so that the lookup table doesn't change
 
         :param record_id: the ID of the record that will be replaced with the new one
         :param new_record: the new record
@@ -1173,14 +2124,47 @@ class ElasticSearchDriver(DriverInterface):
         else:
             newid=record_id
         new_record['_id']=newid
-        self.delete_record(record_id)
-        self.add_record(new_record)
+        if self._is_patient_record(new_record):
+            self.collection_name=self.collection
+        else:
+            self._select_doc_type(new_record['ehr_structure_id'])
+        location = self._get_record_location(newid)
+        routing = self._get_routing(new_record)
+        if location and location[0]['_type'] == self.collection_name and location[1] == routing:
+            res = self.client.index(index=self.database,doc_type=self.collection_name,id=newid,
+                                    body=self._to_json(new_record),refresh=self.refresh,
+                                    routing=routing,timeout=self.insert_timeout)
+            self.logger.debug('replaced %s document', res[u'_id'])
+        else:
+            # the structure (or the routing key) of the record changed, the document is moved
+            self.delete_record(record_id)
+            self.add_record(new_record)
+        return last_update
+
+    def _update_list(self, record_id, list_label, add_items, remove_items, update_timestamp_label,
+                     increase_version):
+        body, last_update = self._get_update_body('update_list',
+                                                  {'field_label': list_label, 'add_items': add_items,
+                                                   'remove_items': remove_items},
+                                                  update_timestamp_label, increase_version)
+
+        def update_document(record):
+            record[list_label].extend(add_items)
+            for item in remove_items:
+                try:
+                    record[list_label].remove(item)
+                except ValueError:
+                    raise ValueError('Unable to update record %s, item not found in list' % record_id)
+        if not self._update_record_by_script(record_id, body, update_document, update_timestamp_label,
+                                             last_update, increase_version):
+            return None
         return last_update
 
     def add_to_list(self, record_id, list_label, item_value, update_timestamp_label=None,
                     increase_version=False):
         """
-        Append a value to a list within a document
+        Append a value to a list within a document, the value is appended by a script run
+        with the _update API
 
         :param record_id: record's ID
         :param list_label: the label of the field containing the list
@@ -1189,64 +2173,48 @@ class ElasticSearchDriver(DriverInterface):
         :param update_timestamp_label: the label of the *last_update* field of the record if the last update timestamp
           must be recorded or None
         :type update_timestamp_label: field label or None
+        :param increase_version: if True, increase record's version number by 1
+        :type increase_version: bool
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        record_to_update = self.get_record_by_id(record_id)
-        list_to_update = record_to_update[list_label]
-        list_to_update.append(item_value)
-        if update_timestamp_label:
-            last_update = time.time()
-            record_to_update['last_update'] = last_update
-        else:
-            last_update = None
-        if(not self._is_patient_record(record_to_update)):
-            self._select_doc_type(record_to_update['ehr_structure_id'])
-        res = self.client.index(index=self.database,doc_type=self.collection_name,body=record_to_update,
-                                id=record_id,timeout=self.insert_timeout)
-        self.logger.debug('updated %s document', res[u'_id'])
-        return last_update
+        return self._update_list(record_id, list_label, [item_value], [], update_timestamp_label,
+                                 increase_version)
 
     def extend_list(self, record_id, list_label, items, update_timestamp_label,
                     increase_version=False):
         """
         Add values provided with the *items* field to the list with label *list_label*
-        of the record with ID *record_id* and update the timestamp in field *update_timestamp_label*
+        of the record with ID *record_id* and update the timestamp in field *update_timestamp_label*,
+        all the values are appended with a single _update request
         """
-        return super(ElasticSearchDriver, self).extend_list(record_id, list_label, items,
-                                                            update_timestamp_label, increase_version)
+        return self._update_list(record_id, list_label, list(items), [], update_timestamp_label,
+                                 increase_version)
 
 #    @profile
     def remove_from_list(self, record_id, list_label, item_value, update_timestamp_label=None,
                          increase_version=False):
         """
-        Remove a value from a list within a document
+        Remove a value from a list within a document, the value is removed by a script run
+        with the _update API. Only the first occurrence of each item is removed, a ValueError
+        is raised if an item is not in the list
 
         :param record_id: record's ID
         :param list_label: the label of the field containing the list
         :type list_label: string
-        :param item_value: the item that will be removed from the list
+        :param item_value: the item that will be removed from the list, or a list of items
         :param update_timestamp_label: the label of the *last_update* field of the record if the last update timestamp
           must be recorded or None
         :type update_timestamp_label: field label or None
+        :param increase_version: if True, increase record's version number by 1
+        :type increase_version: bool
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        record_to_update = self.get_record_by_id(record_id)
-        list_to_update=record_to_update[list_label]
         if isinstance(item_value, list):
-            for i in item_value:
-                list_to_update.remove(i)
-        else:
-            list_to_update.remove(item_value)
-        if update_timestamp_label:
-            last_update = time.time()
-            record_to_update['last_update'] = last_update
+            remove_items = item_value
         else:
-            last_update = None
-        if(not self._is_patient_record(record_to_update)):
-            self._select_doc_type(record_to_update['ehr_structure_id'])
-        res = self.client.index(index=self.database,doc_type=self.collection_name,body=record_to_update,id=record_id,timeout=self.insert_timeout)
-        self.logger.debug('updated %s document', res[u'_id'])
-        return last_update
+            remove_items = [item_value]
+        return self._update_list(record_id, list_label, [], remove_items, update_timestamp_label,
+                                 increase_version)
 
     def _map_operand(self, left, right, operand):
         """
@@ -1254,7 +2222,7 @@ class ElasticSearchDriver(DriverInterface):
         :param left: left part of the expression
         :param right: right part of the expression
         :param operand: operand
-        :return: mapped expression in ES syntax
+        :return: mapped expression as a clauses dictionary, only filter and must_not clauses are used
         """
         def cast_right_operand(rigth_operand):
             if rigth_operand.isdigit():
@@ -1277,12 +2245,17 @@ class ElasticSearchDriver(DriverInterface):
         }
         right = cast_right_operand(right.strip())
         left = left.strip()
+        if operand in ('=', '!=') and isinstance(right, basestring) and len(right) > self.STRINGS_IGNORE_ABOVE:
+            self.logger.warning('Strings longer than %d characters are not indexed, the condition %s %s ... '
+                                'is evaluated as if no record had a value for the field',
+                                self.STRINGS_IGNORE_ABOVE, left, operand)
+        # exact matches on not analyzed fields, in filter context so that they can be cached
         if operand == '=':
-            return {"{\"match\" : "+str({left : right})+"}" : "$%nothing%$"}
-        elif operand == "!=":
-            return   { "  \"must_not\" : { \"match\" : "+str({left : right})+"}" : "$%nothing%$" }
+            return dsl.clauses('filter', dsl.term(left, right))
+        elif operand == '!=':
+            return dsl.clauses('must_not', dsl.term(left, right))
         elif operand in operands_map:
-            return { "{ \"range\" :  "+str({left: {operands_map[operand]: right}})+"}" : "$%nothing%$" }
+            return dsl.clauses('filter', dsl.range_query(left, operands_map[operand], right))
         else:
             raise ValueError('The operand %s is not supported' % operand)
 
@@ -1356,7 +2329,7 @@ class ElasticSearchDriver(DriverInterface):
         :param condition:
         :param variables_map:
         :param containment_mapping:
-        :return: dict with condition translated in ES syntax
+        :return: the clauses dictionary of the condition
         """
         query = dict()
         paths = self._build_paths(containment_mapping)
@@ -1378,29 +2351,15 @@ class ElasticSearchDriver(DriverInterface):
                     else:
                         and_indices.append(i+1)
         if len(or_indices) > 0:
-            for j in or_indices:
-                if(str(expressions[j]).find("must_not") != -1):
-                    exprstr=self._clean_piece(expressions[j])
-                    exprstr2="{ \"bool\":"+exprstr+"}"
-                    exprstr3=exprstr2.replace("\\'","'").replace("\"bool\":{'","\"bool\":{ {'").replace("}':","}}':")
-                    expressions[j]= { exprstr3 : "$%nothing%$"}
-            or_statement= " \"should\" : "+str([ expressions[i] for i in or_indices])+",\"minimum_should_match\" : 1"
-            expressions[max(expressions.keys()) + 1] = or_statement
+            should = [dsl.to_query(expressions[j]) for j in or_indices]
+            expressions[max(expressions.keys()) + 1] = {'should': should, 'minimum_should_match': 1}
             and_indices.append(max(expressions.keys()))
         if len(and_indices) > 0:
             for ai in and_indices:
-                if(isinstance(expressions[ai],str)):
-                    query.update({str(expressions[ai]) : "$%nothing%$" })
-                elif (str(expressions[ai]).find("must_not") == -1 ):
-                    query.update({ " \"must\" : "+str(expressions[ai]) : "$%nothing%$" })
-                else:
-                    query.update(expressions[ai])
+                dsl.merge_clauses(query, expressions[ai])
         else:
             for e in expressions.values():
-                if (str(e).find("must_not") == -1 ):
-                    query.update({" \"must\" : "+ str(e) : "$%nothing%$" })
-                else:
-                    query.update(e)
+                dsl.merge_clauses(query, e)
         return query
 
     def _compute_predicate(self, predicate):
@@ -1408,7 +2367,7 @@ class ElasticSearchDriver(DriverInterface):
         Compute a predicate (archetype or expression)
 
         :param predicate:
-        :return: dict with predicate translated in ES syntax
+        :return: the clauses dictionary of the predicate, predicates are always filters
         """
         query = dict()
         if type(predicate) == Predicate:
@@ -1422,13 +2381,12 @@ class ElasticSearchDriver(DriverInterface):
                 if op and ro:
                     self.logger.debug("lo: %s - op: %s - ro: %s", lo, op, ro)
                     if op == "=":
-                        query.update({"{ \"match\" : {"+ str({lo : ro})+"}}" : "$%nothing%$" })
-#                        query[lo] = ro
+                        dsl.merge_clauses(query, dsl.clauses('filter', dsl.term(lo, ro)))
             else:
                 raise PredicateException("No predicate expression found")
         elif type(predicate) == ArchetypePredicate:
             predicate_string = predicate.archetype_id
-            query.update({"{ \"filter\" : {\"exists\" : { \"field\" : "+ str(predicate_string)+"}}}" : "$%nothing%$"} )
+            dsl.merge_clauses(query, dsl.clauses('filter', dsl.exists(predicate_string)))
         else:
             raise PredicateException("No predicate expression found")
         return query
@@ -1442,7 +2400,8 @@ class ElasticSearchDriver(DriverInterface):
         :param query_params:
         :param patients_collection:
         :param ehr_collection:
-        :return:ehr expression in ES syntax
+        :return: the clauses dictionary of the ehr expression, only filters are used so that it
+                 can be merged with the condition of the query
         """
         # Resolve predicate expressed for EHR AQL expression
         query = dict()
@@ -1457,12 +2416,11 @@ class ElasticSearchDriver(DriverInterface):
                 else:
                     right_operand = pr.right_operand
                 if pr.left_operand == 'uid':
-                    query.update({ " \"must\" : { \"term\" : {\"patient_id\": \"" + str(right_operand).lower() +"\"}}" : "$%nothing%$"})
+                    dsl.merge_clauses(query, dsl.clauses('filter', dsl.term('patient_id', str(right_operand))))
                 elif pr.left_operand == 'id':
                     # use given EHR ID
-                    query.update(self._map_operand(pr.left_operand,
-                                                   right_operand,
-                                                   pr.operand))
+                    id_query = dsl.to_query(self._map_operand(pr.left_operand, right_operand, pr.operand))
+                    dsl.merge_clauses(query, dsl.clauses('filter', id_query))
                 else:
                     query.update(self._compute_predicate(pr))
             else:
@@ -1480,7 +2438,7 @@ class ElasticSearchDriver(DriverInterface):
         :param patients_collection:
         :param ehr_collection:
         :param aliases_mapping:
-        :return: location expression translated in ES syntax
+        :return: the clauses dictionary of the location expression
         """
         query = dict()
         if location.class_expression:
@@ -1550,32 +2508,114 @@ class ElasticSearchDriver(DriverInterface):
                 yield key, value
 
 
-    def get_records_by_query(self, query, fields=None, limit=0):
+    def get_records_by_query(self, query, fields=None, limit=0, routing=None):
         """
-        Choose which routine to get records by query
+        Choose which routine to get records by query, records are streamed so the connection
+        must be kept open until the returned generator is consumed
 
         :param query:
         :param fields:
         :param limit:
-        :return:
+        :param routing: if not None, only the shard selected by this routing key is searched
+        :return: a generator of records
         """
         if self.grbq == "from":
-            res=self.get_records_by_query_from(query,fields,limit)
+            res=self.get_records_by_query_from(query,fields,limit,routing)
         elif self.grbq == "scan":
-            res=self.get_records_by_query_scan(query,fields,limit)
+            res=self.get_records_by_query_scan(query,fields,limit,routing)
         else:
             print "\nbad grbq:"+self.grbq+" using scan instead"
-            res=self.get_records_by_query_scan(query,fields,limit)
+            res=self.get_records_by_query_scan(query,fields,limit,routing)
         return res
 
     def get_values_by_record_id(self, record_id, values_list):
-        res = self.client.get_source(index=self.database, id=record_id, _source_include=values_list)
+        routing = None
+        if self.patient_routing:
+            location = self._get_record_location(record_id)
+            routing = location[1] if location else None
+        res = self.client.get_source(index=self.database, id=record_id, routing=routing,
+                                     _source_include=values_list)
         return decode_dict(res)
 
-    def get_records_by_query_scan(self, query,fields=None,limit=0):
+    def _search(self, **kwargs):
+        """
+        Run a search request bound to the query control of the driver, if any: the time left
+        before the query's deadline is passed to Elasticsearch as the search timeout and a
+        :class:`QueryTimeoutError` is raised if the search timed out
+        """
+        timeout = self._get_remaining_time_ms()
+        if timeout is not None:
+            kwargs['timeout'] = '%dms' % timeout
+        resu = self.client.search(**kwargs)
+        if resu.get('timed_out'):
+            raise QueryTimeoutError('Query exceeded its deadline')
+        return resu
+
+    def _msearch(self, bodies, routings=None, **body_params):
+        """
+        Run the given search bodies on the current database with a single multi search request,
+        bound to the query control of the driver like :meth:`_search`. *body_params* are added to
+        every search body (i.e. size).
+
+        :param bodies: a list of search bodies, as JSON strings or dictionaries
+        :param routings: the routing keys of the searches, in the same order of the bodies (None
+                         items search all the shards), or None
+        :return: the list of the responses, in the same order of the bodies
+        """
+        self._check_query_control()
+        timeout = self._get_remaining_time_ms()
+        request = list()
+        for body, routing in izip(bodies, routings or [None]*len(bodies)):
+            body = json.loads(body) if isinstance(body, basestring) else dict(body)
+            body.update(body_params)
+            if timeout is not None:
+                body['timeout'] = '%dms' % timeout
+            header = {'index': self.database}
+            if routing:
+                header['routing'] = routing
+            request.extend([header, body])
+        responses = self.client.msearch(body=request)['responses']
+        for resu in responses:
+            if 'error' in resu:
+                raise elasticsearch.TransportError(resu.get('status', 500), resu['error'])
+            if resu.get('timed_out'):
+                raise QueryTimeoutError('Query exceeded its deadline')
+        return responses
+
+    def _scroll(self, **kwargs):
+        self._check_query_control()
+        return self.client.scroll(**kwargs)
+
+    def _clear_scroll(self, scroll_id):
+        # release the search context on the server instead of waiting for the scroll timeout
+        if not self.client:
+            return
+        try:
+            self.client.clear_scroll(scroll_id=scroll_id)
+        except elasticsearch.TransportError, te:
+            self.logger.debug('Unable to clear scroll %s: %s', scroll_id, te)
+
+    def _get_page_body(self, query, last_key):
+        """
+        Return the search body that selects the records following *last_key* in _uid order.
+        Search after is not available in ES 1.x/2.x, so a range filter on the _uid is used.
+
+        :param query: the query, as a JSON string or a dictionary
+        :param last_key: the _uid of the last record of the previous page, None for the first page
+        :return: the search body sorted by _uid
+        """
+        body = json.loads(query) if isinstance(query, basestring) else dict(query)
+        if last_key is not None:
+            body['query'] = {'filtered': {'query': body['query'],
+                                          'filter': {'range': {'_uid': {'gt': last_key}}}}}
+        body['sort'] = [{'_uid': {'order': 'asc'}}]
+        return body
+
+    def get_records_by_query_scan(self, query,fields=None,limit=0,routing=None):
         """
         Retrieve all records matching the given query
-        Approach 1: using scroll for number of records greater than threshold
+        Approach 1: using scroll, records are yielded page by page and the scroll is cleared
+        when the iteration ends (or the generator is closed)
 
         :param limit: the max number of total results to be returned
         :type limit: integer
@@ -1583,56 +2623,35 @@ class ElasticSearchDriver(DriverInterface):
         :type  fields: string
         :param query: the value that must be matched for the given field
         :type query: string
-        :return: a list of records
-        :rtype: list
-        """
-        size = self.threshold
-        if limit:
-            if limit<size:
-                size=limit
-
-#        query["size"]=self.threshold
-        scrolltime=self.scrolltime
-        restot = []
-        pippo=False
-        sc_id=""
-        while not pippo:
-            if restot==[]:
-                if fields:
-                    resu = self.client.search(index=self.database,_source_include=fields,size=size,body=query,scroll=scrolltime)
-                else:
-                    resu = self.client.search(index=self.database,size=size,body=query,scroll=scrolltime)
-                if resu['hits']['hits']==[]:
-                    pippo=True
-                else:
-                    sc_id=resu["_scroll_id"]
-                    number_of_results=resu['hits']['total']
-                    restot.extend(resu['hits']['hits'])
-                    if len(resu['hits']['hits']) < size:
-                        pippo=True
-            else:
-                resuh=self.client.scroll(scroll_id=sc_id, scroll=scrolltime)['hits']
-                if resuh['hits']==[]:
-                    pippo=True
-                else:
-                    if limit and len(resuh['hits'])+len(restot) >= limit:
-                        missing=limit-len(restot)
-                        for i in range(0,missing):
-                            restot.append(resuh['hits'][i])
-                        pippo=True
-                    else:
-                        restot.extend(resuh['hits'])
-                        if len(resuh['hits']) < size:
-                            pippo=True
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
-
-    def get_records_by_query_from(self, query,fields=None,limit=0):
+        :param routing: if not None, only the shard selected by this routing key is searched
+        :return: a generator of records
+        """
+        size = min(limit, self.threshold) if limit else self.threshold
+        search_args = {'_source_include': fields} if fields else {}
+        resu = self._search(index=self.database, size=size, body=query, scroll=self.scrolltime,
+                            routing=routing, **search_args)
+        scroll_id = resu.get('_scroll_id')
+        returned = 0
+        try:
+            while resu['hits']['hits']:
+                for hit in resu['hits']['hits']:
+                    yield decode_dict(hit['_source'])
+                    returned += 1
+                    if limit and returned >= limit:
+                        return
+                if len(resu['hits']['hits']) < size:
+                    return
+                resu = self._scroll(scroll_id=scroll_id, scroll=self.scrolltime)
+                scroll_id = resu.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                self._clear_scroll(scroll_id)
+
+    def get_records_by_query_from(self, query,fields=None,limit=0,routing=None):
         """
         Retrieve all records matching the given query
-        Approach 2: using from for number of records greater than threshold
+        Approach 2: using pages sorted by _uid, each page starts after the last _uid of the previous one
+        (no deep paging and no search context kept on the server)
 
         :param limit: the max number of total results to be returned
         :type limit: integer
@@ -1640,59 +2659,47 @@ class ElasticSearchDriver(DriverInterface):
         :type  fields: string
         :param query: the value that must be matched for the given field
         :type query: string
-        :return: a list of records
-        :rtype: list
-        """
-        size = self.threshold
-        if limit:
-            if limit<size:
-                size=limit
-        restot = []
-        if fields:
-            resu = self.client.search(index=self.database,_source_include=fields,size=size,body=query)['hits']
-        else:
-            resu = self.client.search(index=self.database,size=size,body=query)['hits']
-        number_of_results=resu['total']
-        restot.extend(resu['hits'])
-        if limit:
-            nmin=min(number_of_results,limit)
-            if nmin>size:
-                for i in range(1, (nmin-1)/size+1):
-                    if fields:
-                        resu = self.client.search(index=self.database,_source_include=fields,size=size,from_=i*size,body=query)['hits']
-                    else:
-                        resu = self.client.search(index=self.database,size=size,from_=i*size,body=query)['hits']
-                    if len(restot)+len(resu['hits'])>=limit:
-                        missing=limit-len(restot)
-                        for i in range(0,missing):
-                            restot.append(resu['hits'][i])
-                    else:
-                        restot.extend(resu['hits'])
-        else:
-            if number_of_results > size:
-                for i in range(1, (number_of_results-1)/size+1):
-                    if fields:
-                        resu = self.client.search(index=self.database,_source_include=fields,size=size,from_=i*size,body=query)['hits']
-                    else:
-                        resu = self.client.search(index=self.database,size=size,from_=i*size,body=query)['hits']
-                    restot.extend(resu['hits'])
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
-
-    def count_records_by_query(self, query):
+        :param routing: if not None, only the shard selected by this routing key is searched
+        :return: a generator of records
+        """
+        size = min(limit, self.threshold) if limit else self.threshold
+        search_args = {'_source_include': fields} if fields else {}
+        returned = 0
+        last_key = None
+        while True:
+            hits = self._search(index=self.database, size=size, body=self._get_page_body(query, last_key),
+                                routing=routing, **search_args)['hits']['hits']
+            for hit in hits:
+                yield decode_dict(hit['_source'])
+                returned += 1
+                if limit and returned >= limit:
+                    return
+            if len(hits) < size:
+                return
+            last_key = hits[-1]['sort'][0]
+
+    def count_records_by_query(self, query, routing=None):
         """
         Retrieve the count of all records matching the given query
         :param query: the value that must be matched for the given field
         :type query: string
+        :param routing: if not None, only the shard selected by this routing key is searched
         :return: the count of all matching records
         :rtype: integer
         """
-        return self.client.search(index=self.database,body=query,search_type='count')['hits']['total']
+        return self._search(index=self.database,body=query,search_type='count',routing=routing)['hits']['total']
 
 #    @profile
-    def _run_aql_query(self, query, fields, aliases, collection):
+    def _run_sub_query(self, query_description, collection):
+        """
+        Run a sub-query described by a dictionary with *condition*, *selection*, *aliases* and
+        *routing* fields, as returned by :meth:`build_sub_queries`
+        """
+        return self._run_aql_query(query_description['condition'], query_description['selection'],
+                                   query_description['aliases'], collection,
+                                   query_description.get('routing'))
+
+    def _run_aql_query(self, query, fields, aliases, collection, routing=None):
         """
         Run the AQL query
 
@@ -1700,13 +2707,56 @@ class ElasticSearchDriver(DriverInterface):
         :param fields:
         :param aliases:
         :param collection:
+        :param routing: if not None, only the shard selected by this routing key is searched
         :return: records matching the query given
         """
         self.logger.debug("Running query\n%s\nwith filters\n%s", query, fields)
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(collection)
+        selected_fields=self._collate_selected_fields(fields)
+        try:
+            return self._get_result_set(aliases, self.get_records_by_query(query,selected_fields,
+                                                                           routing=routing))
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+
+    def _get_result_set(self, aliases, records):
+        """
+        Build a ResultSet with the given aliases as columns and the given records as rows
+
+        :param aliases:
+        :param records: decoded records
+        :return: a ResultSet
+        """
         rs = ResultSet()
         for path, alias in aliases.iteritems():
             col = ResultColumnDef(alias, path)
             rs.add_column_definition(col)
+        for q in records:
+            record = dict()
+            for x in self._split_results(q):
+                record[x[0]] = x[1]
+            rs.add_row(ResultRow(record))
+        return rs
+
+    def _run_aql_queries(self, queries, collection):
+        """
+        Run a list of AQL sub-queries using multi search requests, sub-queries whose results
+        don't fit in a single page are then completed using :meth:`_run_aql_query`
+
+        :param queries: a list of queries with condition, selection and aliases
+        :param collection:
+        :return: a ResultSet with the records matching the given queries
+        """
+        total_results = ResultSet()
         if self.is_connected:
             original_collection = self.collection
             close_conn_after_done = False
@@ -1714,21 +2764,30 @@ class ElasticSearchDriver(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(collection)
-        selected_fields=self._collate_selected_fields(fields)
-#        query_results = self.get_records_by_query(query)
-        query_results = self.get_records_by_query(query,selected_fields)
-        if close_conn_after_done:
-            self.disconnect()
-        else:
-            self.select_collection(original_collection)
-        if query_results:
-            for q in query_results:
-                record = dict()
-                for x in self._split_results(q):
-                    record[x[0]] = x[1]
-                rr = ResultRow(record)
-                rs.add_row(rr)
-        return rs
+        try:
+            for i in xrange(0, len(queries), self.msearch_size):
+                chunk = queries[i:i+self.msearch_size]
+                bodies = list()
+                for q in chunk:
+                    body = json.loads(q['condition'])
+                    selected_fields = [f for f, v in q['selection'].iteritems() if v == True]
+                    if selected_fields:
+                        body['_source'] = selected_fields
+                    bodies.append(body)
+                routings = [q.get('routing') for q in chunk]
+                for q, resu in izip(chunk, self._msearch(bodies, routings, size=self.threshold)):
+                    if resu['hits']['total'] > len(resu['hits']['hits']):
+                        results = self._run_sub_query(q, collection)
+                    else:
+                        results = self._get_result_set(q['aliases'], (decode_dict(h['_source'])
+                                                                      for h in resu['hits']['hits']))
+                    total_results.extend(results)
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+        return total_results
 
     def _run_aql_count(self, query, collection):
         """
@@ -1766,9 +2825,14 @@ class ElasticSearchDriver(DriverInterface):
                 lfields.append(sf)
         return ",".join(lfields)
 
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      contains_mapping=None):
         return super(ElasticSearchDriver, self).build_queries(query_model, patients_repository, ehr_repository,
-                                                      query_params)
+                                                      query_params, contains_mapping)
+
+    def _add_location_query(self, condition, location_query):
+        # both condition and location expression can use filter clauses, they must be merged
+        dsl.merge_clauses(condition, location_query)
 
     def _get_query_hash(self, query):
         return super(ElasticSearchDriver, self)._get_query_hash(query)
@@ -1784,39 +2848,237 @@ class ElasticSearchDriver(DriverInterface):
         Return the structure selector in ES syntax
 
         :param structure_ids:
-        :return:dict with structures selector
+        :return: a term (or terms) query on the structure ID
         """
         if len(structure_ids) == 1:
-            return {"\"must\" : {\"term\" : {\"ehr_structure_id\" : \""+str(structure_ids[0])+"\"} }": "$%nothing%$"}
+            return dsl.term('ehr_structure_id', structure_ids[0])
         else:
-            return {"\"must\" : {\"terms\" : {\"ehr_structure_id\" : "+str([structure_ids])+",\"execution\" : \"or\" } }" : "$%nothing%$"}
+            return dsl.terms('ehr_structure_id', structure_ids)
 
     def _aggregate_queries(self, queries):
         """
         Try to simplify queries by aggregation
 
         :param queries:
-        :return:aggregated queries
+        :return: aggregated queries, their conditions are search bodies filtered by structure ID
         """
         aggregated_queries = list()
         queries_hash_map = self._get_queries_hash_map(queries)
         structures_hash_map = self._get_structures_hash_map(queries)
         for qhash, structures in structures_hash_map.iteritems():
-            ql=[]
             query = queries_hash_map[qhash]
-            q1=self._clean_piece(query['condition'])
-            ql.append(" \"query\" : { \"bool\" : "+str(q1)+"}")
-            q2=self._clean_piece(self._get_structures_selector(structures))
-            ql.append(" \"filter\" : { \"bool\" : "+str(q2)+"}")
-            qs=",".join(ql)
-            qtot=" \"query\" : { \"filtered\" : {"+qs + "}}"
-            qtot={ qtot : "$%nothing%$"}
-            query['condition']=qtot
+            # build new clauses, lists of the location expression are shared among queries
+            condition = dsl.merge_clauses(dict(), query['condition'])
+            dsl.merge_clauses(condition, dsl.clauses('filter', self._get_structures_selector(structures)))
+            query['routing'] = self._get_condition_routing(condition)
+            query['condition'] = dsl.search_body(dsl.to_query(condition))
             aggregated_queries.append(query)
         return aggregated_queries
 
+    def _get_condition_routing(self, condition):
+        """
+        Return the routing key for a condition that selects the records of a single patient,
+        if clinical records are routed by patient ID
+
+        :param condition: a clauses dictionary
+        :return: the patient ID or None if all the shards must be searched
+        """
+        if not self.patient_routing:
+            return None
+        for query in condition.get('filter', []):
+            if 'patient_id' in query.get('term', {}):
+                return query['term']['patient_id']
+        return None
+
+    def build_sub_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                          contains_mapping=None):
+        """
+        Build the aggregated queries and serialize their conditions as ES search bodies
+
+        :param query_model:
+        :param patients_repository:
+        :param ehr_repository:
+        :param query_params:
+        :param contains_mapping: the result of IndexService.map_aql_contains for query's CONTAINS
+                                 statement, if None it will be retrieved from the IndexService
+        :return: a list of queries with condition, selection, aliases and routing (the routing
+                 key of the query or None)
+        """
+        queries = self.build_queries(query_model, patients_repository, ehr_repository,
+                                     query_params, contains_mapping)
+        aggregated_queries = self._aggregate_queries(queries)
+        return [{'condition': json.dumps(query['condition']), 'selection': query['selection'],
+                 'aliases': query['aliases'], 'routing': query['routing']} for query in aggregated_queries]
+
+    def _run_sub_query_page(self, query_description, collection, page_size, last_key):
+        return self._run_aql_query_page(query_description['condition'], query_description['selection'],
+                                        query_description['aliases'], collection, page_size, last_key,
+                                        query_description.get('routing'))
+
+    def _run_aql_query_page(self, query, fields, aliases, collection, page_size, last_key, routing=None):
+        """
+        Run the AQL query and return a page of results sorted by _uid. Search after is not
+        available in ES 1.x/2.x, so the page is selected using a range filter on the _uid
+        of the last record of the previous page
+
+        :param query:
+        :param fields:
+        :param aliases:
+        :param collection:
+        :param page_size:
+        :param last_key: the _uid of the last record of the previous page
+        :param routing: if not None, only the shard selected by this routing key is searched
+        :return: records matching the query given and the _uid of the last one
+        """
+        self.logger.debug("Running query page\n%s\nwith filters\n%s\nstarting after %s", query, fields, last_key)
+        rs = ResultSet()
+        for path, alias in aliases.iteritems():
+            col = ResultColumnDef(alias, path)
+            rs.add_column_definition(col)
+        body = self._get_page_body(query, last_key)
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(collection)
+        selected_fields=self._collate_selected_fields(fields)
+        if selected_fields:
+            hits = self._search(index=self.database, _source_include=selected_fields,
+                                size=page_size, body=body, routing=routing)['hits']['hits']
+        else:
+            hits = self._search(index=self.database, size=page_size, body=body, routing=routing)['hits']['hits']
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        for h in hits:
+            record = dict()
+            for x in self._split_results(decode_dict(h['_source'])):
+                record[x[0]] = x[1]
+            rs.add_row(ResultRow(record))
+        if len(hits) < page_size:
+            return rs, None
+        return rs, hits[-1]['sort'][0]
+
+    def execute_keys_query(self, query_model, patients_repository, ehr_repository, key,
+                           query_params=None, restrict_to=None):
+        """
+        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and return the distinct
+        values of the given *key* for the records matching the query. Only the key field is fetched;
+        if *restrict_to* is given, it is pushed into the query as a terms (or ids) filter.
+
+        :param query_model:
+        :param patients_repository:
+        :param ehr_repository:
+        :param key: the EHR path used as key, ehr_id.value or uid.value
+        :param query_params:
+        :param restrict_to: if not None, only keys contained in this collection will be returned
+        :return: a set with the matching keys
+        """
+        key_field = self._get_key_field(key)
+        if restrict_to is not None and len(restrict_to) == 0:
+            return set()
+        if restrict_to is not None:
+            if key_field == '_id':
+                keys_filter = {'ids': {'values': list(restrict_to)}}
+            else:
+                keys_filter = {'terms': {key_field: list(restrict_to)}}
+        bodies = list()
+        routings = list()
+        for sq in self.build_sub_queries(query_model, patients_repository, ehr_repository, query_params):
+            body = json.loads(sq['condition'])
+            if restrict_to is not None:
+                body['query'] = {'filtered': {'query': body['query'], 'filter': keys_filter}}
+            bodies.append(body)
+            routings.append(sq['routing'])
+        return self._get_keys_by_queries(bodies, key_field, ehr_repository, routings)
+
+    def _get_keys_by_queries(self, bodies, key_field, ehr_repository, routings=None):
+        """
+        Scroll the records matching the given queries and collect the values of the key field
+
+        :param bodies: a list of queries in ES syntax
+        :param key_field:
+        :param ehr_repository:
+        :param routings: the routing keys of the queries, in the same order of the bodies, or None
+        :return: a set with the keys
+        """
+        keys = set()
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        for body, routing in izip(bodies, routings or [None]*len(bodies)):
+            if key_field == '_id':
+                resu = self._search(index=self.database, _source=False, size=self.threshold,
+                                    body=body, scroll=self.scrolltime, routing=routing)
+            else:
+                resu = self._search(index=self.database, _source_include=key_field,
+                                    size=self.threshold, body=body, scroll=self.scrolltime, routing=routing)
+            scroll_id = resu.get('_scroll_id')
+            try:
+                while resu['hits']['hits']:
+                    for h in resu['hits']['hits']:
+                        keys.add(h['_id'] if key_field == '_id' else decode_dict(h['_source'])[key_field])
+                    if len(resu['hits']['hits']) < self.threshold:
+                        break
+                    resu = self._scroll(scroll_id=scroll_id, scroll=self.scrolltime)
+                    scroll_id = resu.get('_scroll_id', scroll_id)
+            finally:
+                if scroll_id:
+                    self._clear_scroll(scroll_id)
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        return keys
+
+    def execute_structures_keys_query(self, structure_ids, ehr_repository, key):
+        """
+        Return the distinct values of the given *key* for the clinical records with one of the
+        given structures, only the key field is fetched
+
+        :param structure_ids: a list of structure IDs
+        :param ehr_repository:
+        :param key: the EHR path used as key, ehr_id.value or uid.value
+        :return: a set with the matching keys
+        """
+        key_field = self._get_key_field(key)
+        if not structure_ids:
+            return set()
+        body = {'query': {'terms': {'ehr_structure_id': list(structure_ids)}}}
+        return self._get_keys_by_queries([body], key_field, ehr_repository)
+
+    def execute_query_page(self, query_model, patients_repository, ehr_repository, page_size,
+                           query_params=None, page_token=None):
+        """
+        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and return a single page
+        of results. The *next_page_token* of the returned ResultSet can be used to retrieve the following
+        page and it is None when there are no more results.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param page_size: the maximum number of results in the page
+        :type page_size: int
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param page_token: the token returned with the previous page or None for the first page
+        :type page_token: str
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
+                 containing a page of results for the given query
+        """
+        total_queries = self.build_sub_queries(query_model, patients_repository, ehr_repository,
+                                               query_params)
+        return self._find_page_by_aql_queries(total_queries, ehr_repository, page_size, page_token)
+
     def execute_query(self, query_model, patients_repository, ehr_repository,
-                      query_params=None, count_only=False, query_processes=1):
+                      query_params=None, count_only=False, query_processes=1, workers_pool=None):
         """
         Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
         as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
@@ -1827,244 +3089,81 @@ class ElasticSearchDriver(DriverInterface):
         :type: :class:`pyehr.aql.parser.QueryModel`
         :param query_params: a dictionary containing query's parameters and their values
         :type: dictionary
+        :param workers_pool: a running :class:`pyehr.ehr.services.dbmanager.querymanager.workers_pool.QueryWorkersPool`
+                             that will be used to run the sub-queries, if None query_processes will be used
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
                  containing results for the given query
         """
-        queries = self.build_queries(query_model, patients_repository, ehr_repository,
-                                     query_params)
-        aggregated_queries = self._aggregate_queries(queries)
-        total_queries=[]
-        for query in aggregated_queries:
-            single_query={}
-            query_string=self._clean_piece(query['condition'])
-            query_string=self._final_check(query_string)
-            single_query.update({'condition':query_string})
-            single_query.update({'selection':query['selection']})
-            single_query.update({'aliases':query['aliases']})
-            total_queries.append(single_query)
+        total_queries = self.build_sub_queries(query_model, patients_repository, ehr_repository,
+                                               query_params)
         if count_only:
             return self._count_only_queries(total_queries,ehr_repository)
         else:
-            return self._regular_queries(total_queries,ehr_repository,query_processes)
+            return self._regular_queries(total_queries,ehr_repository,query_processes,workers_pool)
 
-    def _regular_queries(self,total_queries,ehr_repository,query_processes):
+    def _regular_queries(self,total_queries,ehr_repository,query_processes,workers_pool=None):
         """
         Call the routines to perform a single processor or multiprocessor query
 
         :param total_queries:
         :param ehr_repository:
         :param query_processes:
+        :param workers_pool: a running QueryWorkersPool, if given it is used instead of query_processes
         :return:
         """
-        total_results = ResultSet()
+        if workers_pool and workers_pool.is_running and len(total_queries) > 1:
+            return workers_pool.run_queries(total_queries, ehr_repository, self.query_control)
         if query_processes == 1 or len(total_queries) == 1:
-            for i in range(0,len(total_queries)):
-                results = self._run_aql_query(total_queries[i]['condition'], fields=total_queries[i]['selection'],
-                                          aliases=total_queries[i]['aliases'], collection=ehr_repository)
-                total_results.extend(results)
+            return self._run_aql_queries(total_queries, ehr_repository)
         else:
+            total_results = ResultSet()
+            deadline = self.query_control.deadline if self.query_control else None
             queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered( MultiprocessQueryRunner(self.host, self.database,
-                                                    ehr_repository, self.port, self.user,self.passwd),total_queries)
-            for r in results:
-                total_results.extend(r)
+            try:
+                results = queries_pool.imap_unordered( MultiprocessQueryRunner(self.host, self.database,
+                                                        ehr_repository, self.port, self.user,self.passwd,
+                                                        deadline),total_queries)
+                for r in results:
+                    self._check_query_control()
+                    total_results.extend(r)
+            except:
+                # the query timed out or was cancelled, don't wait for the other sub-queries
+                queries_pool.terminate()
+                raise
+            else:
+                queries_pool.close()
+            finally:
+                queries_pool.join()
         return total_results
 
     def _count_only_queries(self,total_queries,ehr_repository):
         """
-        Call the routine to perform a count query
+        Count the records matching the sub-queries, using multi search requests
 
         :param total_queries:
         :param ehr_repository:
         :return:
         """
         count=0
-        for i in range(0,len(total_queries)):
-            cresult = self._run_aql_count(total_queries[i]['condition'], collection=ehr_repository)
-            count=count+cresult
-        return count
-#    @profile
-    def _final_check(self,qtot):
-        """
-        Final check on parentheses
-
-        :param qtot:
-        :return:
-        """
-        ql=list(qtot)
-        ob=0
-        oq=0
-        for i in ql:
-            if i=="{":
-                ob=ob+1
-            elif i=="}":
-                ob=ob-1
-            elif i=="[":
-                oq=oq+1
-            elif i=="]":
-                oq=oq-1
-        if ob != 0:
-            if ob>0:
-                for i in range(ob):
-                    ql.append("}")
-            else:
-                for i in range(ob):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("}"))
-        if oq !=0:
-            if oq>0:
-                for i in range(oq):
-                    ql.append("]")
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        try:
+            for i in xrange(0, len(total_queries), self.msearch_size):
+                chunk = total_queries[i:i+self.msearch_size]
+                responses = self._msearch([q['condition'] for q in chunk], [q.get('routing') for q in chunk],
+                                          size=0)
+                count += sum(resu['hits']['total'] for resu in responses)
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
             else:
-                for i in range(oq):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("]"))
-        qtot="".join(ql)
-        return qtot
-
-    def _clean_piece(self,piece):
-        """
-        clean a piece of expression from artifacts used to build it
-
-        :param piece:
-        :return:
-        """
-        def cleanp(p):
-            newp = str(p)
-            newpr=newp[::-1]
-            #clean p from nothing
-            posnothing=[]
-            poscolon=[]
-            posparleft=[]
-            posparright=[]
-            starts=0
-            ends = len(newp)
-            while starts < ends:
-                #find position of string nothing
-                positionn = newp.find("$%nothing%$",starts,ends)
-                if (positionn == -1):
-                    starts=ends
-                else:
-                    starts=positionn+1
-                    posnothing.append(positionn)
-                    #find position of left colon
-                    positionc=newpr.find(":",len(newpr)-positionn,len(newpr))
-                    if( positionc == -1):
-                        print "not found colon for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        positionc=len(newpr)-positionc-1
-                        poscolon.append(positionc)
-                    #find position of first right parenthesis
-                    position=newp.find("}",positionn+10,len(newp))
-                    position2=newp.find("]",positionn+10,len(newp))
-                    isbrace=True
-                    if( position==-1 and position2==-1):
-                        print "not found parenthesis for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        if(position2 != -1):
-                            if(position == -1):
-                                posparright.append(position2)
-                                isbrace=False
-                            if(position < position2):
-                                posparright.append(position)
-                            else:
-                                posparright.append(position2)
-                                isbrace=False
-                        else:
-                            posparright.append(position)
-                    #find position of corresponding left parenthesis
-                    br=0
-                    sq=0
-                    for g,h in enumerate(newpr[(len(newpr)-positionc):len(newpr)]):
-                        if h == "{":
-                            if isbrace and br==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                br=br-1
-                        elif h == "[":
-                            if not isbrace and sq==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                sq=sq-1
-                        elif h== "}":
-                            br=br+1
-                        elif h=="]":
-                            sq=sq+1
-            newpl = list(newp)
-            for i in posparleft:
-                newpl[i]=""
-                newpl[i+1]=""
-            for i in range(len(poscolon)):
-                for j in range(poscolon[i]-1,posparright[i]+1):
-                    newpl[j]=""
-            #clean p from extra braces
-            #clean p from extra squares
-            br=0
-            sq=0
-            istart=[]
-            iend=[]
-            cursor=-1
-            for i in range(len(newpl)-1):
-                if newpl[i]==newpl[i+1]:
-                    if(newpl[i]=="{"):
-                        br=2
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="}"):
-                        if(br==2):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            br=0
-                            if(cursor>-1):
-                                istart.pop()
-                    elif(newpl[i]=="["):
-                        sq=1
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="]"):
-                        if(sq==1):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            sq=0
-                            if(cursor>-1):
-                                istart.pop()
-                elif newpl[i]=="{":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        br=0
-                elif newpl[i]== "[":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        sq=0
-            for i in range(len(istart)):
-                newpl[istart[i]]=""
-                newpl[iend[i]]=""
-            #change all single quotation marks to double
-            for i in range(len(newpl)-1):
-                if newpl[i]=="\\" and newpl[i+1]=="'":
-                    newpl[i]=""
-                    newpl[i+1]='"'
-                elif newpl[i]=="\\" and newpl[i+1]=="\"":
-                    newpl[i]=""
-                elif newpl[i] == "'":
-                    newpl[i]='"'
-                elif newpl[i+1]=="'":
-                    newpl[i+1]='"'
-            newpn = "".join(newpl)
-            return newpn
-        newpiece="{"
-        for p in piece:
-            newpiece=newpiece+cleanp(p)+","
-        newpiece=newpiece.strip(",")+"}"
-        return newpiece
+                self.select_collection(original_collection)
+        return count
 
     def get_selection_hash(self,selection):
         """
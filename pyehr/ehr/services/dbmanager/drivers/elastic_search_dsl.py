@@ -0,0 +1,102 @@
+# Helpers used to build Elasticsearch queries as Query DSL dictionaries. Conditions are handled as
+# clauses dictionaries, mapping the occurrence types of a bool query (must, must_not, should and filter)
+# to lists of queries, that can be merged and finally turned into a query with to_query
+
+RANGE_OPERATORS = ('gt', 'gte', 'lt', 'lte')
+OCCURRENCE_TYPES = ('must', 'must_not', 'should', 'filter')
+
+
+def match(field, value):
+    return {'match': {field: value}}
+
+
+def term(field, value):
+    return {'term': {field: value}}
+
+
+def terms(field, values):
+    return {'terms': {field: list(values)}}
+
+
+def ids(values):
+    return {'ids': {'values': list(values)}}
+
+
+def prefix(field, value):
+    return {'prefix': {field: value}}
+
+
+def range_query(field, operator, value):
+    if operator not in RANGE_OPERATORS:
+        raise ValueError('The range operator %s is not supported' % operator)
+    return {'range': {field: {operator: value}}}
+
+
+def exists(field):
+    return {'exists': {'field': field}}
+
+
+def match_all():
+    return {'match_all': {}}
+
+
+def clauses(occurrence, *queries):
+    """
+    Return a clauses dictionary containing the given queries with the given occurrence type
+    """
+    if occurrence not in OCCURRENCE_TYPES:
+        raise ValueError('The occurrence type %s is not supported' % occurrence)
+    return {occurrence: list(queries)}
+
+
+def merge_clauses(target, source):
+    """
+    Add the clauses of *source* to the *target* clauses dictionary, queries that are already
+    in *target* are not added twice
+
+    :return: the *target* dictionary
+    """
+    for key, value in source.iteritems():
+        if key in OCCURRENCE_TYPES:
+            target_queries = target.setdefault(key, list())
+            target_queries.extend(q for q in value if q not in target_queries)
+        else:
+            target[key] = value
+    return target
+
+
+def bool_query(must=None, must_not=None, should=None, filter=None, minimum_should_match=None):
+    bool_clauses = dict()
+    for key, value in (('must', must), ('must_not', must_not), ('should', should), ('filter', filter)):
+        if value:
+            bool_clauses[key] = list(value)
+    if minimum_should_match is not None:
+        bool_clauses['minimum_should_match'] = minimum_should_match
+    return {'bool': bool_clauses}
+
+
+def to_query(query_clauses):
+    """
+    Turn a clauses dictionary into a query, a bool query is only used when needed
+
+    :param query_clauses: a clauses dictionary
+    :type query_clauses: dict
+    :return: a query in Elasticsearch Query DSL
+    :rtype: dict
+    """
+    if not query_clauses:
+        return match_all()
+    if len(query_clauses) == 1 and query_clauses.keys()[0] in ('must', 'filter') and \
+            len(query_clauses.values()[0]) == 1:
+        return query_clauses.values()[0][0]
+    return bool_query(**query_clauses)
+
+
+def search_body(query, **kwargs):
+    """
+    Return the body of a search request for the given query, *kwargs* are added to the body
+    (i.e. sort or _source)
+    """
+    body = {'query': query}
+    body.update(kwargs)
+    return body
\ No newline at end of file
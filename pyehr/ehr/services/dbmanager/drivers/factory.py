@@ -6,7 +6,7 @@ class DriversFactory(object):
 
     def __init__(self, driver, host, database, repository=None,
                  port=None, user=None, passwd=None, index_service=None,
-                 logger=None):
+                 logger=None, driver_options=None):
         self.driver = driver
         self.host = host
         self.database = database
@@ -16,6 +16,8 @@ class DriversFactory(object):
         self.passwd = passwd
         self.index_service = index_service
         self.logger = logger or get_logger('drivers-factory')
+        # driver specific options, passed as keyword arguments to driver's constructor
+        self.driver_options = driver_options or {}
 
     def get_driver(self):
         if self.driver == 'mongodb':
@@ -24,17 +26,18 @@ class DriversFactory(object):
                 from mongo_pm2 import MongoDriverPM2
                 return MongoDriverPM2(self.host, self.database, self.repository,
                                self.port, self.user, self.passwd,
-                               self.index_service, self.logger)
+                               self.index_service, self.logger, **self.driver_options)
             else:
                 from mongo_pm3 import MongoDriverPM3
                 return MongoDriverPM3(self.host, self.database, self.repository,
                                self.port, self.user, self.passwd,
-                               self.index_service, self.logger)
+                               self.index_service, self.logger, **self.driver_options)
         elif self.driver == 'elasticsearch':
             from elastic_search import ElasticSearchDriver
             return ElasticSearchDriver([{"host":self.host,"port":self.port}],
                                        self.database, self.repository,
                                        user=self.user, passwd=self.passwd,
-                                       index_service=self.index_service, logger=self.logger)
+                                       index_service=self.index_service, logger=self.logger,
+                                       **self.driver_options)
         else:
             raise UnknownDriverError('Unknown driver: %s' % self.driver)
\ No newline at end of file
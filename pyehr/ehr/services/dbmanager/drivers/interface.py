@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 from pyehr.ehr.services.dbmanager.errors import *
-import re, json
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
+import re, json, base64
 from hashlib import md5
 
 
@@ -11,6 +12,17 @@ class DriverInterface(object):
     """
     __metaclass__ = ABCMeta
 
+    # EHR level values that can be used as keys to combine the results of more queries
+    # and the record fields they are stored in
+    EHR_KEY_FIELDS = {
+        'ehr_id.value': 'patient_id',
+        'uid.value': '_id'
+    }
+
+    # a :class:`pyehr.ehr.services.dbmanager.querymanager.query_control.QueryControl` object
+    # bound to the query the driver is running, if any
+    query_control = None
+
     def __enter__(self):
         self.connect()
         return self
@@ -41,6 +53,27 @@ class DriverInterface(object):
         """
         pass
 
+    def check_structure(self, structure_def):
+        """
+        Return the list of the elements (i.e. indexes) of the data structure defined by structure_def
+        that are missing in the backend server, by default nothing is missing
+        """
+        return list()
+
+    def bulk_ingest_session(self):
+        """
+        Return a context manager that optimizes the backend for loading large amounts of records,
+        None if the driver doesn't need it
+        """
+        return None
+
+    def ensure_query_indexes(self, query_model, patients_repository, ehr_repository, query_params=None):
+        """
+        Create the indexes that speed up the query expressed as a :class:`pyehr.aql.model.QueryModel`
+        object and return their names, by default no index is created
+        """
+        return list()
+
     @abstractmethod
     def encode_record(self, record):
         """
@@ -49,10 +82,11 @@ class DriverInterface(object):
         pass
 
     @abstractmethod
-    def decode_record(self, record):
+    def decode_record(self, record, loaded=True, lazy=False):
         """
         Encode a data structure coming from the backend server into a :class:`Record`
-        object
+        object, if *lazy* is True the clinical data of clinical records are decoded on
+        first access
         """
         pass
 
@@ -80,6 +114,25 @@ class DriverInterface(object):
                     raise dke
         return saved, errors
 
+    def add_records_unordered(self, records):
+        """
+        Add a list of records in the backend server, records that can't be saved (i.e. records
+        with an ID already in use) don't stop the other ones. IDs are not checked in advance, they
+        must be unique within the given list.
+
+        :return: a list with the IDs of the saved records and a dictionary mapping the IDs of the
+          records that were not saved to the related error messages
+        """
+        self._check_batch(records, '_id')
+        saved = list()
+        errors = dict()
+        for r in records:
+            try:
+                saved.append(self.add_record(r))
+            except DuplicatedKeyError, dke:
+                errors[r['_id']] = str(dke)
+        return saved, errors
+
     def _check_batch(self, records_batch, uid_field):
         """
         Check records batch for duplicated
@@ -99,6 +152,15 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def get_records_by_ids(self, ids, active_only=False, fields=None):
+        """
+        Retrieve the records matching the given IDs with a single request, IDs that don't match
+        any record are ignored. If *active_only* is True, records that are not active are filtered
+        out by the DB, if *fields* is not None only the given fields are retrieved.
+        """
+        pass
+
     @abstractmethod
     def get_record_by_version(self, record_id, version):
         """
@@ -186,6 +248,18 @@ class DriverInterface(object):
         """
         pass
 
+    def update_field_multi(self, record_ids, field_label, field_value, update_timestamp_label=None,
+                           increase_version=False):
+        """
+        Update the field with label *field_label* of all the records with the given IDs with the
+        value provided as *field_value* and update timestamp in field *update_timestamp_label*
+        """
+        update_timestamp = None
+        for record_id in record_ids:
+            update_timestamp = self.update_field(record_id, field_label, field_value,
+                                                 update_timestamp_label, increase_version)
+        return update_timestamp
+
     @abstractmethod
     def replace_record(self, record_id, new_record, update_timestamp_label=None):
         """
@@ -315,16 +389,47 @@ class DriverInterface(object):
     def _run_aql_query(self, query, fields, aliases, collection):
         pass
 
+    def explain_query(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      query_processes=1, workers_pool=None):
+        """
+        Explain how a query expressed as a :class:`pyehr.aql.model.QueryModel` object would be
+        executed, by default the sub-queries built by :meth:`build_sub_queries` are returned
+        """
+        return {
+            'sub_queries': self.build_sub_queries(query_model, patients_repository, ehr_repository,
+                                                  query_params)
+        }
+
+    def _run_sub_query(self, query_description, collection):
+        """
+        Run a sub-query described by a dictionary with *condition*, *selection* and *aliases*
+        fields, as returned by :meth:`build_sub_queries`
+        """
+        return self._run_aql_query(query_description['condition'], query_description['selection'],
+                                   query_description['aliases'], collection)
+
+    def _run_sub_query_page(self, query_description, collection, page_size, last_key):
+        """
+        Run a sub-query described by a dictionary like :meth:`_run_sub_query` and return a page of
+        results, see :meth:`_find_page_by_aql_queries`
+        """
+        return self._run_aql_query_page(query_description['condition'], query_description['selection'],
+                                        query_description['aliases'], collection, page_size, last_key)
+
     @abstractmethod
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      contains_mapping=None):
         query_params = query_params or dict()
         selection = query_model.selection
         location = query_model.location
         condition = query_model.condition
         # TODO: add ORDER RULES and TIME CONSTRAINTS
         queries = dict()
-        # get aliases map and paths map for structures that match the CONTAINS statement
-        structures_map, aliases_map = self.index_service.map_aql_contains(location.containers)
+        # get aliases map and paths map for structures that match the CONTAINS statement,
+        # a mapping already retrieved from the IndexService can be passed as contains_mapping
+        if contains_mapping is None:
+            contains_mapping = self.index_service.map_aql_contains(location.containers)
+        structures_map, aliases_map = contains_mapping
         for structure_id, archetype_paths in structures_map.iteritems():
             # location_query simply maps EHR section, this will be shared among all structure paths
             location_query = self._calculate_location_expression(location, query_params, patients_repository,
@@ -344,10 +449,16 @@ class DriverInterface(object):
                     # set and empty dictionary as 'condition', it will be filled later with rules to match
                     # ClinicalRecord structure ID
                     apat_query['condition'] = dict()
-                apat_query['condition'].update(location_query)
+                self._add_location_query(apat_query['condition'], location_query)
                 queries.setdefault(structure_id, list()).append(apat_query)
         return queries
 
+    def _add_location_query(self, condition, location_query):
+        """
+        Add the query built for the location expression to the condition of a query
+        """
+        condition.update(location_query)
+
     @abstractmethod
     def _get_query_hash(self, query):
         query_hash = md5()
@@ -374,13 +485,129 @@ class DriverInterface(object):
         return structures_hash_map
 
     @abstractmethod
-    def _aggregate_queries(self, queries):
+    def execute_query(self, query_model, patients_repository, ehr_repository, query_params,
+                      count_only, query_processes, workers_pool):
+        """
+        Execute a query expressed as a :class:`pyehr.aql.model.QueryModel` object
+        """
         pass
 
     @abstractmethod
-    def execute_query(self, query_model, patients_repository, ehr_repository, query_params,
-                      count_only, query_processes):
+    def build_sub_queries(self, query_model, patients_repository, ehr_repository, query_params,
+                          contains_mapping):
+        """
+        Build the sub-queries, with *condition*, *selection* and *aliases* fields, that must be run
+        with :meth:`_run_aql_query` in order to execute a query expressed as a
+        :class:pyehr.aql.model.QueryModel` object, the query results are the union of sub-queries results
+        """
+        pass
+
+    def _check_query_control(self):
+        if self.query_control is not None:
+            self.query_control.check()
+
+    def _get_remaining_time_ms(self):
+        if self.query_control is not None:
+            return self.query_control.get_remaining_ms()
+        return None
+
+    def _get_key_field(self, key):
+        try:
+            return self.EHR_KEY_FIELDS[key]
+        except KeyError:
+            raise ValueError('Unsupported key %s, allowed keys are %s' % (key, ', '.join(self.EHR_KEY_FIELDS)))
+
+    @abstractmethod
+    def execute_keys_query(self, query_model, patients_repository, ehr_repository, key,
+                           query_params, restrict_to):
+        """
+        Execute a query expressed as a :class:`pyehr.aql.model.QueryModel` object and return the set
+        of distinct values of the given *key* (one of the EHR_KEY_FIELDS) for matching records. If
+        *restrict_to* is not None, only records whose key is in *restrict_to* are considered.
+        """
+        pass
+
+    @abstractmethod
+    def execute_structures_keys_query(self, structure_ids, ehr_repository, key):
         """
-        Execute a query expressed as a :class:pyehr.aql.model.QueryModel` object
+        Return the set of distinct values of the given *key* (one of the EHR_KEY_FIELDS) for the
+        clinical records with one of the given structures
         """
         pass
+
+    @abstractmethod
+    def execute_query_page(self, query_model, patients_repository, ehr_repository, page_size,
+                           query_params, page_token):
+        """
+        Execute a query expressed as a :class:`pyehr.aql.model.QueryModel` object and return
+        a single page of results
+        """
+        pass
+
+    @abstractmethod
+    def _run_aql_query_page(self, query, fields, aliases, collection, page_size, last_key):
+        """
+        Run a single query and return at most *page_size* results with a key greater than
+        *last_key* (sorted by key) and the key of the last returned result. If there are no more
+        results for the query, the returned key must be None.
+        """
+        pass
+
+    def _get_page_query_hash(self, query):
+        # short hashes keep page tokens small, keys are sorted to obtain the same
+        # hash for the same query in different processes; planning details like
+        # index hints don't change the results, so they are not part of the hash
+        query_hash = md5()
+        query_hash.update(json.dumps(dict((k, query[k]) for k in ('condition', 'selection', 'aliases')),
+                                     sort_keys=True))
+        return query_hash.hexdigest()[:12]
+
+    def _encode_page_token(self, completed_queries, current_query, last_key):
+        token = {'d': completed_queries, 'c': current_query, 'k': last_key}
+        return base64.urlsafe_b64encode(json.dumps(token))
+
+    def _decode_page_token(self, page_token):
+        try:
+            token = json.loads(base64.urlsafe_b64decode(str(page_token)))
+            return token['d'], token['c'], token['k']
+        except (TypeError, ValueError, KeyError):
+            raise InvalidPageTokenError('Invalid page token %r' % page_token)
+
+    def _find_page_by_aql_queries(self, queries, ehr_repository, page_size, page_token=None):
+        """
+        Walk the given queries, sorted by hash, and fill a page with at most *page_size* results.
+        Page tokens keep track of the queries that were completely consumed and of the position
+        reached in the current query, queries that appeared after the token was created (i.e. for
+        a new structure matching the query) will be walked as well.
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be an integer greater than 0')
+        if page_token:
+            completed_queries, current_query, last_key = self._decode_page_token(page_token)
+        else:
+            completed_queries, current_query, last_key = [], None, None
+        queries_map = dict((self._get_page_query_hash(q), q) for q in queries)
+        pending_queries = sorted(h for h in queries_map if h not in completed_queries)
+        if current_query not in queries_map:
+            # query removed since the token was created, restart from the next one
+            current_query, last_key = None, None
+        elif current_query in pending_queries:
+            # resume the current query first
+            pending_queries.remove(current_query)
+            pending_queries.insert(0, current_query)
+        page = ResultSet()
+        while pending_queries and page.total_results < page_size:
+            self._check_query_control()
+            query_hash = pending_queries[0]
+            if query_hash != current_query:
+                current_query, last_key = query_hash, None
+            query = queries_map[query_hash]
+            results, last_key = self._run_sub_query_page(query, ehr_repository,
+                                                         page_size - page.total_results, last_key)
+            page.extend(results)
+            if last_key is None:
+                completed_queries.append(pending_queries.pop(0))
+                current_query = None
+        if pending_queries:
+            page.next_page_token = self._encode_page_token(completed_queries, current_query, last_key)
+        return page
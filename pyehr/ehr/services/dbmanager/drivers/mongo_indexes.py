@@ -0,0 +1,151 @@
+from hashlib import md5
+import pymongo
+
+from pyehr.utils import get_logger
+
+
+class MongoIndexManager(object):
+    """
+    Create and verify the indexes used by pyEHR on a MongoDB collection. Base indexes depend on the
+    kind of records stored in the collection (see BASE_INDEXES), partial indexes can be added for
+    the fields used in the WHERE statements of frequently executed AQL queries; partial indexes are
+    filtered on the structure ID, so each index only contains the records of a single structure
+    (partial indexes require MongoDB 3.2 or newer).
+    """
+
+    # indexes needed by the queries of pyEHR services, by kind of records
+    BASE_INDEXES = {
+        'patients': [
+            [('active', pymongo.ASCENDING)],
+            [('ehr_records', pymongo.ASCENDING)]
+        ],
+        'ehr': [
+            [('ehr_structure_id', pymongo.ASCENDING)],
+            [('patient_id', pymongo.ASCENDING)],
+            [('active', pymongo.ASCENDING)]
+        ],
+        'ehr_versioning': [
+            [('_id._id', pymongo.ASCENDING), ('_version', pymongo.ASCENDING)]
+        ]
+    }
+    STRUCTURE_FIELD = 'ehr_structure_id'
+    PARTIAL_INDEX_PREFIX = 'pyehr_partial_'
+    # fields already covered by base indexes, they don't need partial indexes
+    BASE_FIELDS = ('_id', 'ehr_structure_id', 'patient_id', 'active')
+
+    def __init__(self, collection, logger=None):
+        """
+        :param collection: a pymongo collection
+        """
+        self.collection = collection
+        self.logger = logger or get_logger('mongo-index-manager')
+
+    def _get_base_indexes(self, records_kind):
+        try:
+            return self.BASE_INDEXES[records_kind]
+        except KeyError:
+            raise ValueError('Unknown records kind %s, allowed values are %s' %
+                             (records_kind, ', '.join(self.BASE_INDEXES)))
+
+    def get_indexes(self):
+        """
+        Return the existing indexes as a dictionary with index names as keys and
+        lists of (field, direction) pairs as values
+        """
+        return dict((name, [tuple(k) for k in index['key']])
+                    for name, index in self.collection.index_information().iteritems())
+
+    def _is_covered(self, keys, indexes):
+        # an index also serves the queries on a prefix of its keys
+        return any(index_keys[:len(keys)] == keys for index_keys in indexes.itervalues())
+
+    def get_missing_indexes(self, records_kind):
+        """
+        Return the base indexes that are not covered by the existing indexes
+
+        :param records_kind: the kind of records stored in the collection, *patients*, *ehr* or *ehr_versioning*
+        :type records_kind: str
+        :return: a list of index keys, as lists of (field, direction) pairs
+        """
+        indexes = self.get_indexes()
+        return [keys for keys in self._get_base_indexes(records_kind) if not self._is_covered(keys, indexes)]
+
+    def ensure_base_indexes(self, records_kind):
+        """
+        Create the missing base indexes, indexes are built in background
+
+        :param records_kind: the kind of records stored in the collection, *patients*, *ehr* or *ehr_versioning*
+        :type records_kind: str
+        :return: the names of the created indexes
+        :rtype: list
+        """
+        created_indexes = list()
+        for keys in self.get_missing_indexes(records_kind):
+            self.logger.info('Creating index %r on collection %s', keys, self.collection.name)
+            created_indexes.append(self.collection.create_index(keys, background=True))
+        return created_indexes
+
+    @staticmethod
+    def get_condition_fields(condition):
+        """
+        Return the fields used in a query condition (in MongoDB syntax)
+
+        :param condition: a query condition
+        :type condition: dict
+        :return: a set of field names
+        """
+        fields = set()
+        for key, value in condition.iteritems():
+            if key in ('$and', '$or', '$nor'):
+                for clause in value:
+                    fields.update(MongoIndexManager.get_condition_fields(clause))
+            elif not key.startswith('$'):
+                fields.add(key)
+        return fields
+
+    def get_partial_index_name(self, field, structure_id):
+        # fields of clinical records are long paths, use a hash to respect the limits on index names
+        index_hash = md5()
+        index_hash.update('%s:%s' % (structure_id, field))
+        return '%s%s' % (self.PARTIAL_INDEX_PREFIX, index_hash.hexdigest()[:16])
+
+    def ensure_partial_index(self, field, structure_id):
+        """
+        Create an index on *field* only containing the records with the given structure, if needed
+
+        :param field: the field that will be indexed
+        :type field: str
+        :param structure_id: the structure ID used to filter the records
+        :type structure_id: str
+        :return: the name of the index and True if the index was created, False if it already existed
+        :rtype: tuple
+        """
+        index_name = self.get_partial_index_name(field, structure_id)
+        if index_name in self.collection.index_information():
+            return index_name, False
+        self.logger.info('Creating partial index %s on field %s for structure %s',
+                         index_name, field, structure_id)
+        self.collection.create_index([(field, pymongo.ASCENDING)], name=index_name, background=True,
+                                     partialFilterExpression={self.STRUCTURE_FIELD: structure_id})
+        return index_name, True
+
+    def ensure_query_indexes(self, queries):
+        """
+        Create the partial indexes for the conditions of the given queries
+
+        :param queries: a dictionary with structure IDs as keys and the list of queries built for
+                        each structure as values, as returned by the *build_queries* method of the driver
+        :type queries: dict
+        :return: the names of the created indexes
+        :rtype: list
+        """
+        created_indexes = list()
+        for structure_id, structure_queries in queries.iteritems():
+            fields = set()
+            for q in structure_queries:
+                fields.update(self.get_condition_fields(q['condition']))
+            for field in sorted(fields.difference(self.BASE_FIELDS)):
+                index_name, created = self.ensure_partial_index(field, structure_id)
+                if created:
+                    created_indexes.append(index_name)
+        return created_indexes
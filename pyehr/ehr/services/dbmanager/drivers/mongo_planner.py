@@ -0,0 +1,175 @@
+from hashlib import md5
+
+from pyehr.ehr.services.dbmanager.drivers.mongo_indexes import MongoIndexManager
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class MongoQueryPlanner(object):
+    """
+    Plan the sub-queries built by the :class:`pyehr.ehr.services.dbmanager.drivers.mongo_pm2.MongoDriverPM2`
+    for an AQL query. The number of records of each structure (the references counters kept by the
+    :class:`pyehr.ehr.services.dbmanager.dbservices.index_service.IndexService`) is compared with the
+    number of records in the collection in order to choose one of the following strategies for each
+    group of sub-queries sharing the same selection:
+
+    * *scan*: a single query, the structures involved cover a large part of the collection (or there
+      is no index on the structure ID) so a collection scan is the cheapest option
+    * *in*: a single query with an $in clause on the structure ID and hinted to use the structure
+      ID index
+    * *union*: a query for each structure, hinted to use the structure ID index; sub-queries can be
+      run in parallel, so this is used for large results when more processes (or threads) are available
+
+    If one of the structures has a partial index (see
+    :meth:`pyehr.ehr.services.dbmanager.drivers.mongo_indexes.MongoIndexManager.ensure_partial_index`)
+    on a field of its conditions, the structure ID index is not hinted: queries on a single structure
+    with a single condition are hinted to use the partial index, the other ones are left to MongoDB's
+    query planner.
+
+    In every case, the conditions of the different structures are combined under a top level clause
+    on the structure ID, so that MongoDB can always use the index to bound the scan. Records of
+    different structures never overlap, so the strategies return the same records.
+    """
+
+    STRATEGIES = ('scan', 'in', 'union')
+    STRUCTURE_FIELD = 'ehr_structure_id'
+
+    def __init__(self, collection_records, structure_index=None, parallel=False,
+                 scan_threshold=0.3, union_min_records=10000, partial_indexes=None):
+        """
+        :param collection_records: the number of records in the queried collection
+        :type collection_records: int
+        :param structure_index: the key of an index starting with the structure ID field, as a
+                                list of (field, direction) pairs, None if there is no such index
+        :type structure_index: list
+        :param parallel: True if sub-queries will be run in parallel
+        :type parallel: bool
+        :param scan_threshold: the fraction of the collection above which a collection scan is used
+        :type scan_threshold: float
+        :param union_min_records: the minimum number of estimated records for the *union* strategy
+        :type union_min_records: int
+        :param partial_indexes: the partial indexes of the collection, a dictionary with structure IDs
+                                as keys and dictionaries mapping indexed fields to index names as values
+        :type partial_indexes: dict
+        """
+        self.collection_records = collection_records
+        self.structure_index = structure_index
+        self.parallel = parallel
+        self.scan_threshold = scan_threshold
+        self.union_min_records = union_min_records
+        self.partial_indexes = partial_indexes or dict()
+
+    @staticmethod
+    def _get_hash(value):
+        value_hash = md5()
+        value_hash.update(json.dumps(value, sort_keys=True))
+        return value_hash.hexdigest()
+
+    def _get_structures_selector(self, structure_ids):
+        if len(structure_ids) == 1:
+            return structure_ids[0]
+        return {'$in': structure_ids}
+
+    def _group_queries(self, queries, merge_selections):
+        # group the queries by selection, within each group keep the distinct
+        # conditions to be applied to each structure
+        groups = dict()
+        for structure_id in sorted(queries):
+            for q in queries[structure_id]:
+                group_key = None if merge_selections else self._get_hash(q['selection'])
+                if group_key not in groups:
+                    groups[group_key] = {'selection': q['selection'], 'aliases': q['aliases'],
+                                         'conditions': dict()}
+                conditions = groups[group_key]['conditions'].setdefault(structure_id, dict())
+                conditions.setdefault(self._get_hash(q['condition']), q['condition'])
+        return [groups[k] for k in sorted(groups)]
+
+    def _build_condition(self, structure_ids, conditions):
+        structures_by_condition = dict()
+        conditions_map = dict()
+        for structure_id in structure_ids:
+            for c_hash, condition in conditions[structure_id].iteritems():
+                structures_by_condition.setdefault(c_hash, list()).append(structure_id)
+                conditions_map[c_hash] = condition
+        clauses = list()
+        for c_hash in sorted(structures_by_condition):
+            clause = dict(conditions_map[c_hash])
+            clause[self.STRUCTURE_FIELD] = self._get_structures_selector(structures_by_condition[c_hash])
+            clauses.append(clause)
+        if len(clauses) == 1:
+            return clauses[0]
+        # without a top level clause on the structure ID, MongoDB can't use the index for the $or
+        return {self.STRUCTURE_FIELD: self._get_structures_selector(structure_ids), '$or': clauses}
+
+    def choose_strategy(self, structures_count, estimated_records):
+        """
+        Choose the strategy used to query *structures_count* structures matching
+        *estimated_records* records
+        """
+        if self.structure_index is None:
+            return 'scan'
+        if self.collection_records and \
+                float(estimated_records) / self.collection_records > self.scan_threshold:
+            return 'scan'
+        if structures_count > 1 and self.parallel and estimated_records >= self.union_min_records:
+            return 'union'
+        return 'in'
+
+    def _get_hint(self, structure_ids, conditions, strategy):
+        if strategy == 'scan':
+            return None
+        partial_indexes = set()
+        for structure_id in structure_ids:
+            structure_indexes = self.partial_indexes.get(structure_id, dict())
+            for condition in conditions[structure_id].itervalues():
+                for field in MongoIndexManager.get_condition_fields(condition):
+                    if field in structure_indexes:
+                        partial_indexes.add(structure_indexes[field])
+        if not partial_indexes:
+            return self.structure_index
+        if len(structure_ids) == 1 and len(conditions[structure_ids[0]]) == 1 and len(partial_indexes) == 1:
+            # partial indexes are hinted by name, indexes of different structures share the same key
+            return partial_indexes.pop()
+        return None
+
+    def _build_step(self, group, structure_ids, strategy, references):
+        return {
+            'condition': self._build_condition(structure_ids, group['conditions']),
+            'selection': group['selection'],
+            'aliases': group['aliases'],
+            'hint': self._get_hint(structure_ids, group['conditions'], strategy),
+            'strategy': strategy,
+            'structures': structure_ids,
+            'estimated_records': sum(references.get(sid, 0) for sid in structure_ids)
+        }
+
+    def plan(self, queries, references, merge_selections=False):
+        """
+        Build the plan for the given queries
+
+        :param queries: a dictionary with structure IDs as keys and the list of queries built for
+                        each structure as values, as returned by the *build_queries* method of the driver
+        :type queries: dict
+        :param references: a dictionary with structure IDs as keys and the number of records with each
+                           structure as values, unknown structures are considered empty
+        :type references: dict
+        :param merge_selections: ignore selections and plan all the queries together, used when
+                                 only conditions are needed (i.e. to count the records)
+        :type merge_selections: bool
+        :return: a list of query descriptions with *condition*, *selection*, *aliases* and *hint*
+                 (an index key, an index name or None) fields; *strategy*, *structures* and *estimated_records* fields describe the plan
+        """
+        steps = list()
+        for group in self._group_queries(queries, merge_selections):
+            structure_ids = sorted(group['conditions'])
+            estimated_records = sum(references.get(sid, 0) for sid in structure_ids)
+            strategy = self.choose_strategy(len(structure_ids), estimated_records)
+            if strategy == 'union':
+                for structure_id in structure_ids:
+                    steps.append(self._build_step(group, [structure_id], strategy, references))
+            else:
+                steps.append(self._build_step(group, structure_ids, strategy, references))
+        return steps
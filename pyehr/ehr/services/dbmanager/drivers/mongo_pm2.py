@@ -1,13 +1,16 @@
 from pyehr.aql.parser import *
 from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
+from pyehr.ehr.services.dbmanager.drivers.mongo_planner import MongoQueryPlanner
+from pyehr.ehr.services.dbmanager.drivers.mongo_indexes import MongoIndexManager
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
     ResultColumnDef, ResultRow
+from pyehr.ehr.services.dbmanager.querymanager.query_control import QueryControl
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
 import pymongo
 import pymongo.errors
 import time
-from hashlib import md5
+from functools import partial
 from multiprocessing import Pool
 
 try:
@@ -19,23 +22,25 @@ except ImportError:
 class MultiprocessQueryRunnerPM2(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, aql_query_mode='find', deadline=None):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.aql_query_mode = aql_query_mode
+        self.deadline = deadline
 
     def __call__(self, query_description):
         driver_instance = MongoDriverPM2(
             self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
-        )
-        results = driver_instance._run_aql_query(
-            query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
+            self.port, self.user, self.passwd,
+            aql_query_mode=self.aql_query_mode
         )
+        if self.deadline is not None:
+            driver_instance.query_control = QueryControl(deadline=self.deadline)
+        results = driver_instance._run_sub_query(query_description, self.collection_name)
         return results
 
 
@@ -49,10 +54,25 @@ class MongoDriverPM2(DriverInterface):
 
     # This map is used to encode\decode data when writing\reading to\from MongoDB
     ENCODINGS_MAP = {'.': '-'}
+    # fields of the clinical records that are enough to build their metadata, used as a projection when
+    # clinical data are not required
+    CLINICAL_RECORD_METADATA_FIELDS = ('creation_time', 'last_update', 'active', '_version', 'patient_id',
+                                       'ehr_structure_id', 'ehr_data.archetype_class')
+    # Supported modes used to run AQL queries: "find" runs a find() and flattens
+    # the returned documents in Python, "aggregate" uses an aggregation pipeline
+    # to make MongoDB return already flat documents
+    AQL_QUERY_MODES = ('find', 'aggregate')
+    # number of records fetched between two checks of the query's deadline and cancellation flag
+    QUERY_CONTROL_CHECK_INTERVAL = 1000
+    # seconds the collection stats and indexes used by the query planner are cached for, records
+    # estimates don't need to be exact and indexes created by this process invalidate the cache
+    PLANNER_STATS_TTL = 30
+    # collection stats and indexes used by the query planner, by collection
+    _planner_stats = dict()
 
     def __init__(self, host, database, collection,
                  port=None, user=None, passwd=None,
-                 index_service=None, logger=None):
+                 index_service=None, logger=None, aql_query_mode='find'):
         self.client = None
         self.database = None
         self.collection = None
@@ -64,6 +84,9 @@ class MongoDriverPM2(DriverInterface):
         self.passwd = passwd
         self.index_service = index_service
         self.logger = logger or get_logger('mongo-db-driver')
+        if aql_query_mode not in self.AQL_QUERY_MODES:
+            raise ValueError('Unknown AQL query mode %s' % aql_query_mode)
+        self.aql_query_mode = aql_query_mode
 
     def connect(self):
         """
@@ -97,9 +120,64 @@ class MongoDriverPM2(DriverInterface):
         self.collection = None
         self.client = None
 
+    def _get_index_manager(self):
+        self._check_connection()
+        return MongoIndexManager(self.collection, self.logger)
+
     def init_structure(self, structure_def):
-        # MongoDB doesn't need structures initialization
-        pass
+        """
+        Create the indexes needed by the current collection, if missing
+
+        :param structure_def: the kind of records stored in the collection, *patients*, *ehr* or *ehr_versioning*
+        :type structure_def: str
+        :return: the names of the created indexes
+        :rtype: list
+        """
+        created_indexes = self._get_index_manager().ensure_base_indexes(structure_def)
+        if created_indexes:
+            self._invalidate_planner_stats(self.collection_name)
+        return created_indexes
+
+    def check_structure(self, structure_def):
+        """
+        Return the indexes needed by the current collection that are missing
+
+        :param structure_def: the kind of records stored in the collection, *patients*, *ehr* or *ehr_versioning*
+        :type structure_def: str
+        :return: a list of index keys, as lists of (field, direction) pairs
+        :rtype: list
+        """
+        return self._get_index_manager().get_missing_indexes(structure_def)
+
+    def ensure_query_indexes(self, query_model, patients_repository, ehr_repository, query_params=None):
+        """
+        Create partial indexes, filtered by structure ID, for the fields used in the WHERE statement
+        of a query parsed with the :class:`pyehr.aql.parser.Parser` object
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :return: the names of the created indexes
+        :rtype: list
+        """
+        queries = self.build_queries(query_model, patients_repository, ehr_repository, query_params)
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        created_indexes = self._get_index_manager().ensure_query_indexes(queries)
+        if created_indexes:
+            self._invalidate_planner_stats(ehr_repository)
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        return created_indexes
 
     @property
     def is_connected(self):
@@ -235,17 +313,38 @@ class MongoDriverPM2(DriverInterface):
                 normalized_doc[k] = self._decode_keys(v, encoded, original)
         return normalized_doc
 
-    def _decode_clinical_record(self, record, loaded):
+    def _decode_ehr_data(self, ehr_data):
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ArchetypeInstance
+
+        ehr_data = decode_dict(ehr_data)
+        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
+            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
+        return ArchetypeInstance.from_json(ehr_data)
+
+    def _decode_clinical_record(self, record, loaded, lazy=False):
         from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecord,\
-            ArchetypeInstance
+            LazyClinicalRecord, ArchetypeInstance
 
+        if loaded and lazy:
+            # only metadata are decoded now, clinical data are kept in their raw form
+            ehr_data = record['ehr_data']
+            record = decode_dict(dict((k, v) for k, v in record.iteritems() if k != 'ehr_data'))
+            crec = LazyClinicalRecord(
+                ehr_data_loader=partial(self._decode_ehr_data, ehr_data),
+                creation_time=record['creation_time'],
+                last_update=record['last_update'],
+                active=record['active'],
+                record_id=record.get('_id'),
+                structure_id=record.get('ehr_structure_id'),
+                version=record['_version']
+            )
+            if 'patient_id' in record:
+                crec._set_patient_id(record['patient_id'])
+            return crec
         record = decode_dict(record)
         if loaded:
-            ehr_data = record['ehr_data']
-            for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-                ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
             crec = ClinicalRecord(
-                ehr_data=ArchetypeInstance.from_json(ehr_data),
+                ehr_data=self._decode_ehr_data(record['ehr_data']),
                 creation_time=record['creation_time'],
                 last_update=record['last_update'],
                 active=record['active'],
@@ -274,15 +373,11 @@ class MongoDriverPM2(DriverInterface):
         return crec
 
     def _decode_clinical_record_revision(self, record):
-        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision, \
-            ArchetypeInstance
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision
 
         record = decode_dict(record)
-        ehr_data = record['ehr_data']
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
         return ClinicalRecordRevision(
-            ehr_data=ArchetypeInstance.from_json(ehr_data),
+            ehr_data=self._decode_ehr_data(record['ehr_data']),
             patient_id=record['patient_id'],
             creation_time=record['creation_time'],
             last_update=record['last_update'],
@@ -292,7 +387,7 @@ class MongoDriverPM2(DriverInterface):
             version=record.get('_version'),
         )
 
-    def decode_record(self, record, loaded=True):
+    def decode_record(self, record, loaded=True, lazy=False):
         """
         Create a :class:`Record` object from data retrieved from MongoDB
 
@@ -301,13 +396,16 @@ class MongoDriverPM2(DriverInterface):
         :param loaded: if True, return a :class:`Record` with all values, if False all fields with
           the exception of the record_id one will have a None value
         :type loaded: boolean
+        :param lazy: if True, clinical records are returned as :class:`LazyClinicalRecord` objects
+          whose clinical data are decoded on first access
+        :type lazy: boolean
         :return: the MongoDB document encoded as a :class:`Record` object
         """
         if 'ehr_data' in record:
             if isinstance(record.get('_id'), dict):
                 return self._decode_clinical_record_revision(record)
             else:
-                return self._decode_clinical_record(record, loaded)
+                return self._decode_clinical_record(record, loaded, lazy)
         else:
             return self._decode_patient_record(record, loaded)
 
@@ -352,6 +450,35 @@ class MongoDriverPM2(DriverInterface):
             # empty bulk insert
             return [], [records_map[x] for x in duplicated_ids]
 
+    def _split_bulk_write_results(self, records, write_errors):
+        errors = dict((records[e['index']]['_id'], e['errmsg']) for e in write_errors)
+        return [r['_id'] for r in records if r['_id'] not in errors], errors
+
+    def add_records_unordered(self, records):
+        """
+        Save a list of records within MongoDB using an unordered bulk write: records that can't be
+        saved (i.e. records with an ID already in use) don't stop the other ones and no query is
+        used to look for duplicated IDs in advance. IDs must be unique within the given list.
+
+        :param records: the list of records that is going to be saved
+        :type records: list
+        :return: a list of records' IDs and a dictionary mapping the IDs of the records that were
+          not saved to the related error messages
+        """
+        if not records:
+            return [], {}
+        self._check_batch(records, '_id')
+        self._check_connection()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for r in records:
+            bulk.insert(r)
+        try:
+            bulk.execute()
+            write_errors = []
+        except pymongo.errors.BulkWriteError, bwe:
+            write_errors = bwe.details['writeErrors']
+        return self._split_bulk_write_results(records, write_errors)
+
     def get_record_by_id(self, record_id):
         """
         Retrieve a record using its ID
@@ -367,6 +494,30 @@ class MongoDriverPM2(DriverInterface):
         else:
             return res
 
+    def get_records_by_ids(self, ids, active_only=False, fields=None):
+        """
+        Retrieve the records matching the given IDs with a single query, IDs that don't match
+        any record are ignored
+
+        :param ids: the IDs of the records
+        :type ids: list
+        :param active_only: if True, only records whose *active* field is True are retrieved
+        :type active_only: bool
+        :param fields: if not None, only the given fields of the records are retrieved
+        :type fields: list
+        :return: the records, in the same order of the given IDs
+        :rtype: list
+        """
+        self._check_connection()
+        ids = list(ids)
+        if not ids:
+            return []
+        query = {'_id': {'$in': ids}}
+        if active_only:
+            query['active'] = True
+        records = dict((r['_id'], r) for r in self.collection.find(query, list(fields) if fields else None))
+        return [decode_dict(records[i]) for i in ids if i in records]
+
     def get_record_by_version(self, record_id, version):
         """
         Retrieve a record using its ID and version number
@@ -411,7 +562,7 @@ class MongoDriverPM2(DriverInterface):
         """
         return self.get_records_by_query({field: value})
 
-    def get_records_by_query(self, selector, fields=None, limit=0):
+    def get_records_by_query(self, selector, fields=None, limit=0, sort=None, hint=None):
         """
         Retrieve all records matching the given query
 
@@ -423,11 +574,56 @@ class MongoDriverPM2(DriverInterface):
         :param limit: the maximum number of records that will be fetched by the query, default value is 0
                       which means that limit won't be applied and all records will be fetched
         :type limit: int
+        :param sort: a list of (key, direction) pairs used to sort the records
+        :type sort: list
+        :param hint: the key of the index that must be used by the query, as a list of (key, direction) pairs,
+                     or the name of the index
+        :type hint: list or str
         :return: a list with the matching records
         :rtype: list
         """
         self._check_connection()
-        return (decode_dict(rec) for rec in self.collection.find(selector, fields, limit=limit))
+        cursor = self.collection.find(selector, fields, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        if hint:
+            cursor = cursor.hint(self._get_hint(hint))
+        max_time_ms = self._get_remaining_time_ms()
+        if max_time_ms is not None:
+            cursor = cursor.max_time_ms(max_time_ms)
+        return self._iter_records(cursor)
+
+    def _iter_records(self, cursor):
+        # decode the records returned by a cursor, checking the query control while
+        # fetching them and mapping server side timeouts to QueryTimeoutError
+        try:
+            for i, rec in enumerate(cursor):
+                if i % self.QUERY_CONTROL_CHECK_INTERVAL == 0:
+                    self._check_query_control()
+                yield decode_dict(rec)
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError('Query exceeded its deadline')
+
+    def _get_max_time_option(self):
+        max_time_ms = self._get_remaining_time_ms()
+        if max_time_ms is not None:
+            return {'maxTimeMS': max_time_ms}
+        return {}
+
+    def get_records_by_pipeline(self, pipeline):
+        """
+        Retrieve the documents produced by the given aggregation pipeline
+
+        :param pipeline: the aggregation pipeline (in MongoDB syntax)
+        :type pipeline: list
+        :return: a generator with the documents produced by the pipeline
+        """
+        self._check_connection()
+        try:
+            cursor = self.collection.aggregate(pipeline, cursor={}, **self._get_max_time_option())
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError('Query exceeded its deadline')
+        return self._iter_records(cursor)
 
     def get_values_by_record_id(self, record_id, values_list):
         """
@@ -456,7 +652,13 @@ class MongoDriverPM2(DriverInterface):
         """
         self._check_connection()
         res = self.collection.find(selector)
-        return res.count()
+        max_time_ms = self._get_remaining_time_ms()
+        if max_time_ms is not None:
+            res = res.max_time_ms(max_time_ms)
+        try:
+            return res.count()
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError('Query exceeded its deadline')
 
     def delete_record(self, record_id):
         """
@@ -873,7 +1075,40 @@ class MongoDriverPM2(DriverInterface):
             else:
                 yield key, value
 
-    def _run_aql_query(self, query, fields, aliases, collection):
+    def _build_flattening_pipeline(self, query, fields):
+        # project each selected path to a positional key, field names
+        # in a $project stage can't contain dots
+        projection = {'_id': False}
+        keys_map = dict()
+        for i, path in enumerate(sorted(f for f, v in fields.iteritems() if v)):
+            key = 'f%d' % i
+            projection[key] = '$%s' % path
+            keys_map[key] = path
+        return [{'$match': query}, {'$project': projection}], keys_map
+
+    def _get_last_value(self, value):
+        # projecting a path that goes through arrays returns (nested) arrays of values,
+        # take the last one in order to obtain the same value returned by _split_results
+        if isinstance(value, list):
+            for element in reversed(value):
+                found, v = self._get_last_value(element)
+                if found:
+                    return True, v
+            return False, None
+        return True, value
+
+    def _rename_flat_results(self, query_result, keys_map):
+        for key, value in query_result.iteritems():
+            found, value = self._get_last_value(value)
+            if not found:
+                continue
+            if isinstance(value, dict):
+                for k, v in self._split_results(value):
+                    yield '{}.{}'.format(keys_map[key], k), v
+            else:
+                yield keys_map[key], value
+
+    def _run_aql_query(self, query, fields, aliases, collection, hint=None):
         self.logger.debug("Running query\n%s\nwith filters\n%s", query, fields)
         rs = ResultSet()
         for path, alias in aliases.iteritems():
@@ -886,23 +1121,65 @@ class MongoDriverPM2(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(collection)
-        query_results = self.get_records_by_query(query, fields)
-
+        if self.aql_query_mode == 'aggregate':
+            pipeline, keys_map = self._build_flattening_pipeline(query, fields)
+            self.logger.debug("Using aggregation pipeline\n%s", pipeline)
+            records = (dict(self._rename_flat_results(q, keys_map))
+                       for q in self.get_records_by_pipeline(pipeline))
+        else:
+            records = (dict(self._split_results(q))
+                       for q in self.get_records_by_query(query, fields, hint=hint))
+        for record in records:
+            rs.add_row(ResultRow(record))
         if close_conn_after_done:
             self.disconnect()
         else:
             self.select_collection(original_collection)
-        for q in query_results:
-            record = dict()
-            for x in self._split_results(q):
-                record[x[0]] = x[1]
-            rr = ResultRow(record)
-            rs.add_row(rr)
         return rs
 
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+    def _run_sub_query(self, query_description, collection):
+        # index hints are only applied to find queries, aggregation pipelines
+        # start with a $match stage that is planned by MongoDB
+        return self._run_aql_query(query_description['condition'], query_description['selection'],
+                                   query_description['aliases'], collection, query_description.get('hint'))
+
+    def _run_aql_query_page(self, query, fields, aliases, collection, page_size, last_key):
+        self.logger.debug("Running query page\n%s\nwith filters\n%s\nstarting after %s", query, fields, last_key)
+        rs = ResultSet()
+        for path, alias in aliases.iteritems():
+            rs.add_column_definition(ResultColumnDef(alias, path))
+        if last_key is not None:
+            query = {'$and': [query, {'_id': {'$gt': last_key}}]}
+        # records' IDs are always needed to build the key for the next page
+        select_id = fields.get('_id', False)
+        fields = dict(fields)
+        fields['_id'] = True
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(collection)
+        last_key = None
+        for q in self.get_records_by_query(query, fields, page_size, [('_id', pymongo.ASCENDING)]):
+            last_key = q['_id']
+            record = dict(self._split_results(q))
+            if not select_id:
+                record.pop('_id', None)
+            rs.add_row(ResultRow(record))
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        if rs.total_results < page_size:
+            last_key = None
+        return rs, last_key
+
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      contains_mapping=None):
         return super(MongoDriverPM2, self).build_queries(query_model, patients_repository, ehr_repository,
-                                                      query_params)
+                                                      query_params, contains_mapping)
 
     def _get_query_hash(self, query):
         return super(MongoDriverPM2, self)._get_query_hash(query)
@@ -919,61 +1196,35 @@ class MongoDriverPM2(DriverInterface):
         else:
             return {'ehr_structure_id': {'$in': structure_ids}}
 
-    def _aggregate_queries(self, queries):
-        aggregated_queries = list()
-        queries_hash_map = self._get_queries_hash_map(queries)
-        structures_hash_map = self._get_structures_hash_map(queries)
-        for qhash, structures in structures_hash_map.iteritems():
-            query = queries_hash_map[qhash]
-            query['condition'].update(self._get_structures_selector(structures))
-            aggregated_queries.append(query)
-        return aggregated_queries
-
-    def _get_query_hash_by_section(self, query, section):
-        query_hash = md5()
-        query_hash.update(json.dumps(query[section]))
-        return query_hash.hexdigest()
-
-    def _get_selection_maps(self, queries):
-        selections_map = dict()
-        queries_by_sel_map = dict()
-        for q in queries:
-            q_hash = self._get_query_hash_by_section(q, 'selection')
-            queries_by_sel_map.setdefault(q_hash, list()).append(q)
-            if q_hash not in selections_map:
-                selections_map[q_hash] = q['selection']
-        return selections_map, queries_by_sel_map
-
-    def _aggregate_queries_by_selection(self, queries):
-        aggregated_queries = list()
-        sel_map, queries_map = self._get_selection_maps(queries)
-        for sel_hash, mapped_queries in queries_map.iteritems():
-            condition = {'$or': [q['condition'] for q in mapped_queries]}
-            aggregated_queries.append({
-                'condition': condition,
-                'aliases': mapped_queries[0]['aliases'],
-                'selection': sel_map[sel_hash]
-            })
-        return aggregated_queries
-
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
-        if len(queries) > 1:
-            queries = self._aggregate_queries_by_selection(queries)
+    def _find_by_aql_queries(self, queries, ehr_repository, query_processes, workers_pool=None):
+        if workers_pool and workers_pool.is_running and len(queries) > 1:
+            return workers_pool.run_queries(queries, ehr_repository, self.query_control)
         total_results = ResultSet()
         if query_processes == 1 or len(queries) == 1:
             for query in queries:
-                results = self._run_aql_query(query=query['condition'], fields=query['selection'],
-                                              aliases=query['aliases'], collection=ehr_repository)
-                total_results.extend(results)
+                self._check_query_control()
+                total_results.extend(self._run_sub_query(query, ehr_repository))
         else:
+            deadline = self.query_control.deadline if self.query_control else None
             queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
-                MultiprocessQueryRunnerPM2(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
-            )
-            for r in results:
-                total_results.extend(r)
+            try:
+                results = queries_pool.imap_unordered(
+                    MultiprocessQueryRunnerPM2(self.host, self.database_name,
+                                            ehr_repository, self.port, self.user, self.passwd,
+                                            self.aql_query_mode, deadline),
+                    queries
+                )
+                for r in results:
+                    self._check_query_control()
+                    total_results.extend(r)
+            except:
+                # the query timed out or was cancelled, don't wait for the other sub-queries
+                queries_pool.terminate()
+                raise
+            else:
+                queries_pool.close()
+            finally:
+                queries_pool.join()
         return total_results
 
     def _count_by_aql_queries(self, queries, ehr_repository):
@@ -984,18 +1235,264 @@ class MongoDriverPM2(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(ehr_repository)
-        if len(queries) == 1:
-            results_counter = self.count_records_by_query(queries[0])
-        else:
-            results_counter = self.count_records_by_query({'$or': queries})
+        # queries are planned with merged selections, so they match records of different structures
+        results_counter = sum(self.count_records_by_query(q) for q in queries)
         if close_conn_after_done:
             self.disconnect()
         else:
             self.select_collection(original_collection)
         return results_counter
 
+    def _get_hint(self, hint):
+        # indexes can be hinted by name or by key
+        if isinstance(hint, basestring):
+            return hint
+        return [tuple(k) for k in hint]
+
+    def _get_structure_index(self, indexes_info):
+        # the first index starting with the structure ID, single field indexes come first,
+        # partial indexes don't contain all the records and can't be used as structure index
+        indexes = sorted([i for i in indexes_info.itervalues() if 'partialFilterExpression' not in i],
+                         key=lambda i: len(i['key']))
+        for index in indexes:
+            if index['key'][0][0] == MongoQueryPlanner.STRUCTURE_FIELD:
+                return [list(k) for k in index['key']]
+        return None
+
+    def _get_partial_indexes(self, indexes_info):
+        # the single field indexes filtered on a single structure, by structure ID and field
+        partial_indexes = dict()
+        for name, index in indexes_info.iteritems():
+            partial_filter = index.get('partialFilterExpression', dict())
+            structure_id = partial_filter.get(MongoQueryPlanner.STRUCTURE_FIELD)
+            if len(index['key']) == 1 and len(partial_filter) == 1 and isinstance(structure_id, basestring):
+                partial_indexes.setdefault(structure_id, dict())[index['key'][0][0]] = name
+        return partial_indexes
+
+    def _get_planner_stats_key(self, collection):
+        return self.host, self.port, self.database_name, collection
+
+    def _invalidate_planner_stats(self, collection):
+        MongoDriverPM2._planner_stats.pop(self._get_planner_stats_key(collection), None)
+
+    def _get_planner_stats(self, collection):
+        # the number of records, the structure index and the partial indexes of the collection
+        key = self._get_planner_stats_key(collection)
+        try:
+            timestamp, stats = MongoDriverPM2._planner_stats[key]
+            if time.time() - timestamp < self.PLANNER_STATS_TTL:
+                return stats
+        except KeyError:
+            pass
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(collection)
+        try:
+            collection_records = self.database.command('collstats', collection).get('count', 0)
+        except pymongo.errors.OperationFailure:
+            # the collection doesn't exist yet
+            collection_records = 0
+        indexes_info = self.collection.index_information()
+        stats = (collection_records, self._get_structure_index(indexes_info),
+                 self._get_partial_indexes(indexes_info))
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        MongoDriverPM2._planner_stats[key] = (time.time(), stats)
+        return stats
+
+    def _get_query_planner(self, collection, parallel):
+        collection_records, structure_index, partial_indexes = self._get_planner_stats(collection)
+        return MongoQueryPlanner(collection_records, structure_index, parallel,
+                                 partial_indexes=partial_indexes)
+
+    def _plan_queries(self, queries, ehr_repository, parallel=False, merge_selections=False):
+        """
+        Plan the queries built by :meth:`build_queries` using a
+        :class:`pyehr.ehr.services.dbmanager.drivers.mongo_planner.MongoQueryPlanner`
+        """
+        if not queries:
+            return list()
+        planner = self._get_query_planner(ehr_repository, parallel)
+        if self.index_service:
+            references = self.index_service.get_structures_references(queries.keys())
+        else:
+            references = dict()
+        plan = planner.plan(queries, references, merge_selections)
+        for step in plan:
+            self.logger.debug('Planned %s query for %d structures (%d estimated records)',
+                              step['strategy'], len(step['structures']), step['estimated_records'])
+        return plan
+
+    def build_sub_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                          contains_mapping=None):
+        """
+        Build the sub-queries that must be run in order to execute a query parsed with the
+        :class:`pyehr.aql.parser.Parser` object; sub-queries are planned by a
+        :class:`pyehr.ehr.services.dbmanager.drivers.mongo_planner.MongoQueryPlanner`, assuming
+        that they will be run in parallel.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param contains_mapping: the result of the :meth:`IndexService.map_aql_contains` method for
+                                 query's CONTAINS statement, if None it will be retrieved from the IndexService
+        :type contains_mapping: tuple
+        :return: a list of sub-queries with condition, selection, aliases and hint fields
+        """
+        queries = self.build_queries(query_model, patients_repository, ehr_repository,
+                                     query_params, contains_mapping)
+        return self._plan_queries(queries, ehr_repository, parallel=True)
+
+    def explain_query(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      query_processes=1, workers_pool=None, server_explain=False):
+        """
+        Explain how a query parsed with the :class:`pyehr.aql.parser.Parser` object would be executed
+        by :meth:`execute_query` with the same *query_processes* and *workers_pool*. For each planned
+        sub-query, the chosen strategy (*scan*, *in* or *union*), the structures involved, the number
+        of records estimated using the IndexService's references counters and the index hint are returned.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param server_explain: add to each sub-query the output of MongoDB's explain
+        :type server_explain: bool
+        :return: a dictionary with the number of records in the collection, the index on structure IDs
+                 (None if there is no such index) and the list of planned sub-queries
+        """
+        parallel = query_processes > 1 or bool(workers_pool and workers_pool.is_running)
+        planner = self._get_query_planner(ehr_repository, parallel)
+        queries = self.build_queries(query_model, patients_repository, ehr_repository, query_params)
+        if queries and self.index_service:
+            references = self.index_service.get_structures_references(queries.keys())
+        else:
+            references = dict()
+        plan = planner.plan(queries, references)
+        if server_explain:
+            if self.is_connected:
+                original_collection = self.collection_name
+                close_conn_after_done = False
+            else:
+                close_conn_after_done = True
+            self.connect()
+            self.select_collection(ehr_repository)
+            for step in plan:
+                cursor = self.collection.find(step['condition'], step['selection'])
+                if step['hint']:
+                    cursor = cursor.hint(self._get_hint(step['hint']))
+                step['explain'] = cursor.explain()
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+        return {
+            'collection_records': planner.collection_records,
+            'structure_index': planner.structure_index,
+            'sub_queries': plan
+        }
+
+    def execute_keys_query(self, query_model, patients_repository, ehr_repository, key,
+                           query_params=None, restrict_to=None):
+        """
+        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and return the distinct
+        values of the given *key* for the records matching the query. Only the key field is fetched
+        from the database; if *restrict_to* is given, it is pushed into the query as an $in clause.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param key: the EHR path used as key, *ehr_id.value* or *uid.value*
+        :type key: str
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param restrict_to: if not None, only keys contained in this collection will be returned
+        :return: a set with the matching keys
+        :rtype: set
+        """
+        key_field = self._get_key_field(key)
+        if restrict_to is not None and len(restrict_to) == 0:
+            return set()
+        queries = self.build_queries(query_model, patients_repository, ehr_repository, query_params)
+        conditions = [q['condition'] for q in self._plan_queries(queries, ehr_repository, merge_selections=True)]
+        if not conditions:
+            return set()
+        condition = conditions[0] if len(conditions) == 1 else {'$or': conditions}
+        if restrict_to is not None:
+            condition = {'$and': [condition, {key_field: {'$in': list(restrict_to)}}]}
+        return self._get_keys_by_query(condition, key_field, ehr_repository)
+
+    def _get_keys_by_query(self, condition, key_field, ehr_repository):
+        fields = {'_id': False, key_field: True}
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        keys = set(rec[key_field] for rec in self.get_records_by_query(condition, fields))
+        if close_conn_after_done:
+            self.disconnect()
+        else:
+            self.select_collection(original_collection)
+        return keys
+
+    def execute_structures_keys_query(self, structure_ids, ehr_repository, key):
+        """
+        Return the distinct values of the given *key* for the clinical records with one of the
+        given structures, only the key field is fetched from the database.
+
+        :param structure_ids: a list of structure IDs
+        :type structure_ids: list
+        :param key: the EHR path used as key, *ehr_id.value* or *uid.value*
+        :type key: str
+        :return: a set with the matching keys
+        :rtype: set
+        """
+        key_field = self._get_key_field(key)
+        if not structure_ids:
+            return set()
+        return self._get_keys_by_query(self._get_structures_selector(list(structure_ids)),
+                                       key_field, ehr_repository)
+
+    def execute_query_page(self, query_model, patients_repository, ehr_repository, page_size,
+                           query_params=None, page_token=None):
+        """
+        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and return a single page
+        of results. Records are returned sorted by ID; the *next_page_token* of the returned
+        :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` can be used to
+        retrieve the following page and it is None when there are no more results.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param page_size: the maximum number of results in the page
+        :type page_size: int
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param page_token: the token returned with the previous page or None for the first page
+        :type page_token: str
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
+                 containing a page of results for the given query
+        """
+        # union plans depend on the number of records, they could change from a page to
+        # the following one and make page tokens useless
+        queries = self._plan_queries(self.build_queries(query_model, patients_repository, ehr_repository,
+                                                        query_params),
+                                     ehr_repository, parallel=False)
+        return self._find_page_by_aql_queries(queries, ehr_repository, page_size, page_token)
+
     def execute_query(self, query_model, patients_repository, ehr_repository,
-                      query_params=None, count_only=False, query_processes=1):
+                      query_params=None, count_only=False, query_processes=1, workers_pool=None):
         """
         Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
         as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
@@ -1006,14 +1503,18 @@ class MongoDriverPM2(DriverInterface):
         :type: :class:`pyehr.aql.parser.QueryModel`
         :param query_params: a dictionary containing query's parameters and their values
         :type: dictionary
+        :param workers_pool: a running :class:`pyehr.ehr.services.dbmanager.querymanager.workers_pool.QueryWorkersPool`
+                             that will be used to run the sub-queries, if None query_processes will be used
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
                  containing results for the given query
         """
         queries = self.build_queries(query_model, patients_repository, ehr_repository,
                                      query_params)
-        aggregated_queries = self._aggregate_queries(queries)
         if not count_only:
-            return self._find_by_aql_queries(aggregated_queries, ehr_repository, query_processes)
+            parallel = query_processes > 1 or bool(workers_pool and workers_pool.is_running)
+            return self._find_by_aql_queries(self._plan_queries(queries, ehr_repository, parallel),
+                                             ehr_repository, query_processes, workers_pool)
         else:
-            return self._count_by_aql_queries([aq['condition'] for aq in aggregated_queries],
+            planned_queries = self._plan_queries(queries, ehr_repository, merge_selections=True)
+            return self._count_by_aql_queries([pq['condition'] for pq in planned_queries],
                                               ehr_repository)
@@ -6,7 +6,9 @@ from multiprocessing import Pool
 
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
     ResultColumnDef, ResultRow
+from pyehr.ehr.services.dbmanager.querymanager.query_control import QueryControl
 from pyehr.ehr.services.dbmanager.errors import *
+from pyehr.utils import decode_dict
 
 try:
     import simplejson as json
@@ -17,23 +19,25 @@ except ImportError:
 class MultiprocessQueryRunnerPM3(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, aql_query_mode='find', deadline=None):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.aql_query_mode = aql_query_mode
+        self.deadline = deadline
 
     def __call__(self, query_description):
         driver_instance = MongoDriverPM3(
             self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
-        )
-        results = driver_instance._run_aql_query(
-            query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
+            self.port, self.user, self.passwd,
+            aql_query_mode=self.aql_query_mode
         )
+        if self.deadline is not None:
+            driver_instance.query_control = QueryControl(deadline=self.deadline)
+        results = driver_instance._run_sub_query(query_description, self.collection_name)
         return results
 
 class MongoDriverPM3(MongoDriverPM2):
@@ -115,6 +119,43 @@ class MongoDriverPM3(MongoDriverPM2):
             # empty bulk insert
             return [], [records_map[x] for x in duplicated_ids]
 
+    def add_records_unordered(self, records):
+        """
+        Save a list of records within MongoDB using an unordered bulk write: records that can't be
+        saved (i.e. records with an ID already in use) don't stop the other ones and no query is
+        used to look for duplicated IDs in advance. IDs must be unique within the given list.
+
+        :param records: the list of records that is going to be saved
+        :type records: list
+        :return: a list of records' IDs and a dictionary mapping the IDs of the records that were
+          not saved to the related error messages
+        """
+        if not records:
+            return [], {}
+        self._check_batch(records, '_id')
+        self._check_connection()
+        try:
+            self.collection.insert_many(records, ordered=False)
+            write_errors = []
+        except pymongo.errors.BulkWriteError, bwe:
+            write_errors = bwe.details['writeErrors']
+        return self._split_bulk_write_results(records, write_errors)
+
+
+    def get_records_by_pipeline(self, pipeline):
+        """
+        Retrieve the documents produced by the given aggregation pipeline
+
+        :param pipeline: the aggregation pipeline (in MongoDB syntax)
+        :type pipeline: list
+        :return: a generator with the documents produced by the pipeline
+        """
+        self._check_connection()
+        try:
+            cursor = self.collection.aggregate(pipeline, **self._get_max_time_option())
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError('Query exceeded its deadline')
+        return self._iter_records(cursor)
 
     def _update_record(self, record_id, update_condition):
         """
@@ -180,24 +221,35 @@ class MongoDriverPM3(MongoDriverPM2):
         self.collection.replace_one({"_id" : record_id}, new_record)
         return last_update
 
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
-        if len(queries) > 1:
-            queries = self._aggregate_queries_by_selection(queries)
+    def _find_by_aql_queries(self, queries, ehr_repository, query_processes, workers_pool=None):
+        if workers_pool and workers_pool.is_running and len(queries) > 1:
+            return workers_pool.run_queries(queries, ehr_repository, self.query_control)
         total_results = ResultSet()
         if query_processes == 1 or len(queries) == 1:
             for query in queries:
-                results = self._run_aql_query(query=query['condition'], fields=query['selection'],
-                                              aliases=query['aliases'], collection=ehr_repository)
-                total_results.extend(results)
+                self._check_query_control()
+                total_results.extend(self._run_sub_query(query, ehr_repository))
         else:
+            deadline = self.query_control.deadline if self.query_control else None
             queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
-                MultiprocessQueryRunnerPM3(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
-            )
-            for r in results:
-                total_results.extend(r)
+            try:
+                results = queries_pool.imap_unordered(
+                    MultiprocessQueryRunnerPM3(self.host, self.database_name,
+                                            ehr_repository, self.port, self.user, self.passwd,
+                                            self.aql_query_mode, deadline),
+                    queries
+                )
+                for r in results:
+                    self._check_query_control()
+                    total_results.extend(r)
+            except:
+                # the query timed out or was cancelled, don't wait for the other sub-queries
+                queries_pool.terminate()
+                raise
+            else:
+                queries_pool.close()
+            finally:
+                queries_pool.join()
         return total_results
 
     def count_records_by_query(self, selector):
@@ -209,4 +261,7 @@ class MongoDriverPM3(MongoDriverPM2):
         :rtype: int
         """
         self._check_connection()
-        return self.collection.count(selector)
\ No newline at end of file
+        try:
+            return self.collection.count(selector, **self._get_max_time_option())
+        except pymongo.errors.ExecutionTimeout:
+            raise QueryTimeoutError('Query exceeded its deadline')
\ No newline at end of file
@@ -84,3 +84,15 @@ class OperationNotAllowedError(Exception):
 
 class QueryCreationException(Exception):
     pass
+
+
+class InvalidPageTokenError(Exception):
+    pass
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class QueryCancelledError(Exception):
+    pass
\ No newline at end of file
@@ -1,7 +1,20 @@
 from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils import get_logger
 from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.ehr.services.dbmanager.querymanager.workers_pool import QueryWorkersPool, QueryThreadsPool
+from pyehr.ehr.services.dbmanager.querymanager.results_cache import ResultsCache
+from pyehr.ehr.services.dbmanager.querymanager.bitmap_index import PatientsBitmapIndex
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
+from pyehr.ehr.services.dbmanager.querymanager.query_control import QueryControl
 from pyehr.aql.parser import Parser
+from copy import deepcopy
+from hashlib import md5
+from threading import Lock
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 
 class QueryManager(object):
@@ -12,7 +25,7 @@ class QueryManager(object):
     def __init__(self, driver, host, database, versioning_database=None,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None, port=None, user=None,
-                 passwd=None, logger=None):
+                 passwd=None, logger=None, driver_options=None):
         self.driver = driver
         self.host = host
         self.database = database
@@ -24,6 +37,12 @@ class QueryManager(object):
         self.user = user
         self.passwd = passwd
         self.index_service = None
+        self.driver_options = driver_options
+        self.workers_pool = None
+        self.results_cache = None
+        self.bitmap_index = None
+        self.running_queries = dict()
+        self.running_queries_lock = Lock()
         self.logger = logger or get_logger('query_manager')
 
     def _get_drivers_factory(self, repository):
@@ -36,7 +55,8 @@ class QueryManager(object):
             user=self.user,
             passwd=self.passwd,
             index_service=self.index_service,
-            logger=self.logger
+            logger=self.logger,
+            driver_options=self.driver_options
         )
 
     def set_index_service(self, url, database, user, passwd):
@@ -54,29 +74,431 @@ class QueryManager(object):
         """
         self.index_service = IndexService(database, url, user, passwd, self.logger)
 
-    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1):
+    def set_results_cache(self, max_size):
+        """
+        Enable a :class:`pyehr.ehr.services.dbmanager.querymanager.results_cache.ResultsCache` for
+        the current :class:`QueryManager`. Cached results are invalidated when one of the structures
+        involved in the query is modified, this requires an :class:`IndexService`: the cache is not
+        used until one is set with :meth:`set_index_service`.
+        If *max_size* is 0 or None, the cache is disabled.
+
+        :param max_size: the maximum amount of memory, in bytes, used to store results
+        :type max_size: int
+        """
+        if max_size:
+            self.results_cache = ResultsCache(max_size, self.logger)
+        else:
+            self.results_cache = None
+
+    def set_bitmap_index(self, max_size):
+        """
+        Enable a :class:`pyehr.ehr.services.dbmanager.querymanager.bitmap_index.PatientsBitmapIndex`
+        for the current :class:`QueryManager`, used by :meth:`get_patients_bitmap`. In order to keep
+        structure bitmaps up to date incrementally, pass the index to the
+        :class:`pyehr.ehr.services.dbmanager.dbservices.DBServices` used to save records in this process.
+        If *max_size* is 0 or None, the index is disabled.
+
+        :param max_size: the maximum amount of memory, in bytes, used to store compressed bitmaps
+        :type max_size: int
+        """
+        if max_size:
+            self.bitmap_index = PatientsBitmapIndex(max_size, self.logger)
+        else:
+            self.bitmap_index = None
+
+    def _results_cache_enabled(self):
+        # cached results can't be invalidated without an index service
+        return self.results_cache is not None and self.index_service is not None
+
+    def _lookup_results_cache(self, query, query_model, query_params, count_only, index_service):
+        cache_key = ResultsCache.get_key(query, query_params, count_only)
+        # generations must be retrieved before running the query, if a record
+        # is modified while the query is running, results will be invalidated
+        generations = index_service.get_structures_generations(query_model.location.containers)
+        return cache_key, generations, self.results_cache.get(cache_key, generations)
+
+    def _normalize_query_params(self, query_params):
+        if query_params:
+            if not isinstance(query_params, dict):
+                raise ValueError('query_params field must be a dictionary')
+            # add the $ character to the keys in query_params that don't begin with it
+            query_params = dict(('$%s' % k if not k.startswith('$') else k, v)
+                                for k, v in query_params.iteritems())
+        return query_params
+
+    def start_workers_pool(self, processes):
+        """
+        Start a :class:`pyehr.ehr.services.dbmanager.querymanager.workers_pool.QueryWorkersPool`
+        that will be used to run AQL queries. Worker processes are kept alive (with an open connection
+        to the database) until the :meth:`stop_workers_pool` method is called.
+
+        :param processes: the number of worker processes
+        :type processes: int
+        """
+        if self.workers_pool is None:
+            self.workers_pool = QueryWorkersPool(self.driver, self.host, self.database,
+                                                 self.ehr_repository, self.port, self.user,
+                                                 self.passwd, processes, self.logger,
+                                                 self.driver_options)
+        self.workers_pool.start()
+
+    def stop_workers_pool(self, wait=True):
+        """
+        Stop the workers pool started with the :meth:`start_workers_pool` method. If *wait* is True,
+        wait for running queries to complete, otherwise worker processes will be terminated immediately.
+
+        :param wait: wait for running queries before stopping the pool
+        :type wait: bool
+        """
+        if self.workers_pool is not None:
+            if wait:
+                self.workers_pool.shutdown()
+            else:
+                self.workers_pool.terminate()
+            self.workers_pool = None
+
+    def _register_query(self, query_id, timeout):
+        if query_id is None and timeout is None:
+            return None
+        query_control = QueryControl(query_id, timeout)
+        with self.running_queries_lock:
+            if query_control.query_id in self.running_queries:
+                raise ValueError('A query with ID %s is already running' % query_control.query_id)
+            self.running_queries[query_control.query_id] = query_control
+        return query_control
+
+    def _unregister_query(self, query_control):
+        if query_control is not None:
+            with self.running_queries_lock:
+                self.running_queries.pop(query_control.query_id, None)
+
+    def cancel_query(self, query_id):
+        """
+        Cancel a query started with the given *query_id*. The query stops as soon as the driver
+        checks its state and raises a :class:`pyehr.ehr.services.dbmanager.errors.QueryCancelledError`.
+
+        :param query_id: the ID of the query
+        :type query_id: str
+        :return: True if the query was running, False otherwise
+        :rtype: bool
+        """
+        with self.running_queries_lock:
+            query_control = self.running_queries.get(query_id)
+        if query_control is None:
+            return False
+        self.logger.debug('Cancelling query %s', query_id)
+        query_control.cancel()
+        return True
+
+    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1,
+                          page_size=None, page_token=None, timeout=None, query_id=None):
         """
         Execute an AQL query and return a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
         object that maps the obtained results.
         If the query has one or more parameters, they will be passed using query_params field.
+        If a *page_size* is given, only a page of results is returned; the *next_page_token* attribute
+        of the ResultSet can be passed as *page_token* to retrieve the following page and it is None
+        when the last page is reached. Paginated queries bypass the results cache.
+        If a *timeout* is given, the query is stopped with a :class:`pyehr.ehr.services.dbmanager.errors.QueryTimeoutError`
+        when its deadline expires (the time left is passed to the database as well); if a *query_id* is
+        given, the query can be stopped using the :meth:`cancel_query` method.
 
         :param query: an AQL query
         :type query: str
         :param query_params: a dictionary containing query parameters as keys and their values
         :type query_params: dict
+        :param count_only: only return the number of records matching the query
+        :type count_only: bool
+        :param query_processes: the number of processes used to run the query, ignored if a workers pool
+                                was started using the :meth:`start_workers_pool` method
+        :type query_processes: int
+        :param page_size: the maximum number of results returned, None to get all the results
+        :type page_size: int
+        :param page_token: the token returned with the previous page of results
+        :type page_token: str
+        :param timeout: the maximum execution time of the query, in seconds
+        :type timeout: float
+        :param query_id: the ID used to cancel the query
+        :type query_id: str
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
         """
-        if query_params:
-            if not isinstance(query_params, dict):
-                raise ValueError('query_params field must be a dictionary')
-            # add the $ character to the keys in query_params that don't begin with it
-            query_params = dict(('$%s' % k if not k.startswith('$') else k, v)
-                                for k, v in query_params.iteritems())
+        query_params = self._normalize_query_params(query_params)
         parser = Parser()
         query_model = parser.parse(query)
+        use_cache = self._results_cache_enabled() and (page_size is None or count_only)
+        if use_cache:
+            cache_key, generations, cached_results = self._lookup_results_cache(query, query_model, query_params,
+                                                                                count_only, self.index_service)
+            if cached_results is not None:
+                return cached_results
+        query_control = self._register_query(query_id, timeout)
+        try:
+            if page_size is not None and not count_only:
+                return self._execute_aql_query_page(query_model, query_params, page_size, page_token,
+                                                    query_control)
+            drf = self._get_drivers_factory(self.ehr_repository)
+            with drf.get_driver() as driver:
+                driver.query_control = query_control
+                # the count_only field will be retrieved parsing AQL query
+                results_set = driver.execute_query(query_model, self.patients_repository, self.ehr_repository,
+                                                   query_params, count_only, query_processes,
+                                                   self.workers_pool)
+        finally:
+            self._unregister_query(query_control)
+        if use_cache:
+            self.results_cache.put(cache_key, generations, results_set)
+        return results_set
+
+    def explain_aql_query(self, query, query_params=None, query_processes=1):
+        """
+        Explain how an AQL query would be executed by :meth:`execute_aql_query` using the
+        same *query_processes*, without running it. The content of the explanation depends on
+        the driver, the MongoDB driver returns the strategy chosen for each sub-query.
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :param query_processes: the number of processes used to run the query
+        :type query_processes: int
+        :return: a dictionary describing the sub-queries that would be executed
+        :rtype: dict
+        """
+        query_params = self._normalize_query_params(query_params)
+        query_model = Parser().parse(query)
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            return driver.explain_query(query_model, self.patients_repository, self.ehr_repository,
+                                        query_params, query_processes, self.workers_pool)
+
+    def ensure_query_indexes(self, query, query_params=None):
+        """
+        Create the indexes that speed up the given AQL query, this should be used for frequently
+        executed queries. Only the MongoDB driver creates indexes, partial indexes filtered by structure
+        ID are created for the fields used in the WHERE statement.
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :return: the names of the created indexes
+        :rtype: list
+        """
+        query_params = self._normalize_query_params(query_params)
+        query_model = Parser().parse(query)
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            return driver.ensure_query_indexes(query_model, self.patients_repository, self.ehr_repository,
+                                               query_params)
+
+    def _get_index_service(self):
+        return self.index_service
+
+    def _get_sub_query_hash(self, sub_query):
+        sub_query_hash = md5()
+        sub_query_hash.update(json.dumps(sub_query, sort_keys=True))
+        return sub_query_hash.hexdigest()
+
+    def _run_sub_queries(self, sub_queries, max_threads):
+        if self.workers_pool and self.workers_pool.is_running:
+            return self.workers_pool.map_queries(sub_queries, self.ehr_repository)
+        threads_pool = QueryThreadsPool(self.driver, self.host, self.database, self.ehr_repository,
+                                        self.port, self.user, self.passwd,
+                                        min(max_threads, len(sub_queries)), self.logger,
+                                        self.driver_options)
+        threads_pool.start()
+        try:
+            return threads_pool.map_queries(sub_queries, self.ehr_repository)
+        finally:
+            threads_pool.shutdown()
+
+    def plan_many(self, queries, query_params=None, errors=None):
+        """
+        Plan a batch of AQL queries without running them: the CONTAINS statements shared by more
+        queries are resolved only once using the :class:`IndexService` and each query is mapped to
+        the hashes of its sub-queries, identical sub-queries are returned only once.
+        If *errors* is a dictionary, queries that can't be planned are reported in it by label
+        instead of raising an exception.
+
+        :param queries: a dictionary with labels as keys and AQL queries as values
+        :type queries: dict
+        :param query_params: a dictionary with queries labels as keys and the parameters of the
+                             related queries as values
+        :type query_params: dict
+        :param errors: a dictionary used to collect planning errors by label
+        :type errors: dict
+        :return: a tuple with the cached results by label, the distinct sub-queries by hash, the
+                 sub-queries hashes of each label and the results cache entries by label
+        """
+        query_params = query_params or dict()
+        index_service = self._get_index_service()
+        parser = Parser()
+        results = dict()
+        contains_map = dict()
+        generations_map = dict()
+        sub_queries = dict()
+        labels_map = dict()
+        cache_entries = dict()
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            driver.index_service = index_service
+            for label, query in queries.iteritems():
+                try:
+                    params = self._normalize_query_params(query_params.get(label))
+                    query_model = parser.parse(query)
+                    containers = query_model.location.containers
+                    contains_key = index_service.get_contains_key(containers)
+                    if self._results_cache_enabled():
+                        if contains_key not in generations_map:
+                            generations_map[contains_key] = index_service.get_structures_generations(containers)
+                        cache_key = ResultsCache.get_key(query, params)
+                        cached_results = self.results_cache.get(cache_key, generations_map[contains_key])
+                        if cached_results is not None:
+                            results[label] = cached_results
+                            continue
+                        cache_entries[label] = (cache_key, generations_map[contains_key])
+                    if contains_key not in contains_map:
+                        contains_map[contains_key] = index_service.map_aql_contains(containers)
+                    # queries built by the driver may modify the mapping, give them their own copy
+                    label_sub_queries = driver.build_sub_queries(query_model, self.patients_repository,
+                                                                 self.ehr_repository, params,
+                                                                 deepcopy(contains_map[contains_key]))
+                except Exception, e:
+                    if errors is None:
+                        raise
+                    self.logger.error('Unable to plan query %s: %s', label, e)
+                    errors[label] = str(e)
+                    cache_entries.pop(label, None)
+                    continue
+                labels_map[label] = list()
+                for sq in label_sub_queries:
+                    sq_hash = self._get_sub_query_hash(sq)
+                    sub_queries.setdefault(sq_hash, sq)
+                    labels_map[label].append(sq_hash)
+        self.logger.debug('%d queries mapped to %d distinct sub-queries (%d CONTAINS statements)',
+                          len(labels_map), len(sub_queries), len(contains_map))
+        return results, sub_queries, labels_map, cache_entries
+
+    def execute_many(self, queries, query_params=None, max_threads=10):
+        """
+        Execute a batch of AQL queries and return their results by label. Queries are planned
+        together using :meth:`plan_many`, identical sub-queries are executed only once and all the
+        sub-queries are run by a bounded pool of threads (or by the workers pool started with
+        :meth:`start_workers_pool`, if available).
+
+        :param queries: a dictionary with labels as keys and AQL queries as values
+        :type queries: dict
+        :param query_params: a dictionary with queries labels as keys and the parameters of the
+                             related queries as values
+        :type query_params: dict
+        :param max_threads: the maximum number of threads used to run the sub-queries
+        :type max_threads: int
+        :return: a dictionary with labels as keys and
+                 :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` objects as values
+        """
+        if max_threads < 1:
+            raise ValueError('max_threads must be an integer greater than 0')
+        results, sub_queries, labels_map, cache_entries = self.plan_many(queries, query_params)
+        sub_queries_results = dict()
+        if sub_queries:
+            sub_queries_hashes = sub_queries.keys()
+            sub_queries_results = dict(zip(sub_queries_hashes,
+                                           self._run_sub_queries([sub_queries[h] for h in sub_queries_hashes],
+                                                                 max_threads)))
+        for label, sub_queries_hashes in labels_map.iteritems():
+            results_set = ResultSet()
+            for sq_hash in sub_queries_hashes:
+                results_set.extend(sub_queries_results[sq_hash])
+            results[label] = results_set
+            if label in cache_entries:
+                self.results_cache.put(cache_entries[label][0], cache_entries[label][1], results_set)
+        return results
+
+    def execute_aql_keys_query(self, query, key='ehr_id.value', query_params=None, restrict_to=None):
+        """
+        Execute an AQL query and only return the distinct values of the given *key* for the records
+        matching the query, without retrieving the fields listed in the SELECT statement.
+        If *restrict_to* is given, keys not contained in it are filtered out by the database.
+
+        :param query: an AQL query
+        :type query: str
+        :param key: the EHR level value used as key, *ehr_id.value* (patients) or *uid.value* (clinical records)
+        :type key: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :param restrict_to: a collection of keys used to filter the results
+        :return: a set with the matching keys
+        :rtype: set
+        """
+        query_params = self._normalize_query_params(query_params)
+        query_model = Parser().parse(query)
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            return driver.execute_keys_query(query_model, self.patients_repository, self.ehr_repository,
+                                             key, query_params, restrict_to)
+
+    def _get_structures_bitmap(self, driver, generations):
+        bitmap = 0
+        for structure_id, generation in generations.iteritems():
+            key = self.bitmap_index.get_structure_key(structure_id)
+            structure_bitmap = self.bitmap_index.get(key, {structure_id: generation})
+            if structure_bitmap is None:
+                patients = driver.execute_structures_keys_query([structure_id], self.ehr_repository,
+                                                                'ehr_id.value')
+                structure_bitmap = self.bitmap_index.from_patients(patients)
+                self.bitmap_index.put(key, {structure_id: generation}, structure_bitmap)
+            bitmap |= structure_bitmap
+        return bitmap
+
+    def get_patients_bitmap(self, query, query_params=None):
+        """
+        Get the bitmap of the patients having at least one clinical record matching the given AQL query.
+        Queries without a WHERE statement and without EHR predicates are resolved combining the bitmaps
+        of the structures matching the CONTAINS statement, the other ones are cached by query.
+        Bitmaps can be combined using bitwise operators and converted to patient IDs with
+        :meth:`get_patients`, this requires a bitmap index enabled with :meth:`set_bitmap_index`.
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :return: the patients bitmap, as a non negative integer
+        """
+        if self.bitmap_index is None:
+            raise RuntimeError('patients bitmap index is not enabled')
+        query_params = self._normalize_query_params(query_params)
+        query_model = Parser().parse(query)
+        index_service = self._get_index_service()
+        generations = index_service.get_structures_generations(query_model.location.containers)
+        drf = self._get_drivers_factory(self.ehr_repository)
+        if query_model.condition is None and not query_model.location.class_expression.predicate:
+            with drf.get_driver() as driver:
+                return self._get_structures_bitmap(driver, generations)
+        key = self.bitmap_index.get_query_key(query, query_params)
+        bitmap = self.bitmap_index.get(key, generations)
+        if bitmap is None:
+            with drf.get_driver() as driver:
+                driver.index_service = index_service
+                patients = driver.execute_keys_query(query_model, self.patients_repository, self.ehr_repository,
+                                                     'ehr_id.value', query_params, None)
+            bitmap = self.bitmap_index.from_patients(patients)
+            self.bitmap_index.put(key, generations, bitmap)
+        return bitmap
+
+    def get_patients(self, bitmap):
+        """
+        Get the IDs of the patients mapped by a bitmap obtained with :meth:`get_patients_bitmap`
+
+        :param bitmap: a patients bitmap
+        :return: a set with patient IDs
+        """
+        if self.bitmap_index is None:
+            raise RuntimeError('patients bitmap index is not enabled')
+        return set(self.bitmap_index.to_patients(bitmap))
+
+    def _execute_aql_query_page(self, query_model, query_params, page_size, page_token, query_control=None):
         drf = self._get_drivers_factory(self.ehr_repository)
         with drf.get_driver() as driver:
-            # the count_only field will be retrieved parsing AQL query
-            results_set = driver.execute_query(query_model, self.patients_repository, self.ehr_repository,
-                                               query_params, count_only, query_processes)
-        return results_set
\ No newline at end of file
+            driver.query_control = query_control
+            return driver.execute_query_page(query_model, self.patients_repository, self.ehr_repository,
+                                             page_size, query_params, page_token)
\ No newline at end of file
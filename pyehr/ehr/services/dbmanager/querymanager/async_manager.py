@@ -0,0 +1,205 @@
+from multiprocessing.pool import ThreadPool
+from threading import local
+
+from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.ehr.services.dbmanager.querymanager.workers_pool import QueryThreadsPool
+from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.aql.parser import Parser
+
+
+class AsyncQueryManager(QueryManager):
+    """
+    A :class:`QueryManager` that runs AQL queries in the background. Queries are submitted using
+    the :meth:`execute_aql_query_async` method, that returns immediately, and are executed by a pool
+    of threads; sub-queries are fanned out to a second pool of threads (or to the process based pool
+    started with :meth:`start_workers_pool`, if available). Each thread keeps its own connection to
+    the database and its own connection to the :class:`IndexService`, so no connection is shared
+    among threads.
+
+    The manager must be started with :meth:`start` before submitting queries and stopped with
+    :meth:`stop` when it is no longer needed.
+    """
+
+    def __init__(self, driver, host, database, versioning_database=None,
+                 patients_repository=None, ehr_repository=None,
+                 ehr_versioning_repository=None, port=None, user=None,
+                 passwd=None, logger=None, driver_options=None,
+                 max_concurrent_queries=100, query_threads=10):
+        super(AsyncQueryManager, self).__init__(driver, host, database, versioning_database,
+                                                patients_repository, ehr_repository,
+                                                ehr_versioning_repository, port, user,
+                                                passwd, logger, driver_options)
+        self.max_concurrent_queries = max_concurrent_queries
+        self.query_threads = query_threads
+        self.queries_pool = None
+        self.threads_pool = None
+        self._local = local()
+
+    @property
+    def is_running(self):
+        return self.queries_pool is not None
+
+    def start(self):
+        """
+        Start the threads used to run the queries, if the manager is already running
+        nothing happens
+        """
+        if not self.is_running:
+            self.logger.debug('starting async query manager (%d concurrent queries, %d query threads)',
+                              self.max_concurrent_queries, self.query_threads)
+            self.threads_pool = QueryThreadsPool(self.driver, self.host, self.database,
+                                                 self.ehr_repository, self.port, self.user,
+                                                 self.passwd, self.query_threads, self.logger,
+                                                 self.driver_options)
+            self.threads_pool.start()
+            self.queries_pool = ThreadPool(self.max_concurrent_queries)
+
+    def stop(self, wait=True):
+        """
+        Stop the threads used to run the queries. If *wait* is True, wait for submitted queries
+        to complete, otherwise pending queries will be discarded.
+
+        :param wait: wait for submitted queries before stopping the manager
+        :type wait: bool
+        """
+        if self.is_running:
+            self.logger.debug('stopping async query manager')
+            if wait:
+                self.queries_pool.close()
+            else:
+                self.queries_pool.terminate()
+            self.queries_pool.join()
+            self.queries_pool = None
+            if wait:
+                self.threads_pool.shutdown()
+            else:
+                self.threads_pool.terminate()
+            self.threads_pool = None
+
+    def _get_index_service(self):
+        # IndexService objects keep a reference to the BaseX client, give each thread its own instance
+        index_service = getattr(self._local, 'index_service', None)
+        if index_service is None and self.index_service is not None:
+            index_service = IndexService(self.index_service.db, self.index_service.url,
+                                         self.index_service.user, self.index_service.passwd,
+                                         self.logger)
+            self._local.index_service = index_service
+        return index_service
+
+    def _run_sub_queries(self, sub_queries, max_threads):
+        if not self.is_running:
+            return super(AsyncQueryManager, self)._run_sub_queries(sub_queries, max_threads)
+        if self.workers_pool and self.workers_pool.is_running:
+            return self.workers_pool.map_queries(sub_queries, self.ehr_repository)
+        return self.threads_pool.map_queries(sub_queries, self.ehr_repository)
+
+    def _execute_aql_query(self, query, query_params, count_only, query_control=None):
+        try:
+            query_model = Parser().parse(query)
+            index_service = self._get_index_service()
+            use_cache = self._results_cache_enabled()
+            if use_cache:
+                cache_key, generations, cached_results = self._lookup_results_cache(query, query_model,
+                                                                                    query_params, count_only,
+                                                                                    index_service)
+                if cached_results is not None:
+                    return cached_results
+            driver = self.threads_pool.get_driver()
+            driver.index_service = index_service
+            if self.workers_pool and self.workers_pool.is_running:
+                sub_queries_pool = self.workers_pool
+            else:
+                sub_queries_pool = self.threads_pool
+            # drivers are reused by the following queries, reset the query control when done
+            driver.query_control = query_control
+            try:
+                results = driver.execute_query(query_model, self.patients_repository, self.ehr_repository,
+                                               query_params, count_only, 1, sub_queries_pool)
+            finally:
+                driver.query_control = None
+        finally:
+            self._unregister_query(query_control)
+        if use_cache:
+            self.results_cache.put(cache_key, generations, results)
+        return results
+
+    def _execute_aql_query_page(self, query_model, query_params, page_size, page_token, query_control=None):
+        if not self.is_running:
+            return super(AsyncQueryManager, self)._execute_aql_query_page(query_model, query_params,
+                                                                          page_size, page_token, query_control)
+        # pages are bounded, they are retrieved directly by the calling thread
+        driver = self.threads_pool.get_driver()
+        driver.index_service = self._get_index_service()
+        driver.query_control = query_control
+        try:
+            return driver.execute_query_page(query_model, self.patients_repository, self.ehr_repository,
+                                             page_size, query_params, page_token)
+        finally:
+            driver.query_control = None
+
+    def execute_aql_query_async(self, query, query_params=None, count_only=False, callback=None,
+                                timeout=None, query_id=None):
+        """
+        Submit an AQL query and return immediately. The returned object can be used to wait for the
+        query to complete and to retrieve the results using its *get* method, that accepts an optional
+        timeout and raises the exception occurred while running the query, if any.
+        If a *callback* is given, it will be called with the results as soon as they are available.
+        *timeout* and *query_id* work as in :meth:`QueryManager.execute_aql_query`, the deadline
+        includes the time spent waiting for a free thread.
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :param count_only: only return the number of records matching the query
+        :type count_only: bool
+        :param callback: a callable that will receive query's results
+        :param timeout: the maximum execution time of the query, in seconds
+        :type timeout: float
+        :param query_id: the ID used to cancel the query
+        :type query_id: str
+        :return: a :class:`multiprocessing.pool.AsyncResult` object
+        """
+        if not self.is_running:
+            raise RuntimeError('async query manager is not running')
+        query_params = self._normalize_query_params(query_params)
+        query_control = self._register_query(query_id, timeout)
+        try:
+            return self.queries_pool.apply_async(self._execute_aql_query,
+                                                 (query, query_params, count_only, query_control),
+                                                 callback=callback)
+        except:
+            self._unregister_query(query_control)
+            raise
+
+    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1,
+                          page_size=None, page_token=None, timeout=None, query_id=None):
+        """
+        Execute an AQL query and wait for the results. If the manager is running, the query is
+        executed using manager's threads and *query_processes* is ignored. Pagination works as in
+        :meth:`QueryManager.execute_aql_query`.
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: a dictionary containing query parameters as keys and their values
+        :type query_params: dict
+        :param count_only: only return the number of records matching the query
+        :type count_only: bool
+        :param query_processes: the number of processes used to run the query if the manager is not running
+        :type query_processes: int
+        :param page_size: the maximum number of results returned, None to get all the results
+        :type page_size: int
+        :param page_token: the token returned with the previous page of results
+        :type page_token: str
+        :param timeout: the maximum execution time of the query, in seconds
+        :type timeout: float
+        :param query_id: the ID used to cancel the query
+        :type query_id: str
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
+        """
+        if not self.is_running or (page_size is not None and not count_only):
+            return super(AsyncQueryManager, self).execute_aql_query(query, query_params, count_only,
+                                                                    query_processes, page_size, page_token,
+                                                                    timeout, query_id)
+        return self.execute_aql_query_async(query, query_params, count_only,
+                                            timeout=timeout, query_id=query_id).get()
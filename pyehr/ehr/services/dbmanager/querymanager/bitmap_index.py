@@ -0,0 +1,155 @@
+import zlib
+from binascii import hexlify, unhexlify
+from threading import Lock
+
+from pyehr.ehr.services.dbmanager.querymanager.results_cache import ResultsCache
+
+
+def bitmap_to_bytes(bitmap):
+    """
+    Convert a bitmap, stored as a non negative integer, to a little endian string of bytes
+    """
+    if not bitmap:
+        return ''
+    hex_bitmap = '%x' % bitmap
+    if len(hex_bitmap) % 2:
+        hex_bitmap = '0' + hex_bitmap
+    return unhexlify(hex_bitmap)[::-1]
+
+
+def bytes_to_bitmap(data):
+    """
+    Convert a little endian string of bytes to a bitmap, see :func:`bitmap_to_bytes`
+    """
+    if not data:
+        return 0
+    return long(hexlify(data[::-1]), 16)
+
+
+class PatientsDictionary(object):
+    """
+    Map patient IDs to dense integers, the integers are used as bit positions in patients
+    bitmaps. Integers are assigned in order of appearance and never reused.
+    """
+
+    def __init__(self):
+        self.indices = dict()
+        self.patients = list()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.patients)
+
+    def get_index(self, patient_id):
+        try:
+            return self.indices[patient_id]
+        except KeyError:
+            with self.lock:
+                if patient_id not in self.indices:
+                    self.indices[patient_id] = len(self.patients)
+                    self.patients.append(patient_id)
+                return self.indices[patient_id]
+
+    def to_bitmap(self, patient_ids):
+        """
+        Build the bitmap for the given patient IDs
+
+        :param patient_ids: a collection of patient IDs
+        :return: the bitmap, as a non negative integer
+        """
+        indices = [self.get_index(pid) for pid in patient_ids]
+        if not indices:
+            return 0
+        # set bits on a byte array and convert it at the end, setting bits directly
+        # on a big integer would create a new integer for each patient
+        data = bytearray((max(indices) >> 3) + 1)
+        for i in indices:
+            data[i >> 3] |= 1 << (i & 7)
+        return bytes_to_bitmap(str(data))
+
+    def to_patient_ids(self, bitmap):
+        """
+        Get the patient IDs mapped by the given bitmap
+
+        :param bitmap: a bitmap, as a non negative integer
+        :return: a list of patient IDs
+        """
+        patient_ids = list()
+        for byte_index, byte in enumerate(bytearray(bitmap_to_bytes(bitmap))):
+            if byte:
+                for bit in xrange(8):
+                    if byte & (1 << bit):
+                        patient_ids.append(self.patients[(byte_index << 3) + bit])
+        return patient_ids
+
+
+class PatientsBitmapIndex(ResultsCache):
+    """
+    A memory bounded, LRU cache of patients bitmaps. A bitmap maps the set of patients that have
+    at least one clinical record with a given structure (a *structure bitmap*) or that have records
+    matching a given AQL query (a *query bitmap*); set operations on patients are performed with
+    bitwise operations on bitmaps. Bitmaps are kept compressed and, like cached results, they are tagged
+    with the write generations of the structures they involve.
+
+    Structure bitmaps can be updated incrementally using the :meth:`add_patient` and
+    :meth:`add_patients` methods when new clinical records are saved. Bit positions are assigned by a :class:`PatientsDictionary`
+    owned by the index, so bitmaps are only meaningful within the process that built them.
+    """
+
+    def __init__(self, max_size, logger=None):
+        super(PatientsBitmapIndex, self).__init__(max_size, logger)
+        self.dictionary = PatientsDictionary()
+
+    @staticmethod
+    def get_structure_key(structure_id):
+        return 'structure', structure_id
+
+    @staticmethod
+    def get_query_key(query, query_params=None):
+        return ResultsCache.get_key(query, query_params)
+
+    def _serialize(self, bitmap):
+        return zlib.compress(bitmap_to_bytes(bitmap))
+
+    def _deserialize(self, data):
+        return bytes_to_bitmap(zlib.decompress(data))
+
+    def from_patients(self, patient_ids):
+        return self.dictionary.to_bitmap(patient_ids)
+
+    def to_patients(self, bitmap):
+        return self.dictionary.to_patient_ids(bitmap)
+
+    def add_patient(self, structure_id, patient_id, generation):
+        """
+        Add a patient to the bitmap of the given structure. *generation* is the write generation of
+        the structure after the new records were saved; the bitmap is updated only if it was built
+        for the previous generation, otherwise it is evicted and it will be rebuilt when needed.
+
+        :param structure_id: the structure ID of the saved records
+        :param patient_id: the ID of the patient the records belong to
+        :param generation: the current write generation of the structure
+        :type generation: int
+        """
+        self.add_patients(structure_id, [patient_id], generation)
+
+    def add_patients(self, structure_id, patient_ids, generation):
+        """
+        Add a batch of patients to the bitmap of the given structure. The records of all the patients
+        must have been saved with a single write generation increase, see :meth:`add_patient`.
+
+        :param structure_id: the structure ID of the saved records
+        :param patient_ids: the IDs of the patients the records belong to
+        :param generation: the current write generation of the structure
+        :type generation: int
+        """
+        key = self.get_structure_key(structure_id)
+        with self.lock:
+            try:
+                generations, data = self.entries[key]
+            except KeyError:
+                return
+            self._remove(key)
+        if generations == {structure_id: generation - 1}:
+            bitmap = self._deserialize(data) | self.from_patients(patient_ids)
+            self.put(key, {structure_id: generation}, bitmap)
@@ -1,39 +1,54 @@
-import multiprocessing
+import os, shutil, tempfile, time
+import cPickle as pickle
+from multiprocessing import Pool
 
-from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.ehr.services.dbmanager.querymanager import QueryManager, workers_pool
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
 
 from pyehr.utils.services import get_logger
 
 
-class QueryProcess(multiprocessing.Process):
-
-    def __init__(self, query_manager_conf, index_service_conf, query_label,
-                 aql_query, results_queue, logger=None):
-        multiprocessing.Process.__init__(self)
-        self.query_manager = QueryManager(**query_manager_conf)
-        self.query_manager.set_index_service(**index_service_conf)
-        self.query_label = query_label
-        self.query = aql_query
-        self.queue = results_queue
-        if logger:
-            self.logger = logger
-        else:
-            self.logger = get_logger('query_thread')
-
-    def run(self):
-        self.logger.debug('Start thread for query %s', self.query_label)
-        res = self.query_manager.execute_aql_query(self.query)
-        self.logger.debug('Retrieved %d results', res.total_results)
-        self.queue.put({'query': self.query_label, 'results': res})
+def _run_sub_query(task):
+    sq_hash, sub_query, collection, timeout, results_file = task
+    # the deadline starts when the worker picks up the sub-query, time spent
+    # waiting in the pool queue doesn't count against the query timeout
+    deadline = time.time() + timeout if timeout is not None else None
+    try:
+        columns = workers_pool._run_query((sub_query, collection, deadline))
+    except Exception, e:
+        return sq_hash, None, str(e)
+    # results are written to disk, only the hash and the counter go back to the parent process
+    with open(results_file, 'wb') as f:
+        pickle.dump(columns, f, pickle.HIGHEST_PROTOCOL)
+    return sq_hash, len(columns['masks']), None
 
 
 class QueriesRunner(object):
+    """
+    Run a set of labelled AQL queries and combine their results. Queries are planned together
+    in the current process (see :meth:`pyehr.ehr.services.dbmanager.querymanager.QueryManager.plan_many`)
+    and only the distinct sub-queries are executed by a pool of *max_processes* worker processes.
+    Workers store the results of each sub-query in a file inside *results_dir* (a temporary directory
+    if None), results of a query are merged from these files as soon as all its sub-queries completed
+    and they are loaded from disk only when requested. If *query_timeout* is given, each sub-query is stopped
+    if it runs for more than *query_timeout* seconds; queries that timed out or failed are reported
+    by :attr:`failed_queries` while the other ones keep running.
+    """
 
-    def __init__(self, query_manager_conf, index_sevice_conf, logger=None):
+    def __init__(self, query_manager_conf, index_sevice_conf, logger=None,
+                 max_processes=4, query_timeout=None, results_dir=None):
+        if max_processes < 1:
+            raise ValueError('max_processes must be an integer greater than 0')
         self.qm_conf = query_manager_conf
         self.idxs_conf = index_sevice_conf
+        self.max_processes = max_processes
+        self.query_timeout = query_timeout
+        self.results_dir = results_dir
+        self._temp_results_dir = False
         self.queries = dict()
         self.queries_results = dict()
+        self.failed_queries = dict()
+        self.query_manager = None
         if logger:
             self.logger = logger
         else:
@@ -53,48 +68,259 @@ class QueriesRunner(object):
         else:
             raise KeyError('Query label %s already in use' % query_label)
 
+    def _get_query_manager(self):
+        if self.query_manager is None:
+            self.query_manager = QueryManager(**self.qm_conf)
+            self.query_manager.set_index_service(**self.idxs_conf)
+        return self.query_manager
+
+    def enable_bitmap_index(self, max_size):
+        """
+        Use a patients bitmap index for set operations over the *ehr_id.value* key, patients sets
+        are combined with bitwise operations over bitmaps kept in memory and invalidated when
+        the involved structures change.
+        See :meth:`pyehr.ehr.services.dbmanager.querymanager.QueryManager.set_bitmap_index`
+
+        :param max_size: the maximum amount of memory, in bytes, used by the bitmaps, 0 disables the index
+        :return: the bitmap index, it can be passed to the DBServices saving records in this process
+        """
+        query_manager = self._get_query_manager()
+        query_manager.set_bitmap_index(max_size)
+        return query_manager.bitmap_index
+
+    def _use_bitmaps(self, key):
+        return key == 'ehr_id.value' and self._get_query_manager().bitmap_index is not None
+
+    def _get_bitmap(self, query_label):
+        return self._get_query_manager().get_patients_bitmap(self._get_query(query_label))
+
+    def _get_query(self, query_label):
+        try:
+            return self.queries[query_label]
+        except KeyError:
+            raise KeyError('There is no query labeled %s' % query_label)
+
+    def _get_results_file(self):
+        if self.results_dir is None:
+            self.results_dir = tempfile.mkdtemp(prefix='pyehr_queries_')
+            self._temp_results_dir = True
+        fd, results_file = tempfile.mkstemp(suffix='.results', dir=self.results_dir)
+        os.close(fd)
+        return results_file
+
+    def _remove_results_file(self, query_label):
+        results_file = self.queries_results.pop(query_label, None)
+        if results_file and os.path.exists(results_file):
+            os.remove(results_file)
+
+    def _get_driver_conf(self, query_manager):
+        return {
+            'driver': query_manager.driver,
+            'host': query_manager.host,
+            'database': query_manager.database,
+            'repository': query_manager.ehr_repository,
+            'port': query_manager.port,
+            'user': query_manager.user,
+            'passwd': query_manager.passwd,
+            'driver_options': query_manager.driver_options
+        }
+
+    def _save_results(self, query_label, results):
+        results_file = self._get_results_file()
+        with open(results_file, 'wb') as f:
+            pickle.dump(results.to_columns(), f, pickle.HIGHEST_PROTOCOL)
+        self.queries_results[query_label] = results_file
+        self.logger.debug('Retrieved %d results for query %s', results.total_results, query_label)
+        return results_file
+
+    def _load_results(self, results_file):
+        with open(results_file, 'rb') as f:
+            return ResultSet.from_columns(pickle.load(f))
+
+    def _merge_sub_queries_results(self, query_label, sub_queries_files):
+        if len(sub_queries_files) == 1:
+            results_set = self._load_results(sub_queries_files[0])
+        else:
+            results_set = ResultSet()
+            for results_file in sub_queries_files:
+                results_set.extend(self._load_results(results_file))
+        self._save_results(query_label, results_set)
+        return results_set
+
     def execute_queries(self):
-        results_queue = multiprocessing.Queue(len(self.queries))
-        query_threads = list()
-        self.logger.debug('Start processing queues')
-        for label, query in self.queries.iteritems():
-            qp = QueryProcess(self.qm_conf, self.idxs_conf, label, query,
-                              results_queue, self.logger)
-            qp.start()
-            query_threads.append(qp)
-        for qp in query_threads:
-            qp.join()
-        self.logger.debug('Queries executed, collecting results')
-        while not results_queue.empty():
-            q_element = results_queue.get()
-            self.queries_results.update({q_element['query']: q_element['results']})
+        for label in self.queries:
+            self._remove_results_file(label)
+            self.failed_queries.pop(label, None)
+        if not self.queries:
+            return
+        query_manager = self._get_query_manager()
+        cached_results, sub_queries, labels_map, cache_entries = \
+            query_manager.plan_many(self.queries, errors=self.failed_queries)
+        for label, results in cached_results.iteritems():
+            self._save_results(label, results)
+        # queries without sub-queries have an empty result
+        for label in [l for l, hashes in labels_map.iteritems() if not hashes]:
+            self._save_results(label, ResultSet())
+            del labels_map[label]
+        if not sub_queries:
+            return
+        sub_queries_files = dict((sq_hash, self._get_results_file()) for sq_hash in sub_queries)
+        # labels waiting for each sub-query and number of pending sub-queries of each label
+        sub_queries_labels = dict()
+        pending = dict()
+        for label, sub_queries_hashes in labels_map.iteritems():
+            pending[label] = len(set(sub_queries_hashes))
+            for sq_hash in set(sub_queries_hashes):
+                sub_queries_labels.setdefault(sq_hash, list()).append(label)
+        tasks = [(sq_hash, sq, query_manager.ehr_repository, self.query_timeout, sub_queries_files[sq_hash])
+                 for sq_hash, sq in sub_queries.iteritems()]
+        processes = min(self.max_processes, len(tasks))
+        self.logger.debug('Start processing %d sub-queries using %d processes', len(tasks), processes)
+        pool = Pool(processes, initializer=workers_pool._init_worker,
+                    initargs=(self._get_driver_conf(query_manager),))
+        try:
+            # results are handled as soon as sub-queries complete
+            for sq_hash, results_count, error in pool.imap_unordered(_run_sub_query, tasks):
+                for label in sub_queries_labels[sq_hash]:
+                    if label in self.failed_queries:
+                        continue
+                    if error is not None:
+                        self.logger.error('Query %s failed: %s', label, error)
+                        self.failed_queries[label] = error
+                        continue
+                    self.logger.debug('Sub-query of query %s returned %d results', label, results_count)
+                    pending[label] -= 1
+                    if pending[label] == 0:
+                        results_set = self._merge_sub_queries_results(
+                            label, [sub_queries_files[h] for h in labels_map[label]]
+                        )
+                        if label in cache_entries:
+                            query_manager.results_cache.put(cache_entries[label][0], cache_entries[label][1],
+                                                            results_set)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            # sub-queries results were merged in the results of the queries
+            for results_file in sub_queries_files.itervalues():
+                if os.path.exists(results_file):
+                    os.remove(results_file)
         self.logger.debug('Results collected')
 
     def cleanup(self):
+        for label in self.queries_results.keys():
+            self._remove_results_file(label)
+        if self._temp_results_dir:
+            shutil.rmtree(self.results_dir, ignore_errors=True)
+            self.results_dir = None
+            self._temp_results_dir = False
         self.queries = dict()
         self.queries_results = dict()
+        self.failed_queries = dict()
 
     def remove_query(self, query_label):
         try:
             del(self.queries[query_label])
         except KeyError:
             raise KeyError('There is no query labeled %s' % query_label)
-        try:
-            del(self.queries_results[query_label])
-        except KeyError:
-            pass
+        self._remove_results_file(query_label)
+        self.failed_queries.pop(query_label, None)
 
     def get_result_set(self, query_label):
-        return self.queries_results.get(query_label)
+        results_file = self.queries_results.get(query_label)
+        if results_file is None:
+            return None
+        return self._load_results(results_file)
+
+    def _get_results(self, query_label):
+        res = self.get_result_set(query_label)
+        if res is None:
+            raise KeyError('There are no results for query %s' % query_label)
+        return res.results
 
     def get_intersection(self, field, *query_labels):
-        res = set([r[field] for r in self.queries_results[query_labels[0]].results])
+        res = set([r[field] for r in self._get_results(query_labels[0])])
         for label in query_labels[1:]:
-            res.intersection_update(set([r[field] for r in self.queries_results[label].results]))
+            res.intersection_update(set([r[field] for r in self._get_results(label)]))
         return res
 
     def get_union(self, field, *query_labels):
-        res = set([r[field] for r in self.queries_results[query_labels[0]].results])
+        res = set([r[field] for r in self._get_results(query_labels[0])])
         for label in query_labels[1:]:
-            res.update(set([r[field] for r in self.queries_results[label].results]))
-        return res
\ No newline at end of file
+            res.update(set([r[field] for r in self._get_results(label)]))
+        return res
+
+    def _get_keys(self, query_manager, query_label, key, restrict_to=None):
+        return query_manager.execute_aql_keys_query(self._get_query(query_label), key,
+                                                    restrict_to=restrict_to)
+
+    def intersect(self, key, *query_labels):
+        """
+        Get the keys returned by all the given queries. Queries don't need to be executed with
+        :meth:`execute_queries`: the least selective queries are filtered by the database using
+        the keys returned by the most selective ones and only key values are retrieved.
+
+        :param key: the EHR level value used as key, *ehr_id.value* (patients) or *uid.value*
+                    (clinical records)
+        :param query_labels: the labels of the queries
+        :return: a set with the matching keys
+        """
+        query_manager = self._get_query_manager()
+        if self._use_bitmaps(key):
+            bitmap = reduce(lambda b1, b2: b1 & b2, [self._get_bitmap(label) for label in query_labels])
+            return query_manager.get_patients(bitmap)
+        counters = dict((label, query_manager.execute_aql_query(self._get_query(label), count_only=True))
+                        for label in query_labels)
+        keys = None
+        for label in sorted(query_labels, key=lambda l: counters[l]):
+            keys = self._get_keys(query_manager, label, key, keys)
+            if not keys:
+                self.logger.debug('Query %s returned no keys, stop intersection', label)
+                return set()
+        return keys
+
+    def union(self, key, *query_labels):
+        """
+        Get the keys returned by at least one of the given queries, only key values are retrieved.
+
+        :param key: the EHR level value used as key, *ehr_id.value* (patients) or *uid.value*
+                    (clinical records)
+        :param query_labels: the labels of the queries
+        :return: a set with the matching keys
+        """
+        query_manager = self._get_query_manager()
+        if self._use_bitmaps(key):
+            bitmap = reduce(lambda b1, b2: b1 | b2, [self._get_bitmap(label) for label in query_labels])
+            return query_manager.get_patients(bitmap)
+        keys = set()
+        for label in query_labels:
+            keys.update(self._get_keys(query_manager, label, key))
+        return keys
+
+    def difference(self, key, query_label, *excluded_query_labels):
+        """
+        Get the keys returned by the query labeled *query_label* and not returned by any of the
+        excluded queries. Excluded queries are filtered by the database using the keys that are
+        still part of the result and only key values are retrieved.
+
+        :param key: the EHR level value used as key, *ehr_id.value* (patients) or *uid.value*
+                    (clinical records)
+        :param query_label: the label of the base query
+        :param excluded_query_labels: the labels of the queries whose keys will be removed
+        :return: a set with the matching keys
+        """
+        query_manager = self._get_query_manager()
+        if self._use_bitmaps(key):
+            bitmap = self._get_bitmap(query_label)
+            for label in excluded_query_labels:
+                bitmap &= ~self._get_bitmap(label)
+            return query_manager.get_patients(bitmap)
+        keys = self._get_keys(query_manager, query_label, key)
+        for label in excluded_query_labels:
+            if not keys:
+                break
+            keys.difference_update(self._get_keys(query_manager, label, key, keys))
+        return keys
\ No newline at end of file
@@ -0,0 +1,51 @@
+import time
+from threading import Event
+from uuid import uuid4
+
+from pyehr.ehr.services.dbmanager.errors import QueryTimeoutError, QueryCancelledError
+
+
+class QueryControl(object):
+    """
+    Deadline and cancellation flag of a running AQL query. Drivers periodically call :meth:`check`
+    while fetching results and pass :meth:`get_remaining_ms` to the database, so that a query can be
+    stopped both on the client and on the server side.
+    If no *deadline* is given, it is computed from *timeout* (in seconds); if both are None the
+    query can only be stopped using :meth:`cancel`.
+    """
+
+    def __init__(self, query_id=None, timeout=None, deadline=None):
+        self.query_id = query_id or uuid4().hex
+        if deadline is None and timeout is not None:
+            if timeout <= 0:
+                raise ValueError('timeout must be a number greater than 0')
+            deadline = time.time() + timeout
+        self.deadline = deadline
+        self.cancelled = Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def check(self):
+        """
+        Raise a :class:`QueryCancelledError` if the query was cancelled or a :class:`QueryTimeoutError`
+        if the deadline expired
+        """
+        if self.cancelled.is_set():
+            raise QueryCancelledError('Query %s was cancelled' % self.query_id)
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise QueryTimeoutError('Query %s exceeded its deadline' % self.query_id)
+
+    def get_remaining_ms(self):
+        """
+        Return the milliseconds left before the deadline or None if the query has no deadline.
+        Checks the query first, so the returned value is always greater than 0.
+        """
+        self.check()
+        if self.deadline is None:
+            return None
+        return max(int((self.deadline - time.time()) * 1000), 1)
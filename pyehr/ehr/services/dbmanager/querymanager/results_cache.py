@@ -0,0 +1,137 @@
+import re
+import cPickle as pickle
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
+from pyehr.utils import get_logger
+
+
+class ResultsCache(object):
+    """
+    A memory bounded, LRU cache for AQL queries results. Cached results are tagged with the
+    write generations of the structures involved in the query (as returned by the
+    :class:`pyehr.ehr.services.dbmanager.dbservices.index_service.IndexService`), a cached
+    result is returned only if these generations did not change since results were stored.
+
+    Results are stored in serialized form, *max_size* is the maximum amount of memory, in bytes,
+    that can be used by serialized results.
+    """
+
+    def __init__(self, max_size, logger=None):
+        if max_size < 1:
+            raise ValueError('max_size must be an integer greater than 0')
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.logger = logger or get_logger('results_cache')
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def get_key(query, query_params=None, count_only=False):
+        """
+        Build the cache key for the given query, whitespaces in the query are normalized
+
+        :param query: an AQL query
+        :type query: str
+        :param query_params: query parameters
+        :type query_params: dict
+        :param count_only: True if only the number of results is requested
+        :type count_only: bool
+        :return: the cache key
+        """
+        normalized_query = re.sub(r'\s+', ' ', query).strip()
+        return normalized_query, json.dumps(query_params or {}, sort_keys=True), bool(count_only)
+
+    def _serialize(self, results):
+        if isinstance(results, ResultSet):
+            return pickle.dumps(('rs', results.to_columns()), pickle.HIGHEST_PROTOCOL)
+        return pickle.dumps(('value', results), pickle.HIGHEST_PROTOCOL)
+
+    def _deserialize(self, data):
+        kind, value = pickle.loads(data)
+        if kind == 'rs':
+            return ResultSet.from_columns(value)
+        return value
+
+    def _remove(self, key):
+        _, data = self.entries.pop(key)
+        self.size -= len(data)
+
+    def get(self, key, generations):
+        """
+        Get cached results for the given *key*. If the results were stored with different
+        structures generations they are evicted and None is returned.
+
+        :param key: the cache key, see :meth:`get_key`
+        :param generations: a dictionary mapping the IDs of the structures involved in the query
+                            to their current write generations
+        :type generations: dict
+        :return: the cached results or None
+        """
+        with self.lock:
+            try:
+                cached_generations, data = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if cached_generations != generations:
+                self.logger.debug('Structures changed, evicting cached results')
+                self.size -= len(data)
+                self.misses += 1
+                return None
+            # move the entry to the end, it is now the most recently used one
+            self.entries[key] = (cached_generations, data)
+            self.hits += 1
+        return self._deserialize(data)
+
+    def put(self, key, generations, results):
+        """
+        Store results for the given *key*, least recently used entries are evicted if needed.
+        Results that exceed the size of the whole cache are not stored.
+
+        :param key: the cache key, see :meth:`get_key`
+        :param generations: a dictionary mapping the IDs of the structures involved in the query
+                            to their write generations
+        :type generations: dict
+        :param results: a :class:`ResultSet` or the results counter
+        """
+        data = self._serialize(results)
+        if len(data) > self.max_size:
+            self.logger.debug('Results too big to be cached (%d bytes)', len(data))
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            while self.size + len(data) > self.max_size:
+                self._remove(next(iter(self.entries)))
+            self.entries[key] = (generations, data)
+            self.size += len(data)
+
+    def evict_structures(self, structure_ids):
+        """
+        Evict all the cached results involving one or more of the given structures
+
+        :param structure_ids: a list of structure IDs
+        :type structure_ids: list
+        """
+        structure_ids = set(structure_ids)
+        with self.lock:
+            for key in [k for k, (g, _) in self.entries.iteritems()
+                        if structure_ids.intersection(g)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
@@ -36,6 +36,8 @@ class ResultSet(object):
         self.total_results = 0
         self.columns = []
         self.rows = []
+        # when results are paginated, the token used to retrieve the next page
+        self.next_page_token = None
 
     def to_json(self, add_columns_json=False):
         json_res = {
@@ -44,6 +46,8 @@ class ResultSet(object):
         }
         if add_columns_json:
             json_res['columns'] = [c.to_json() for c in self.columns]
+        if self.next_page_token:
+            json_res['next_page_token'] = self.next_page_token
         return json_res
 
     def _get_alias(self, key):
@@ -80,4 +84,61 @@ class ResultSet(object):
             for x in set([r[field] for r in self.results]):
                 yield x
         except KeyError:
-            raise InvalidFieldError('There is no field "%s" in this results set' % field)
\ No newline at end of file
+            raise InvalidFieldError('There is no field "%s" in this results set' % field)
+
+    def to_columns(self):
+        """
+        Encode the result set in a compact, columnar form made only of builtin types.
+        Each column contains the values of a single key for all the rows of the result set,
+        rows that do not contain one or more keys are tracked using a bit mask.
+
+        :return: a dictionary with columns definitions, keys, values and masks
+        :rtype: dict
+        """
+        keys = list()
+        keys_index = dict()
+        for r in self.rows:
+            for k in r.record:
+                if k not in keys_index:
+                    keys_index[k] = len(keys)
+                    keys.append(k)
+        full_mask = (1 << len(keys)) - 1
+        values = [list() for _ in keys]
+        masks = list()
+        for r in self.rows:
+            mask = 0
+            for i, k in enumerate(keys):
+                if k in r.record:
+                    values[i].append(r.record[k])
+                    mask |= 1 << i
+                else:
+                    values[i].append(None)
+            masks.append(None if mask == full_mask else mask)
+        return {
+            'columns': [c.to_json() for c in self.columns],
+            'keys': keys,
+            'values': values,
+            'masks': masks
+        }
+
+    @classmethod
+    def from_columns(cls, columns_data):
+        """
+        Create a :class:`ResultSet` from data encoded with the :meth:`to_columns` method
+
+        :param columns_data: the result set in columnar form
+        :type columns_data: dict
+        :return: a :class:`ResultSet` object
+        """
+        rs = cls()
+        for c in columns_data['columns']:
+            rs.add_column_definition(ResultColumnDef(c['alias'], c['path']))
+        keys = columns_data['keys']
+        values = columns_data['values']
+        for i, mask in enumerate(columns_data['masks']):
+            if mask is None:
+                record = dict((k, values[j][i]) for j, k in enumerate(keys))
+            else:
+                record = dict((k, values[j][i]) for j, k in enumerate(keys) if mask & (1 << j))
+            rs.add_row(ResultRow(record))
+        return rs
@@ -0,0 +1,284 @@
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
+from threading import local, Lock
+
+from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
+from pyehr.ehr.services.dbmanager.querymanager.query_control import QueryControl
+from pyehr.utils import get_logger
+
+
+# driver used by the current worker process, it is created once when the
+# worker starts and it is reused by all the queries handled by the worker
+_worker_driver = None
+
+
+def _close_worker_driver():
+    global _worker_driver
+    if _worker_driver is not None and _worker_driver.is_connected:
+        _worker_driver.disconnect()
+    _worker_driver = None
+
+
+def _init_worker(driver_conf):
+    global _worker_driver
+    _worker_driver = DriversFactory(logger=get_logger('query_worker'),
+                                    **driver_conf).get_driver()
+    _worker_driver.connect()
+    Finalize(None, _close_worker_driver, exitpriority=16)
+
+
+def _run_query(task):
+    query_description, collection, deadline = task
+    # only the deadline can be sent to worker processes, cancelled queries are
+    # stopped by the parent process while collecting the results
+    if deadline is not None:
+        _worker_driver.query_control = QueryControl(deadline=deadline)
+    else:
+        _worker_driver.query_control = None
+    results = _worker_driver._run_sub_query(query_description, collection)
+    # results are sent back to the parent process in columnar form, this
+    # is much cheaper to pickle than a list of ResultRow objects
+    return results.to_columns()
+
+
+class QueryWorkersPool(object):
+    """
+    A pool of long living processes used to run AQL sub-queries. Each worker opens a connection
+    to the database when the pool is started and keeps it open until the pool is shut down,
+    in this way there is no need to spawn new processes and to open new connections every time
+    a query is executed.
+    """
+
+    def __init__(self, driver, host, database, repository, port=None,
+                 user=None, passwd=None, processes=2, logger=None, driver_options=None):
+        if processes < 1:
+            raise ValueError('processes must be an integer greater than 0')
+        self.driver_conf = {
+            'driver': driver,
+            'host': host,
+            'database': database,
+            'repository': repository,
+            'port': port,
+            'user': user,
+            'passwd': passwd,
+            'driver_options': driver_options
+        }
+        self.processes = processes
+        self.pool = None
+        self.logger = logger or get_logger('query_workers_pool')
+
+    @property
+    def is_running(self):
+        return self.pool is not None
+
+    def start(self):
+        """
+        Start the worker processes, if the pool is already running nothing happens
+        """
+        if not self.is_running:
+            self.logger.debug('starting a pool of %d query workers', self.processes)
+            self.pool = Pool(self.processes, initializer=_init_worker,
+                             initargs=(self.driver_conf,))
+        else:
+            self.logger.debug('query workers pool is already running')
+
+    def shutdown(self):
+        """
+        Wait for the running queries to complete and stop the worker processes
+        """
+        if self.is_running:
+            self.logger.debug('shutting down query workers pool')
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        """
+        Stop the worker processes immediately, without waiting for running queries
+        """
+        if self.is_running:
+            self.logger.debug('terminating query workers pool')
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _get_tasks(self, queries, collection, query_control):
+        deadline = query_control.deadline if query_control else None
+        return [(q, collection, deadline) for q in queries]
+
+    def run_queries(self, queries, collection, query_control=None):
+        """
+        Run the given queries using the worker processes and merge the results in a single
+        :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
+
+        :param queries: a list of query descriptions with *condition*, *selection* and *aliases* fields
+        :type queries: list
+        :param collection: the collection (or index) that will be queried
+        :param query_control: the :class:`pyehr.ehr.services.dbmanager.querymanager.query_control.QueryControl`
+                              of the query, its deadline is enforced by the worker processes
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
+        """
+        if not self.is_running:
+            raise RuntimeError('query workers pool is not running')
+        total_results = ResultSet()
+        for r in self.pool.imap_unordered(_run_query, self._get_tasks(queries, collection, query_control)):
+            if query_control:
+                query_control.check()
+            total_results.extend(ResultSet.from_columns(r))
+        return total_results
+
+    def map_queries(self, queries, collection, query_control=None):
+        """
+        Run the given queries using the worker processes and return their results separately
+
+        :param queries: a list of query descriptions with *condition*, *selection* and *aliases* fields
+        :type queries: list
+        :param collection: the collection (or index) that will be queried
+        :param query_control: the :class:`pyehr.ehr.services.dbmanager.querymanager.query_control.QueryControl`
+                              of the queries, its deadline is enforced by the worker processes
+        :return: a list of :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
+                 objects, in the same order of the queries
+        """
+        if not self.is_running:
+            raise RuntimeError('query workers pool is not running')
+        results = list()
+        for r in self.pool.imap(_run_query, self._get_tasks(queries, collection, query_control)):
+            if query_control:
+                query_control.check()
+            results.append(ResultSet.from_columns(r))
+        return results
+
+
+class QueryThreadsPool(object):
+    """
+    Thread based counterpart of the :class:`QueryWorkersPool`. Each thread lazily opens its own
+    connection to the database (drivers are not shared among threads) and keeps it open until the
+    pool is shut down. Threads spend most of their time waiting for the database, so a single process
+    can keep a large number of sub-queries in flight.
+    """
+
+    def __init__(self, driver, host, database, repository, port=None,
+                 user=None, passwd=None, threads=10, logger=None, driver_options=None):
+        if threads < 1:
+            raise ValueError('threads must be an integer greater than 0')
+        self.driver_conf = {
+            'driver': driver,
+            'host': host,
+            'database': database,
+            'repository': repository,
+            'port': port,
+            'user': user,
+            'passwd': passwd,
+            'driver_options': driver_options
+        }
+        self.threads = threads
+        self.pool = None
+        self.logger = logger or get_logger('query_threads_pool')
+        self._local = local()
+        self._drivers = list()
+        self._drivers_lock = Lock()
+
+    @property
+    def is_running(self):
+        return self.pool is not None
+
+    def get_driver(self):
+        """
+        Return the connected driver bound to the calling thread, create it if needed.
+        Drivers are disconnected when the pool is shut down.
+        """
+        driver = getattr(self._local, 'driver', None)
+        if driver is None:
+            driver = DriversFactory(logger=self.logger, **self.driver_conf).get_driver()
+            driver.connect()
+            self._local.driver = driver
+            with self._drivers_lock:
+                self._drivers.append(driver)
+        return driver
+
+    def _close_drivers(self):
+        with self._drivers_lock:
+            for d in self._drivers:
+                if d.is_connected:
+                    d.disconnect()
+            self._drivers = list()
+        self._local = local()
+
+    def start(self):
+        """
+        Start the threads, if the pool is already running nothing happens
+        """
+        if not self.is_running:
+            self.logger.debug('starting a pool of %d query threads', self.threads)
+            self.pool = ThreadPool(self.threads)
+        else:
+            self.logger.debug('query threads pool is already running')
+
+    def shutdown(self):
+        """
+        Wait for the running queries to complete, stop the threads and close their connections
+        """
+        if self.is_running:
+            self.logger.debug('shutting down query threads pool')
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self._close_drivers()
+
+    def terminate(self):
+        """
+        Stop the threads without waiting for running queries and close their connections
+        """
+        if self.is_running:
+            self.logger.debug('terminating query threads pool')
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self._close_drivers()
+
+    def _run_query(self, task):
+        query_description, collection, query_control = task
+        driver = self.get_driver()
+        # threads share the query control with the caller, so cancelled queries are stopped as well
+        driver.query_control = query_control
+        try:
+            return driver._run_sub_query(query_description, collection)
+        finally:
+            driver.query_control = None
+
+    def run_queries(self, queries, collection, query_control=None):
+        """
+        Run the given queries using the pool's threads and merge the results in a single
+        :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
+
+        :param queries: a list of query descriptions with *condition*, *selection* and *aliases* fields
+        :type queries: list
+        :param collection: the collection (or index) that will be queried
+        :param query_control: the :class:`pyehr.ehr.services.dbmanager.querymanager.query_control.QueryControl`
+                              of the query
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
+        """
+        if not self.is_running:
+            raise RuntimeError('query threads pool is not running')
+        total_results = ResultSet()
+        for r in self.pool.imap_unordered(self._run_query, [(q, collection, query_control) for q in queries]):
+            total_results.extend(r)
+        return total_results
+
+    def map_queries(self, queries, collection, query_control=None):
+        """
+        Run the given queries using the pool's threads and return their results separately
+
+        :param queries: a list of query descriptions with *condition*, *selection* and *aliases* fields
+        :type queries: list
+        :param collection: the collection (or index) that will be queried
+        :param query_control: the :class:`pyehr.ehr.services.dbmanager.querymanager.query_control.QueryControl`
+                              of the queries
+        :return: a list of :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
+                 objects, in the same order of the queries
+        """
+        if not self.is_running:
+            raise RuntimeError('query threads pool is not running')
+        return self.pool.map(self._run_query, [(q, collection, query_control) for q in queries])
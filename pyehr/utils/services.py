@@ -11,7 +11,11 @@ class ServiceConfig(object):
                  db_ehr_repository, db_ehr_versioning_repository,
                  index_url, index_database, index_user, index_passwd,
                  db_service_host, db_service_port, db_service_server_engine,
-                 query_service_host, query_service_port, query_service_server_engine):
+                 query_service_host, query_service_port, query_service_server_engine,
+                 query_service_workers_pool_size=0, query_service_async_mode=False,
+                 query_service_max_concurrent_queries=100, query_service_results_cache_size=0,
+                 query_service_query_timeout=0, query_service_max_running_queries=0,
+                 query_service_admission_queue_timeout=30):
         self.db_driver = db_driver
         self.db_host = db_host
         self.db_database = db_database
@@ -32,6 +36,13 @@ class ServiceConfig(object):
         self.query_service_host = query_service_host
         self.query_service_port = query_service_port
         self.query_service_server_engine = query_service_server_engine
+        self.query_service_workers_pool_size = int(query_service_workers_pool_size)
+        self.query_service_async_mode = str(query_service_async_mode).lower() in ('1', 'true', 'yes', 'on')
+        self.query_service_max_concurrent_queries = int(query_service_max_concurrent_queries)
+        self.query_service_results_cache_size = int(query_service_results_cache_size)
+        self.query_service_query_timeout = float(query_service_query_timeout)
+        self.query_service_max_running_queries = int(query_service_max_running_queries)
+        self.query_service_admission_queue_timeout = float(query_service_admission_queue_timeout)
 
     def get_db_configuration(self):
         return {
@@ -69,6 +80,35 @@ class ServiceConfig(object):
             'engine': self.query_service_server_engine
         }
 
+    def get_query_service_workers_configuration(self):
+        return {
+            'processes': self.query_service_workers_pool_size
+        }
+
+    def get_query_service_cache_configuration(self):
+        return {
+            'max_size': self.query_service_results_cache_size
+        }
+
+    def get_query_service_async_configuration(self):
+        return {
+            'async_mode': self.query_service_async_mode,
+            'max_concurrent_queries': self.query_service_max_concurrent_queries
+        }
+
+    def get_query_service_limits_configuration(self):
+        return {
+            'query_timeout': self.query_service_query_timeout,
+            'max_running_queries': self.query_service_max_running_queries,
+            'admission_queue_timeout': self.query_service_admission_queue_timeout
+        }
+
+
+def _get_optional(parser, section, option, default=None):
+    if parser.has_option(section, option) and parser.get(section, option):
+        return parser.get(section, option)
+    return default
+
 
 def get_service_configuration(configuration_file, logger=None):
     if not logger:
@@ -96,7 +136,14 @@ def get_service_configuration(configuration_file, logger=None):
             parser.get('db_service', 'server_engine'),
             parser.get('query_service', 'host'),
             parser.get('query_service', 'port'),
-            parser.get('query_service', 'server_engine')
+            parser.get('query_service', 'server_engine'),
+            _get_optional(parser, 'query_service', 'workers_pool_size', 0),
+            _get_optional(parser, 'query_service', 'async_mode', False),
+            _get_optional(parser, 'query_service', 'max_concurrent_queries', 100),
+            _get_optional(parser, 'query_service', 'results_cache_size', 0),
+            _get_optional(parser, 'query_service', 'query_timeout', 0),
+            _get_optional(parser, 'query_service', 'max_running_queries', 0),
+            _get_optional(parser, 'query_service', 'admission_queue_timeout', 30)
         )
         return conf
     except NoOptionError, nopt:
@@ -55,6 +55,12 @@ class DBService(object):
     def add_index_service(self, url, database, user, passwd):
         self.dbs.set_index_service(url, database, user, passwd)
 
+    def init_structures(self):
+        created_structures = self.dbs.init_structures()
+        for structure_def, created in sorted(created_structures.iteritems()):
+            if created:
+                self.logger.info('Created indexes %s for %s repository', ', '.join(created), structure_def)
+
     def exceptions_handler(f):
         @wraps(f)
         def wrapper(inst, *args, **kwargs):
@@ -390,7 +396,8 @@ class DBService(object):
     @exceptions_handler
     def batch_save_patients(self):
         """
-        Save a list of PatientRecords and connected ClinicalRecords at the same time.
+        Save a list of PatientRecords and connected ClinicalRecords at the same time, all the
+        records of the batch are written together with bulk inserts.
         For each PatientRecord, if an error occurs during the saving procedure data for that
         specific patient will be delete (patient data + ehr records).
         Two lists of JSON records will be returned, one with the saved records and one with
@@ -406,19 +413,22 @@ class DBService(object):
             'ERRORS': []
         }
         try:
+            patient_records = list()
+            # map the decoded records to the original JSON objects, used to report errors
+            patients_json = dict()
             for patient in patients_data:
                 try:
                     patient_record = PatientRecord.from_json(patient)
-                    success, msg, patient_record, errors = self._save_patient_from_batch(patient_record)
-                    if success:
-                        response_body['SAVED'].append(patient_record.to_json())
-                    else:
-                        response_body['ERRORS'].append({'MESSAGE': msg, 'RECORD': patient})
-                except pyehr_errors.DuplicatedKeyError:
-                    msg = 'Duplicated key error for PatientRecord with ID %s' % patient_record.record_id
-                    response_body['ERRORS'].append({'MESSAGE': msg, 'RECORD': patient})
                 except pyehr_errors.InvalidJsonStructureError, je:
                     response_body['ERRORS'].append({'MESSAGE': str(je), 'RECORD': patient})
+                    continue
+                patient_records.append(patient_record)
+                patients_json[id(patient_record)] = patient
+            with self.dbs.bulk_ingest():
+                saved, failures = self.dbs.save_patients_with_records(patient_records)
+            response_body['SAVED'] = [p.to_json() for p in saved]
+            for patient_record, msg in failures:
+                response_body['ERRORS'].append({'MESSAGE': msg, 'RECORD': patients_json[id(patient_record)]})
             return self._success(response_body)
         except ValueError, ve:
             # TODO: check this, not quite sure about the 400 error code...
@@ -496,6 +506,7 @@ def main(argv):
     dbs = DBService(log_file=args.log_file, log_level=args.log_level,
                     **conf.get_db_configuration())
     dbs.add_index_service(**conf.get_index_configuration())
+    dbs.init_structures()
     check_pid_file(args.pid_file, logger)
     create_pid(args.pid_file)
     dbs.start_service(debug=args.debug, **conf.get_db_service_configuration())
@@ -1,41 +1,116 @@
-import sys, argparse
+import sys, argparse, signal, time
 from functools import wraps
+from threading import Condition
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from bottle import post, get, run, response, request, abort, HTTPError
+from bottle import post, get, run, response, request, abort, HTTPError, ServerAdapter
 
 from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.ehr.services.dbmanager.querymanager.async_manager import AsyncQueryManager
 from pyehr.utils import get_logger
 from pyehr.utils.services import get_service_configuration, check_pid_file,\
     create_pid, destroy_pid, get_rotating_file_logger
 import pyehr.ehr.services.dbmanager.errors as pyehr_errors
 
 
+class ThreadingWSGIRefServer(ServerAdapter):
+    """
+    A wsgiref server that handles each request in a separate thread
+    """
+
+    def run(self, app):
+        from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+        from SocketServer import ThreadingMixIn
+
+        class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+            daemon_threads = True
+
+        quiet = self.quiet
+
+        class RequestHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    return WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        srv = make_server(self.host, self.port, app, ThreadingWSGIServer, RequestHandler)
+        srv.serve_forever()
+
+
+class AdmissionController(object):
+    """
+    Limit the number of queries executed at the same time. When *max_running* queries are
+    running, new queries wait up to *queue_timeout* seconds for a free slot and are rejected
+    if none is released in time. If *max_running* is 0, queries are never limited.
+    """
+
+    def __init__(self, max_running=0, queue_timeout=0):
+        self.max_running = max_running
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.condition = Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot, return False if no slot was released within the queue timeout
+        """
+        if not self.max_running:
+            return True
+        with self.condition:
+            deadline = time.time() + self.queue_timeout
+            while self.running >= self.max_running:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.running += 1
+            return True
+
+    def release(self):
+        if not self.max_running:
+            return
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+
 class QueryService():
 
     def __init__(self, driver, host, database, versioning_database,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None,
                  port=None, user=None, passwd=None,
-                 log_file=None, log_level='INFO'):
+                 log_file=None, log_level='INFO', async_mode=False,
+                 max_concurrent_queries=100):
         if not log_file:
             self.logger = get_logger('query_service_daemon')
         else:
             self.logger = get_rotating_file_logger('query_service_daemon', log_file,
                                                    log_level=log_level)
-        self.qmanager = QueryManager(driver, host, database, versioning_database,
-                                     patients_repository, ehr_repository,
-                                     ehr_versioning_repository,
-                                     port, user, passwd, self.logger)
+        self.async_mode = async_mode
+        self.query_timeout = None
+        self.admission_controller = AdmissionController()
+        if self.async_mode:
+            self.qmanager = AsyncQueryManager(driver, host, database, versioning_database,
+                                              patients_repository, ehr_repository,
+                                              ehr_versioning_repository,
+                                              port, user, passwd, self.logger,
+                                              max_concurrent_queries=max_concurrent_queries)
+        else:
+            self.qmanager = QueryManager(driver, host, database, versioning_database,
+                                         patients_repository, ehr_repository,
+                                         ehr_versioning_repository,
+                                         port, user, passwd, self.logger)
         ###############################################
         # Web Service methods
         ###############################################
         post('/query/execute')(self.execute_query)
         post('/query/execute_count')(self.execute_count_query)
+        post('/query/execute_batch')(self.execute_batch_query)
+        post('/query/cancel')(self.cancel_query)
         # utilities
         post('/check/status/querymanager')(self.test_server)
         get('/check/status/querymanager')(self.test_server)
@@ -43,6 +118,30 @@ class QueryService():
     def add_index_service(self, url, database, user, passwd):
         self.qmanager.set_index_service(url, database, user, passwd)
 
+    def set_results_cache(self, max_size):
+        if max_size > 0:
+            self.logger.info('Caching query results, using up to %d bytes', max_size)
+            self.qmanager.set_results_cache(max_size)
+
+    def set_limits(self, query_timeout, max_running_queries, admission_queue_timeout):
+        if query_timeout > 0:
+            self.logger.info('Stopping queries running for more than %.1f seconds', query_timeout)
+            self.query_timeout = query_timeout
+        if max_running_queries > 0:
+            self.logger.info('Running up to %d queries at the same time, waiting up to %.1f seconds '
+                             'for a free slot', max_running_queries, admission_queue_timeout)
+        self.admission_controller = AdmissionController(max_running_queries, admission_queue_timeout)
+
+    def start_workers_pool(self, processes):
+        if processes > 0:
+            self.logger.info('Starting %d query workers', processes)
+            self.qmanager.start_workers_pool(processes)
+
+    def stop_workers_pool(self):
+        if self.qmanager.workers_pool:
+            self.logger.info('Stopping query workers')
+            self.qmanager.stop_workers_pool()
+
     def exception_handler(f):
         @wraps(f)
         def wrapper(inst, *args, **kwargs):
@@ -77,6 +176,32 @@ class QueryService():
         response.status = return_code
         return body
 
+    def admission_control(f):
+        @wraps(f)
+        def wrapper(inst, *args, **kwargs):
+            if not inst.admission_controller.acquire():
+                inst._error('Too many running queries, retry later', 503)
+            try:
+                return f(inst, *args, **kwargs)
+            finally:
+                inst.admission_controller.release()
+        return wrapper
+
+    def _get_query_timeout(self, params):
+        timeout = params.get('timeout')
+        if timeout:
+            try:
+                timeout = float(timeout)
+            except ValueError:
+                timeout = 0
+            if timeout <= 0:
+                self._error('timeout must be a number greater than 0', 400)
+            # the timeout configured for the service can't be exceeded
+            if self.query_timeout:
+                timeout = min(timeout, self.query_timeout)
+            return timeout
+        return self.query_timeout
+
     def _execute_query(self, params, count_only):
         aql_query = params.get('query')
         if not aql_query:
@@ -84,10 +209,37 @@ class QueryService():
         query_params = params.get('query_params')
         if query_params:
             query_params = json.loads(query_params)
-        results = self.qmanager.execute_aql_query(aql_query, query_params, count_only)
+        page_size, page_token = None, None
+        if not count_only:
+            page_size = params.get('page_size')
+            if page_size:
+                try:
+                    page_size = int(page_size)
+                except ValueError:
+                    page_size = 0
+                if page_size < 1:
+                    self._error('page_size must be an integer greater than 0', 400)
+            else:
+                page_size = None
+            page_token = params.get('page_token') or None
+            if page_token and not page_size:
+                self._missing_mandatory_field('page_size')
+        timeout = self._get_query_timeout(params)
+        query_id = params.get('query_id') or None
+        try:
+            results = self.qmanager.execute_aql_query(aql_query, query_params, count_only,
+                                                      page_size=page_size, page_token=page_token,
+                                                      timeout=timeout, query_id=query_id)
+        except pyehr_errors.InvalidPageTokenError, ipte:
+            self._error(str(ipte), 400)
+        except pyehr_errors.QueryTimeoutError, qte:
+            self._error(str(qte), 504)
+        except pyehr_errors.QueryCancelledError, qce:
+            self._error(str(qce), 409)
         return results
 
     @exception_handler
+    @admission_control
     def execute_query(self):
         params = request.forms
         results = self._execute_query(params, count_only=False)
@@ -98,6 +250,7 @@ class QueryService():
         return self._success(response_body)
 
     @exception_handler
+    @admission_control
     def execute_count_query(self):
         params = request.forms
         results = self._execute_query(params, count_only=True)
@@ -107,12 +260,66 @@ class QueryService():
         }
         return self._success(response_body)
 
+    @exception_handler
+    @admission_control
+    def execute_batch_query(self):
+        params = request.forms
+        queries = params.get('queries')
+        if not queries:
+            self._missing_mandatory_field('queries')
+        queries = json.loads(queries)
+        if not isinstance(queries, dict):
+            self._error('queries field must be a JSON object mapping labels to AQL queries', 400)
+        query_params = params.get('query_params')
+        if query_params:
+            query_params = json.loads(query_params)
+            if not isinstance(query_params, dict):
+                self._error('query_params field must be a JSON object mapping labels to query parameters', 400)
+        results = self.qmanager.execute_many(queries, query_params)
+        response_body = {
+            'SUCCESS': True,
+            'RESULTS_SETS': dict((label, rs.to_json()) for label, rs in results.iteritems())
+        }
+        return self._success(response_body)
+
+    @exception_handler
+    def cancel_query(self):
+        params = request.forms
+        query_id = params.get('query_id')
+        if not query_id:
+            self._missing_mandatory_field('query_id')
+        if not self.qmanager.cancel_query(query_id):
+            self._error('There is no running query with ID %s' % query_id, 404)
+        response_body = {
+            'SUCCESS': True,
+            'QUERY_ID': query_id
+        }
+        return self._success(response_body)
+
+    def _handle_sigterm(self, signum, frame):
+        raise KeyboardInterrupt()
+
     def start_service(self, host, port, engine, debug=False):
         self.logger.info('Starting QueryService daemon with DEBUG set to %s', debug)
+        # handle SIGTERM like a CTRL+C, this way the web server stops
+        # gracefully and query workers are shut down as well
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        if self.async_mode:
+            self.logger.info('Running in async mode, up to %d concurrent queries',
+                             self.qmanager.max_concurrent_queries)
+            self.qmanager.start()
+        # /query/cancel and the admission controller need requests to be served while
+        # other queries are running, the default wsgiref server handles one request at a time
+        if engine == 'wsgiref':
+            engine = ThreadingWSGIRefServer
         try:
             run(host=host, port=port, server=engine, debug=debug)
         except Exception, e:
             self.logger.critical('An error has occurred: %s', e)
+        finally:
+            if self.async_mode:
+                self.qmanager.stop()
+            self.stop_workers_pool()
 
     def test_server(self):
         return 'QueryManager daemon running'
@@ -141,11 +348,17 @@ def main(argv):
         msg = 'It was impossible to load configuration, exit'
         logger.critical(msg)
         sys.exit(msg)
+    async_conf = conf.get_query_service_async_configuration()
     qservice = QueryService(log_file=args.log_file, log_level=args.log_level,
+                            async_mode=async_conf['async_mode'],
+                            max_concurrent_queries=async_conf['max_concurrent_queries'],
                             **conf.get_db_configuration())
     qservice.add_index_service(**conf.get_index_configuration())
+    qservice.set_results_cache(**conf.get_query_service_cache_configuration())
+    qservice.set_limits(**conf.get_query_service_limits_configuration())
     check_pid_file(args.pid_file, logger)
     create_pid(args.pid_file)
+    qservice.start_workers_pool(**conf.get_query_service_workers_configuration())
     qservice.start_service(debug=args.debug, **conf.get_query_service_configuration())
     destroy_pid(args.pid_file)
 
@@ -1,15 +1,20 @@
 import argparse, sys, time, multiprocessing, gzip
+from itertools import islice
 
 from records_builder import get_patient_records_from_file, get_patient_records_from_file_row
 
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
-from pyehr.ehr.services.dbmanager.errors import DuplicatedKeyError
 from pyehr.utils.services import get_service_configuration, get_logger
 
 
 class DataLoaderThread(multiprocessing.Process):
-    def __init__(self, db_service_conf, index_service_conf, file_row, logger):
+    def __init__(self, db_service_conf, index_service_conf, file_row, logger, ingest_session=None):
         multiprocessing.Process.__init__(self)
+        if ingest_session:
+            # write using the bulk ingest session opened by the parent process
+            driver_options = dict(db_service_conf.get('driver_options') or {})
+            driver_options['ingest_session'] = ingest_session
+            db_service_conf = dict(db_service_conf, driver_options=driver_options)
         self.db_service = DBServices(**db_service_conf)
         self.db_service.set_index_service(**index_service_conf)
         self.dataset_row = file_row
@@ -46,6 +51,8 @@ def get_parser():
                         help='clean pyEHR databases before dumping new records')
     parser.add_argument('--parallel_processes', type=int, default=1,
                         help='The number of parallel processes used to load data (tool is single process by default)')
+    parser.add_argument('--batch_size', type=int, default=100,
+                        help='The number of patients saved together by a single process (default=100)')
     parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
     parser.add_argument('--log_level', type=str, default='INFO',
                         help='LOG level (default=INFO)')
@@ -74,24 +81,37 @@ def clean_database(db_service, logger):
     logger.info('Cleanup completed')
 
 
-def dump_records(dataset_file, compressed_file, db_service, logger):
+def dump_records(dataset_file, compressed_file, db_service, logger, batch_size=100):
     logger.info('Dumping records to database')
     total_dump_start_time = time.time()
-    for patient, crecs in get_patient_records_from_file(dataset_file, compressed_file):
-        logger.info('Creating patient %s' % patient.record_id)
-        try:
-            patient = db_service.save_patient(patient)
-        except DuplicatedKeyError:
-            logger.info('Patient with ID %s already exists, adding ClinicalRecords to it' % patient.record_id)
-            patient = db_service.get_patient(patient.record_id, fetch_ehr_records=False)
-        logger.info('Saving %d ClinicalRecord objects' % len(crecs))
-        start_time = time.time()
-        db_service.save_ehr_records(crecs, patient)
-        logger.info('ClinicalRecords saved in %f seconds' % (time.time() - start_time))
+    patient_records = get_patient_records_from_file(dataset_file, compressed_file)
+    with db_service.bulk_ingest():
+        while True:
+            batch = list(islice(patient_records, batch_size))
+            if not batch:
+                break
+            patients = list()
+            for patient, crecs in batch:
+                patient.ehr_records = crecs
+                patients.append(patient)
+            logger.info('Creating %d patients with %d ClinicalRecord objects' %
+                        (len(patients), sum(len(crecs) for _, crecs in batch)))
+            start_time = time.time()
+            saved, failures = db_service.save_patients_with_records(patients)
+            logger.info('%d patients saved in %f seconds' % (len(saved), time.time() - start_time))
+            for patient, error in failures:
+                existing_patient = db_service.get_patient(patient.record_id, fetch_ehr_records=False)
+                if not existing_patient:
+                    logger.error('Unable to save patient %s: %s' % (patient.record_id, error))
+                    continue
+                logger.info('Patient with ID %s already exists, adding ClinicalRecords to it' % patient.record_id)
+                start_time = time.time()
+                db_service.save_ehr_records(patient.ehr_records, existing_patient)
+                logger.info('ClinicalRecords saved in %f seconds' % (time.time() - start_time))
     logger.info('Dump completed in %f seconds' % (time.time() - total_dump_start_time))
 
 
-def dump_records_multiprocess(dataset_file, compressed_file, dbs_conf, index_conf,
+def dump_records_multiprocess(dataset_file, compressed_file, db_service, dbs_conf, index_conf,
                               max_active_processes, logger):
     logger.info('Dumping records to database')
     total_dump_start_time = time.time()
@@ -100,21 +120,23 @@ def dump_records_multiprocess(dataset_file, compressed_file, dbs_conf, index_con
         f = gzip.open(dataset_file, 'rb')
     else:
         f = open(dataset_file)
-    for row in f.readlines():
-        proc = DataLoaderThread(dbs_conf, index_conf, row, logger)
-        active_processes.append(proc)
-        if len(active_processes) == max_active_processes:
-            for p in active_processes:
-                p.start()
-            # wait until all processes completed their runs
-            for p in active_processes:
-                p.join()
-            active_processes = list()
-    # check if there are hanging processes that didn't run
-    for p in active_processes:
-        p.start()
-    for p in active_processes:
-        p.join()
+    # a single session for all the processes, indexes are refreshed and checked once at the end
+    with db_service.bulk_ingest() as ingest_session:
+        for row in f.readlines():
+            proc = DataLoaderThread(dbs_conf, index_conf, row, logger, ingest_session)
+            active_processes.append(proc)
+            if len(active_processes) == max_active_processes:
+                for p in active_processes:
+                    p.start()
+                # wait until all processes completed their runs
+                for p in active_processes:
+                    p.join()
+                active_processes = list()
+        # check if there are hanging processes that didn't run
+        for p in active_processes:
+            p.start()
+        for p in active_processes:
+            p.join()
     f.close()
     logger.info('Dump completed in %f seconds' % (time.time() - total_dump_start_time))
 
@@ -128,9 +150,9 @@ def main(argv):
     if args.clean_db:
         clean_database(dbservice, logger)
     if args.parallel_processes == 1:
-        dump_records(args.datasets_file, args.compression_enabled, dbservice, logger)
+        dump_records(args.datasets_file, args.compression_enabled, dbservice, logger, args.batch_size)
     else:
-        dump_records_multiprocess(args.datasets_file, args.compression_enabled, dbservice_cfg,
+        dump_records_multiprocess(args.datasets_file, args.compression_enabled, dbservice, dbservice_cfg,
                                   index_service_cfg, args.parallel_processes, logger)
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import argparse, sys, time
+
+from pyehr.aql.parser import Parser
+from pyehr.ehr.services.dbmanager.drivers.elastic_search import ElasticSearchDriver
+from pyehr.utils import get_logger
+
+ARCHETYPE_ID = 'openEHR-EHR-OBSERVATION.blood_pressure.v1'
+VALUE_PATH = 'o/data[at0001]/events[at0006]/data[at0003]/items[at%04d]/value/magnitude'
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Measure the time needed by the Elasticsearch driver to build the '
+                                     'queries for AQL statements with growing WHERE sections, no '
+                                     'Elasticsearch server is contacted')
+    parser.add_argument('--predicates', type=int, nargs='+', default=[1, 5, 10, 25, 50, 100],
+                        help='The numbers of predicates of the WHERE statements (default 1 5 10 25 50 100)')
+    parser.add_argument('--structures', type=int, default=100,
+                        help='The number of structures matching the CONTAINS statement (default 100)')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='How many times each query is built (default 10)')
+    parser.add_argument('--log_file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log_level', type=str, default='INFO',
+                        help='LOG level (default=INFO)')
+    return parser
+
+
+def build_aql_query(predicates_count):
+    # alternate AND and OR operators, odd predicates are negated, in order to cover all the mappings
+    where_statement = list()
+    for i in xrange(predicates_count):
+        if i > 0:
+            where_statement.append('OR' if i % 3 == 0 else 'AND')
+        operand = '!=' if i % 2 else '>='
+        where_statement.append('%s %s %d' % (VALUE_PATH % (i + 5), operand, i))
+    return 'SELECT e/ehr_id/value AS patient_identifier, %s AS value FROM Ehr e ' \
+           'CONTAINS Observation o[%s] WHERE %s' % (VALUE_PATH % 4, ARCHETYPE_ID, ' '.join(where_statement))
+
+
+def build_contains_mapping(structures_count):
+    # each structure has its own path, so that queries can't be aggregated
+    structures_map = dict()
+    for i in xrange(structures_count):
+        path = ['openEHR-EHR-COMPOSITION.encounter.v1', 'content[%s]' % ARCHETYPE_ID] + \
+               ['items[openEHR-EHR-SECTION.section_%d.v1]' % j for j in xrange(i % 10)]
+        structures_map['structure_%d' % i] = [{ARCHETYPE_ID: path}]
+    return structures_map, {'o': ARCHETYPE_ID}
+
+
+def run_benchmark(predicates_count, structures_count, repeats, logger):
+    driver = ElasticSearchDriver('localhost', 'benchmark_db', 'ehr', logger=logger)
+    query_model = Parser().parse(build_aql_query(predicates_count))
+    contains_mapping = build_contains_mapping(structures_count)
+    start_time = time.time()
+    for _ in xrange(repeats):
+        sub_queries = driver.build_sub_queries(query_model, 'patients', 'ehr',
+                                               contains_mapping=contains_mapping)
+    execution_time = (time.time() - start_time) / repeats
+    logger.info('%d predicates, %d structures: %d sub-queries (%d bytes) built in %f seconds',
+                predicates_count, structures_count, len(sub_queries),
+                sum(len(sq['condition']) for sq in sub_queries), execution_time)
+    return execution_time
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logger = get_logger('es_query_builder_benchmark', log_file=args.log_file, log_level=args.log_level)
+    for predicates_count in args.predicates:
+        # builders of previous revisions may not be able to map every WHERE statement,
+        # report the failure and go on with the other sizes
+        try:
+            run_benchmark(predicates_count, args.structures, args.repeats, logger)
+        except Exception, e:
+            logger.error('%d predicates, %d structures: unable to build sub-queries (%s: %s)',
+                         predicates_count, args.structures, type(e).__name__, e)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
\ No newline at end of file
@@ -2,7 +2,7 @@ import unittest, sys, os, uuid
 from collections import Counter
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
 from pyehr.ehr.services.dbmanager.dbservices.wrappers import PatientRecord,\
-    ClinicalRecord, ArchetypeInstance
+    ClinicalRecord, LazyClinicalRecord, ArchetypeInstance
 from pyehr.ehr.services.dbmanager.errors import DuplicatedKeyError
 from pyehr.utils.services import get_service_configuration
 
@@ -84,6 +84,53 @@ class TestDBServices(unittest.TestCase):
         # cleanup
         dbs.delete_patient(pat_rec, cascade_delete=True)
 
+    def test_save_patients_with_records(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        existing_patient = dbs.save_patient(self.create_random_patient())
+        existing_ehr, existing_patient = dbs.save_ehr_record(
+            ClinicalRecord(ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                             {'field1': 'value1'})),
+            existing_patient
+        )
+
+        def build_patient(patient_id=None, records_count=3):
+            patient = PatientRecord(record_id=patient_id or uuid.uuid4().hex)
+            patient.ehr_records = [ClinicalRecord(ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                                                    {'field1': 'value%d' % x}))
+                                   for x in xrange(records_count)]
+            return patient
+        good_patient = build_patient()
+        empty_patient = build_patient(records_count=0)
+        # the patient already exists
+        duplicated_patient = build_patient(existing_patient.record_id)
+        # the ID of the patient is used twice in this batch
+        batch_duplicated_patient = build_patient(good_patient.record_id)
+        # one of the records has an ID already in use
+        duplicated_ehr_patient = build_patient()
+        duplicated_ehr_patient.ehr_records[1].record_id = existing_ehr.record_id
+        saved, failures = dbs.save_patients_with_records([good_patient, empty_patient, duplicated_patient,
+                                                          batch_duplicated_patient, duplicated_ehr_patient])
+        self.assertEqual(saved, [good_patient, empty_patient])
+        self.assertEqual([p for p, _ in failures], [batch_duplicated_patient, duplicated_patient,
+                                                    duplicated_ehr_patient])
+        loaded_patient = dbs.get_patient(good_patient.record_id)
+        self.assertEqual(len(loaded_patient.ehr_records), 3)
+        for ehr in loaded_patient.ehr_records:
+            self.assertEqual(ehr.version, 1)
+            self.assertEqual(ehr.patient_id, good_patient.record_id)
+        self.assertEqual(len(dbs.get_patient(empty_patient.record_id).ehr_records), 0)
+        self.assertEqual(len(dbs.get_patient(existing_patient.record_id).ehr_records), 1)
+        # data of the failed patient were removed
+        self.assertIsNone(dbs.get_patient(duplicated_ehr_patient.record_id))
+        for ehr in duplicated_ehr_patient.ehr_records:
+            self.assertFalse(ehr.is_persistent)
+        self.assertEqual(dbs.get_ehr_record(existing_ehr.record_id, existing_patient.record_id),
+                         existing_ehr)
+        # cleanup
+        for pat_rec in saved + [existing_patient]:
+            dbs.delete_patient(pat_rec, cascade_delete=True)
+
     def test_remove_ehr_record(self):
         dbs = DBServices(**self.conf)
         dbs.set_index_service(**self.index_conf)
@@ -220,17 +267,74 @@ class TestDBServices(unittest.TestCase):
         # cleanup
         dbs.delete_patient(p, cascade_delete=True)
 
+    def test_iter_patients(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        # small batches, in order to load patients and records with more than one request
+        dbs.records_batch_size = 2
+        patients = dict()
+        for x in xrange(3):
+            pat_rec = dbs.save_patient(self.create_random_patient())
+            for y in xrange(3):
+                arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                         {'ehr_field': 'ehr_value%02d' % y})
+                ehr_rec, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+            patients[pat_rec.record_id] = pat_rec
+        hidden_rec = dbs.hide_ehr_record(ehr_rec)
+        loaded = dict((p.record_id, p) for p in dbs.iter_patients(chunk_size=2)
+                      if p.record_id in patients)
+        self.assertEqual(len(loaded), 3)
+        for pat_id, pat_rec in loaded.iteritems():
+            expected = 2 if pat_id == hidden_rec.patient_id else 3
+            self.assertEqual(len(pat_rec.ehr_records), expected)
+            self.assertNotIn(hidden_rec.record_id, [e.record_id for e in pat_rec.ehr_records])
+        loaded = dict((p.record_id, p) for p in dbs.get_patients(fetch_hidden_ehr=True)
+                      if p.record_id in patients)
+        for pat_rec in loaded.itervalues():
+            self.assertEqual(len(pat_rec.ehr_records), 3)
+        # cleanup
+        for pat_rec in loaded.itervalues():
+            dbs.delete_patient(pat_rec, cascade_delete=True)
+
+    def test_lazy_ehr_records(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        pat_rec = dbs.save_patient(self.create_random_patient())
+        arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                 {'ehr_field': 'ehr_value'})
+        ehr_rec, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+        lazy_pat = dbs.get_patient(pat_rec.record_id, lazy_ehr_records=True)
+        lazy_rec = lazy_pat.ehr_records[0]
+        self.assertIsInstance(lazy_rec, LazyClinicalRecord)
+        self.assertFalse(lazy_rec.is_loaded)
+        self.assertEqual(lazy_rec, ehr_rec)
+        self.assertEqual(lazy_rec.version, ehr_rec.version)
+        self.assertEqual(lazy_rec.patient_id, pat_rec.record_id)
+        self.assertEqual(lazy_rec.ehr_data.archetype_details, {'ehr_field': 'ehr_value'})
+        self.assertTrue(lazy_rec.is_loaded)
+        # metadata only, retrieved with a projection
+        meta_pat = dbs.get_patient(pat_rec.record_id, fetch_ehr_records=False)
+        meta_rec = meta_pat.ehr_records[0]
+        self.assertEqual(meta_rec.version, ehr_rec.version)
+        self.assertEqual(meta_rec.ehr_data.archetype_class, arch.archetype_class)
+        self.assertEqual(meta_rec.ehr_data.archetype_details, {})
+        # cleanup
+        dbs.delete_patient(pat_rec, cascade_delete=True)
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestDBServices('test_save_patient'))
     suite.addTest(TestDBServices('test_save_ehr_record'))
     suite.addTest(TestDBServices('test_save_ehr_records'))
+    suite.addTest(TestDBServices('test_save_patients_with_records'))
     suite.addTest(TestDBServices('test_remove_ehr_record'))
     suite.addTest(TestDBServices('test_load_ehr_records'))
     suite.addTest(TestDBServices('test_hide_ehr_record'))
     suite.addTest(TestDBServices('test_move_ehr_record'))
     suite.addTest(TestDBServices('test_get_ehr_record'))
+    suite.addTest(TestDBServices('test_iter_patients'))
+    suite.addTest(TestDBServices('test_lazy_ehr_records'))
     return suite
 
 if __name__ == '__main__':
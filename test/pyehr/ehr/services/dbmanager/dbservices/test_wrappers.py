@@ -1,6 +1,6 @@
 import unittest, time
 from pyehr.ehr.services.dbmanager.dbservices.wrappers \
-    import ClinicalRecord, PatientRecord, ArchetypeInstance
+    import ClinicalRecord, LazyClinicalRecord, PatientRecord, ArchetypeInstance
 from pyehr.ehr.services.dbmanager.errors import InvalidJsonStructureError
 
 
@@ -113,6 +113,33 @@ class TestWrapper(unittest.TestCase):
         crec2 = build_clinical_record()
         self.assertNotEqual(crec1, crec2)
 
+    def test_lazy_clinical_record(self):
+        calls = []
+
+        def loader():
+            calls.append(True)
+            return ArchetypeInstance.from_json({
+                'archetype_class': 'openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                'archetype_details': {'field1': 'value1'}
+            })
+        crec = LazyClinicalRecord(ehr_data_loader=loader, record_id='5314b3a55c98931a8a3d1a2c',
+                                  version=2)
+        # metadata don't require clinical data
+        self.assertEqual(crec.version, 2)
+        self.assertFalse(crec.is_loaded)
+        self.assertEqual(calls, [])
+        self.assertEqual(crec, ClinicalRecord(ehr_data=None, record_id='5314b3a55c98931a8a3d1a2c'))
+        self.assertEqual(crec.ehr_data.archetype_details, {'field1': 'value1'})
+        self.assertEqual(crec.to_json()['ehr_data']['archetype_class'],
+                         'openEHR-EHR-EVALUATION.dummy-evaluation.v1')
+        self.assertTrue(crec.is_loaded)
+        self.assertEqual(len(calls), 1)
+        # assigned clinical data replace the loader
+        crec = LazyClinicalRecord(ehr_data_loader=loader)
+        crec.ehr_data = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1', {})
+        self.assertEqual(crec.ehr_data.archetype_details, {})
+        self.assertEqual(len(calls), 1)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -120,6 +147,7 @@ def suite():
     suite.addTest(TestWrapper('test_from_json'))
     suite.addTest(TestWrapper('test_get_clinical_record'))
     suite.addTest(TestWrapper('test_equal_records'))
+    suite.addTest(TestWrapper('test_lazy_clinical_record'))
     return suite
 
 if __name__ == '__main__':
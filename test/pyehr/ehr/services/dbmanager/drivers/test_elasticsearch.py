@@ -1,5 +1,6 @@
 import unittest
 from pyehr.ehr.services.dbmanager.drivers.elastic_search import ElasticSearchDriver
+from pyehr.ehr.services.dbmanager.drivers import elastic_search_dsl as dsl
 
 
 class TestElasticSearchDriver(unittest.TestCase):
@@ -97,6 +98,84 @@ class TestElasticSearchDriver(unittest.TestCase):
             # cleanup
             driver.delete_record(rec_id)
 
+    def test_update_field_multi(self):
+        records = [{'_id': str(x), 'label': 'label', 'version': 1} for x in xrange(0, 5)]
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            record_ids, _ = driver.add_records(records)
+            last_update = driver.update_field_multi(record_ids, 'label', 'new_label', 'last_update', True)
+            for rid in record_ids:
+                rec = driver.get_record_by_id(rid)
+                self.assertEqual(rec['label'], 'new_label')
+                self.assertEqual(rec['last_update'], last_update)
+                self.assertEqual(rec['version'], 2)
+            # cleanup
+            for rid in record_ids:
+                driver.delete_record(rid)
+
+    def test_update_list(self):
+        record = {
+            '_id': '1',
+            'items': ['a'],
+            'version': 1
+        }
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            rec_id = driver.add_record(record)
+            driver.add_to_list(rec_id, 'items', 'b')
+            driver.extend_list(rec_id, 'items', ['c', 'd'], None)
+            self.assertEqual(driver.get_record_by_id(rec_id)['items'], ['a', 'b', 'c', 'd'])
+            driver.remove_from_list(rec_id, 'items', ['a', 'c'], increase_version=True)
+            rec = driver.get_record_by_id(rec_id)
+            self.assertEqual(rec['items'], ['b', 'd'])
+            self.assertEqual(rec['version'], 2)
+            # only the first occurrence of an item is removed
+            driver.add_to_list(rec_id, 'items', 'b')
+            driver.remove_from_list(rec_id, 'items', 'b')
+            self.assertEqual(driver.get_record_by_id(rec_id)['items'], ['d', 'b'])
+            with self.assertRaises(ValueError):
+                driver.remove_from_list(rec_id, 'items', 'z')
+            self.assertEqual(driver.get_record_by_id(rec_id)['items'], ['d', 'b'])
+            # cleanup
+            driver.delete_record(rec_id)
+
+    def test_revisions_routing(self):
+        revisions = [{
+            '_id': 'record_%d' % v,
+            'ehr_structure_id': 'structure',
+            'ehr_data': {'field': v},
+            'version': v,
+            'archived': True
+        } for v in xrange(1, 4)]
+        # both the lookup table (default) and the routing layouts
+        for record_routing in (False, True):
+            with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection',
+                                     record_routing=record_routing) as driver:
+                for rev in revisions:
+                    driver.add_record(dict(rev))
+                self.assertEqual(driver.get_record_by_version('record', 2), revisions[1])
+                self.assertIsNone(driver.get_record_by_version('record', 4))
+                self.assertEqual(sorted(r['version'] for r in driver.get_revisions_by_ehr_id('record')), [1, 2, 3])
+                self.assertEqual(driver.delete_later_versions('record', 1), 2)
+                self.assertEqual([r['version'] for r in driver.get_revisions_by_ehr_id('record')], [1])
+                driver.delete_record('record_1')
+                self.assertIsNone(driver.get_record_by_id('record_1'))
+
+    def test_patient_routing(self):
+        condition = dsl.merge_clauses(dsl.clauses('filter', dsl.term('patient_id', 'PATIENT_01'),
+                                                  dsl.exists('ehr_data')),
+                                      dsl.clauses('must_not', dsl.term('active', False)))
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection',
+                                     patient_routing=True)
+        self.assertEqual(driver._get_condition_routing(condition), 'PATIENT_01')
+        self.assertIsNone(driver._get_condition_routing(dsl.clauses('must_not', dsl.term('patient_id', 'PATIENT_01'))))
+        record = {'_id': 'record_2', 'patient_id': 'PATIENT_01', 'ehr_data': {}, 'archived': True}
+        self.assertEqual(driver._get_routing(record), 'PATIENT_01')
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection')
+        self.assertIsNone(driver._get_condition_routing(condition))
+        self.assertIsNone(driver._get_routing(record))
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection',
+                                     record_routing=True)
+        self.assertEqual(driver._get_routing(record), 'record')
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -107,6 +186,10 @@ def suite():
     suite.addTest(TestElasticSearchDriver('test_get_record_by_id'))
     suite.addTest(TestElasticSearchDriver('test_get_records_by_value'))
     suite.addTest(TestElasticSearchDriver('test_update_field'))
+    suite.addTest(TestElasticSearchDriver('test_update_field_multi'))
+    suite.addTest(TestElasticSearchDriver('test_update_list'))
+    suite.addTest(TestElasticSearchDriver('test_revisions_routing'))
+    suite.addTest(TestElasticSearchDriver('test_patient_routing'))
     return suite
 
 if __name__ == '__main__':
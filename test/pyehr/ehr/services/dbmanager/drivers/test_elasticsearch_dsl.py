@@ -0,0 +1,48 @@
+import unittest
+from pyehr.ehr.services.dbmanager.drivers import elastic_search_dsl as dsl
+
+
+class TestElasticSearchDSL(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestElasticSearchDSL, self).__init__(label)
+
+    def test_merge_clauses(self):
+        condition = dsl.clauses('must', dsl.match('a', 1))
+        dsl.merge_clauses(condition, dsl.clauses('must', dsl.match('a', 1), dsl.range_query('b', 'gt', 2)))
+        dsl.merge_clauses(condition, {'should': [dsl.match('c', 3)], 'minimum_should_match': 1})
+        self.assertEqual(condition, {
+            'must': [{'match': {'a': 1}}, {'range': {'b': {'gt': 2}}}],
+            'should': [{'match': {'c': 3}}],
+            'minimum_should_match': 1
+        })
+        self.assertRaises(ValueError, dsl.clauses, 'must_match', dsl.match('a', 1))
+        self.assertRaises(ValueError, dsl.range_query, 'b', 'eq', 2)
+
+    def test_to_query(self):
+        self.assertEqual(dsl.to_query(dict()), {'match_all': {}})
+        self.assertEqual(dsl.to_query(dsl.clauses('must', dsl.match('a', 1))), {'match': {'a': 1}})
+        self.assertEqual(dsl.to_query(dsl.clauses('filter', dsl.term('a', 1))), {'term': {'a': 1}})
+        self.assertEqual(dsl.to_query(dsl.clauses('must_not', dsl.match('a', 1))),
+                         {'bool': {'must_not': [{'match': {'a': 1}}]}})
+        condition = dsl.clauses('must', dsl.match('a', 1))
+        dsl.merge_clauses(condition, dsl.clauses('filter', dsl.terms('ehr_structure_id', ['str_1', 'str_2'])))
+        self.assertEqual(dsl.search_body(dsl.to_query(condition)), {
+            'query': {
+                'bool': {
+                    'must': [{'match': {'a': 1}}],
+                    'filter': [{'terms': {'ehr_structure_id': ['str_1', 'str_2']}}]
+                }
+            }
+        })
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestElasticSearchDSL('test_merge_clauses'))
+    suite.addTest(TestElasticSearchDSL('test_to_query'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
\ No newline at end of file
@@ -0,0 +1,43 @@
+import unittest
+from pyehr.ehr.services.dbmanager.drivers.mongo_indexes import MongoIndexManager
+
+
+class TestMongoIndexManager(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestMongoIndexManager, self).__init__(label)
+
+    def test_condition_fields(self):
+        condition = {
+            'ehr_structure_id': {'$in': ['str_1', 'str_2']},
+            '$or': [
+                {'ehr_data.data.value': {'$gt': 10}, 'ehr_structure_id': 'str_1'},
+                {'$and': [{'ehr_data.other.value': 'abc'}, {'patient_id': 'PATIENT_01'}]}
+            ]
+        }
+        self.assertEqual(MongoIndexManager.get_condition_fields(condition),
+                         set(['ehr_structure_id', 'ehr_data.data.value',
+                              'ehr_data.other.value', 'patient_id']))
+
+    def test_covered_indexes(self):
+        manager = MongoIndexManager(None)
+        indexes = {
+            '_id_': [('_id', 1)],
+            'versions': [('_id._id', 1), ('_version', 1)]
+        }
+        self.assertTrue(manager._is_covered([('_id._id', 1)], indexes))
+        self.assertTrue(manager._is_covered([('_id._id', 1), ('_version', 1)], indexes))
+        self.assertFalse(manager._is_covered([('_version', 1)], indexes))
+        self.assertNotEqual(manager.get_partial_index_name('a.b', 'str_1'),
+                            manager.get_partial_index_name('a.b', 'str_2'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestMongoIndexManager('test_condition_fields'))
+    suite.addTest(TestMongoIndexManager('test_covered_indexes'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
\ No newline at end of file
@@ -0,0 +1,91 @@
+import unittest
+from pyehr.ehr.services.dbmanager.drivers.mongo_planner import MongoQueryPlanner
+
+
+class TestMongoQueryPlanner(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestMongoQueryPlanner, self).__init__(label)
+
+    def _get_queries(self, structure_ids, conditions=None, selection=None):
+        conditions = conditions or [{'patient_id': 'PATIENT_01'}]
+        selection = selection or {'ehr_data.data.value': True}
+        return dict((sid, [{'condition': dict(c), 'selection': selection,
+                            'aliases': {'ehr_data.data.value': 'value'}} for c in conditions])
+                    for sid in structure_ids)
+
+    def test_strategies(self):
+        index = [['ehr_structure_id', 1]]
+        planner = MongoQueryPlanner(100000, index, parallel=True)
+        self.assertEqual(planner.choose_strategy(3, 50000), 'scan')
+        self.assertEqual(planner.choose_strategy(3, 20000), 'union')
+        self.assertEqual(planner.choose_strategy(3, 500), 'in')
+        self.assertEqual(planner.choose_strategy(1, 20000), 'in')
+        self.assertEqual(MongoQueryPlanner(100000, index).choose_strategy(3, 20000), 'in')
+        self.assertEqual(MongoQueryPlanner(100000, None).choose_strategy(3, 500), 'scan')
+
+    def test_in_plan(self):
+        planner = MongoQueryPlanner(100000, [['ehr_structure_id', 1]])
+        queries = self._get_queries(['str_1', 'str_2'])
+        plan = planner.plan(queries, {'str_1': 10, 'str_2': 20})
+        self.assertEqual(len(plan), 1)
+        self.assertEqual(plan[0]['strategy'], 'in')
+        self.assertEqual(plan[0]['estimated_records'], 30)
+        self.assertEqual(plan[0]['hint'], [['ehr_structure_id', 1]])
+        self.assertEqual(plan[0]['condition'], {'patient_id': 'PATIENT_01',
+                                                'ehr_structure_id': {'$in': ['str_1', 'str_2']}})
+
+    def test_or_conditions(self):
+        planner = MongoQueryPlanner(100000, [['ehr_structure_id', 1]])
+        queries = self._get_queries(['str_1'], [{'a': 1}, {'b': 1}])
+        queries.update(self._get_queries(['str_2'], [{'a': 1}]))
+        plan = planner.plan(queries, {'str_1': 10, 'str_2': 20})
+        self.assertEqual(len(plan), 1)
+        condition = plan[0]['condition']
+        # the $or is bounded by a top level clause on the structure ID
+        self.assertEqual(condition['ehr_structure_id'], {'$in': ['str_1', 'str_2']})
+        self.assertEqual(len(condition['$or']), 2)
+        self.assertIn({'a': 1, 'ehr_structure_id': {'$in': ['str_1', 'str_2']}}, condition['$or'])
+        self.assertIn({'b': 1, 'ehr_structure_id': 'str_1'}, condition['$or'])
+
+    def test_union_plan(self):
+        planner = MongoQueryPlanner(100000, [['ehr_structure_id', 1]], parallel=True)
+        queries = self._get_queries(['str_1', 'str_2', 'str_3'])
+        plan = planner.plan(queries, {'str_1': 5000, 'str_2': 5000, 'str_3': 5000})
+        self.assertEqual(len(plan), 3)
+        self.assertEqual(set(p['strategy'] for p in plan), set(['union']))
+        self.assertEqual(sorted(p['condition']['ehr_structure_id'] for p in plan),
+                         ['str_1', 'str_2', 'str_3'])
+        # conditions are merged when selections are not needed
+        planner = MongoQueryPlanner(100000, [['ehr_structure_id', 1]])
+        queries.update(self._get_queries(['str_4'], selection={'ehr_data.other.value': True}))
+        self.assertEqual(len(planner.plan(queries, {})), 2)
+        self.assertEqual(len(planner.plan(queries, {}, merge_selections=True)), 1)
+
+    def test_partial_indexes(self):
+        planner = MongoQueryPlanner(100000, [['ehr_structure_id', 1]],
+                                    partial_indexes={'str_1': {'a': 'pyehr_partial_1'}})
+        # a single structure with a partial index on the condition field
+        plan = planner.plan(self._get_queries(['str_1'], [{'a': 1}]), {'str_1': 10})
+        self.assertEqual(plan[0]['hint'], 'pyehr_partial_1')
+        # the partial index doesn't cover the condition
+        plan = planner.plan(self._get_queries(['str_1'], [{'b': 1}]), {'str_1': 10})
+        self.assertEqual(plan[0]['hint'], [['ehr_structure_id', 1]])
+        # more structures, MongoDB chooses the indexes
+        plan = planner.plan(self._get_queries(['str_1', 'str_2'], [{'a': 1}]), {'str_1': 10, 'str_2': 10})
+        self.assertEqual(plan[0]['strategy'], 'in')
+        self.assertIsNone(plan[0]['hint'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestMongoQueryPlanner('test_strategies'))
+    suite.addTest(TestMongoQueryPlanner('test_in_plan'))
+    suite.addTest(TestMongoQueryPlanner('test_or_conditions'))
+    suite.addTest(TestMongoQueryPlanner('test_union_plan'))
+    suite.addTest(TestMongoQueryPlanner('test_partial_indexes'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
\ No newline at end of file
@@ -0,0 +1,78 @@
+import unittest
+from pyehr.ehr.services.dbmanager.querymanager.bitmap_index import PatientsBitmapIndex,\
+    PatientsDictionary, bitmap_to_bytes, bytes_to_bitmap
+
+
+class TestBitmapIndex(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestBitmapIndex, self).__init__(label)
+
+    def test_patients_dictionary(self):
+        dictionary = PatientsDictionary()
+        patients = ['PATIENT_%03d' % x for x in xrange(100)]
+        bitmap = dictionary.to_bitmap(patients[::3])
+        self.assertEqual(len(dictionary), 34)
+        self.assertEqual(sorted(dictionary.to_patient_ids(bitmap)), sorted(patients[::3]))
+        self.assertEqual(dictionary.get_index(patients[0]), 0)
+        self.assertEqual(dictionary.to_bitmap([]), 0)
+        self.assertEqual(dictionary.to_patient_ids(0), [])
+        self.assertEqual(bytes_to_bitmap(bitmap_to_bytes(bitmap)), bitmap)
+
+    def test_set_operations(self):
+        index = PatientsBitmapIndex(1024 * 1024)
+        patients = ['PATIENT_%03d' % x for x in xrange(100)]
+        b1 = index.from_patients(patients[::2])
+        b2 = index.from_patients(patients[::3])
+        self.assertEqual(set(index.to_patients(b1 & b2)), set(patients[::2]) & set(patients[::3]))
+        self.assertEqual(set(index.to_patients(b1 | b2)), set(patients[::2]) | set(patients[::3]))
+        self.assertEqual(set(index.to_patients(b1 & ~b2)), set(patients[::2]) - set(patients[::3]))
+
+    def test_get_and_put(self):
+        index = PatientsBitmapIndex(1024 * 1024)
+        patients = ['PATIENT_%04d' % x for x in xrange(10000)]
+        index.from_patients(patients)
+        bitmap = index.from_patients(patients[::100])
+        key = index.get_structure_key('str_1')
+        index.put(key, {'str_1': 3}, bitmap)
+        # bitmaps are stored compressed
+        self.assertTrue(index.size < len(bitmap_to_bytes(bitmap)))
+        self.assertEqual(index.get(key, {'str_1': 3}), bitmap)
+        self.assertIsNone(index.get(key, {'str_1': 4}))
+
+    def test_incremental_update(self):
+        index = PatientsBitmapIndex(1024 * 1024)
+        key = index.get_structure_key('str_1')
+        index.put(key, {'str_1': 1}, index.from_patients(['PATIENT_01']))
+        index.add_patient('str_1', 'PATIENT_02', 2)
+        self.assertEqual(set(index.to_patients(index.get(key, {'str_1': 2}))),
+                         set(['PATIENT_01', 'PATIENT_02']))
+        # a write was not seen by the index, the bitmap is evicted
+        index.add_patient('str_1', 'PATIENT_03', 4)
+        self.assertEqual(len(index), 0)
+        # nothing happens if there is no bitmap for the structure
+        index.add_patient('str_2', 'PATIENT_03', 1)
+        self.assertEqual(len(index), 0)
+
+    def test_batch_update(self):
+        index = PatientsBitmapIndex(1024 * 1024)
+        key = index.get_structure_key('str_1')
+        index.put(key, {'str_1': 1}, index.from_patients(['PATIENT_01']))
+        # the records of all the patients were saved with a single generation increase
+        index.add_patients('str_1', ['PATIENT_02', 'PATIENT_03'], 2)
+        self.assertEqual(set(index.to_patients(index.get(key, {'str_1': 2}))),
+                         set(['PATIENT_01', 'PATIENT_02', 'PATIENT_03']))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestBitmapIndex('test_patients_dictionary'))
+    suite.addTest(TestBitmapIndex('test_set_operations'))
+    suite.addTest(TestBitmapIndex('test_get_and_put'))
+    suite.addTest(TestBitmapIndex('test_incremental_update'))
+    suite.addTest(TestBitmapIndex('test_batch_update'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
\ No newline at end of file
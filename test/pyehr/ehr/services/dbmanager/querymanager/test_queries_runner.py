@@ -1,4 +1,4 @@
-import unittest, os, sys
+import unittest, os, sys, shutil, tempfile
 from random import randint
 from pyehr.ehr.services.dbmanager.querymanager.queries_runner import QueriesRunner
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
@@ -23,6 +23,8 @@ class TestQueriesRunner(unittest.TestCase):
         index_conf = sconf.get_index_configuration()
         self.dbs.set_index_service(**index_conf)
         self.queries_runner = QueriesRunner(db_conf, index_conf)
+        self.db_conf = db_conf
+        self.index_conf = index_conf
         self.patients = list()
 
     def tearDown(self):
@@ -171,6 +173,108 @@ class TestQueriesRunner(unittest.TestCase):
                                             'dyastolic_query')
         self.assertEqual(sorted(union_expected_results), sorted(res))
 
+    def test_set_algebra(self):
+        batch_details = self._build_patients_batch(30, 10, systolic_range=(1, 250),
+                                                   dyastolic_range=(1, 250))
+        sys_query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        """
+        dya_query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS dyastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 120
+        """
+        self.queries_runner.add_query('systolic_query', sys_query)
+        self.queries_runner.add_query('dyastolic_query', dya_query)
+        sys_patients = set(k for k, v in batch_details.iteritems()
+                           if any(x['systolic'] >= 180 for x in v))
+        dya_patients = set(k for k, v in batch_details.iteritems()
+                           if any(x['dyastolic'] >= 120 for x in v))
+        self.assertEqual(sys_patients & dya_patients,
+                         self.queries_runner.intersect('ehr_id.value', 'systolic_query', 'dyastolic_query'))
+        self.assertEqual(sys_patients | dya_patients,
+                         self.queries_runner.union('ehr_id.value', 'systolic_query', 'dyastolic_query'))
+        self.assertEqual(sys_patients - dya_patients,
+                         self.queries_runner.difference('ehr_id.value', 'systolic_query', 'dyastolic_query'))
+        # set operations don't require queries to be executed
+        self.assertEqual(self.queries_runner.results_count, 0)
+        with self.assertRaises(ValueError):
+            self.queries_runner.union('systolic', 'systolic_query')
+
+    def test_bitmap_set_algebra(self):
+        batch_details = self._build_patients_batch(20, 5, systolic_range=(1, 250),
+                                                   dyastolic_range=(1, 250))
+        bp_query = """
+        SELECT e/ehr_id/value AS patient_identifier
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        sys_query = """
+        SELECT e/ehr_id/value AS patient_identifier
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        """
+        self.queries_runner.add_query('bp_query', bp_query)
+        self.queries_runner.add_query('systolic_query', sys_query)
+        bitmap_index = self.queries_runner.enable_bitmap_index(1024 * 1024)
+        self.dbs.set_bitmap_index(bitmap_index)
+        sys_patients = set(k for k, v in batch_details.iteritems()
+                           if any(x['systolic'] >= 180 for x in v))
+        self.assertEqual(set(batch_details.keys()),
+                         self.queries_runner.union('ehr_id.value', 'bp_query'))
+        self.assertEqual(sys_patients,
+                         self.queries_runner.intersect('ehr_id.value', 'bp_query', 'systolic_query'))
+        self.assertEqual(set(batch_details.keys()) - sys_patients,
+                         self.queries_runner.difference('ehr_id.value', 'bp_query', 'systolic_query'))
+        # structure bitmaps are updated when new records are saved
+        new_patient = self.dbs.save_patient(PatientRecord('PATIENT_99'))
+        bp_arch = ArchetypeInstance(*self._get_blood_pressure_data(120, 80))
+        _, new_patient, _ = self.dbs.save_ehr_records([ClinicalRecord(bp_arch)], new_patient)
+        self.patients.append(new_patient)
+        self.assertEqual(set(batch_details.keys()) | set([new_patient.record_id]),
+                         self.queries_runner.union('ehr_id.value', 'bp_query'))
+        # patients saved in a batch are all added to the structure bitmap
+        batch_patients = list()
+        for x in xrange(2):
+            patient = PatientRecord('PATIENT_9%d' % (x + 7))
+            patient.ehr_records = [ClinicalRecord(ArchetypeInstance(*self._get_blood_pressure_data(120, 80)))]
+            batch_patients.append(patient)
+        saved, _ = self.dbs.save_patients_with_records(batch_patients)
+        self.patients.extend(saved)
+        structure_key = bitmap_index.get_structure_key(batch_patients[0].ehr_records[0].structure_id)
+        self.assertIn(structure_key, bitmap_index.entries)
+        self.assertEqual(set(batch_details.keys()) | set([new_patient.record_id]) |
+                         set(p.record_id for p in batch_patients),
+                         self.queries_runner.union('ehr_id.value', 'bp_query'))
+
+    def test_results_on_disk(self):
+        self._build_patients_batch(10, 10, systolic_range=(100, 250))
+        sys_query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        results_dir = tempfile.mkdtemp()
+        try:
+            queries_runner = QueriesRunner(self.db_conf, self.index_conf, max_processes=2,
+                                           query_timeout=60, results_dir=results_dir)
+            queries_runner.add_query('systolic_query', sys_query)
+            queries_runner.add_query('broken_query', 'SELECT FROM WHERE')
+            queries_runner.execute_queries()
+            self.assertEqual(queries_runner.results_count, 1)
+            self.assertEqual(queries_runner.failed_queries.keys(), ['broken_query'])
+            self.assertEqual(len(os.listdir(results_dir)), 1)
+            self.assertEqual(queries_runner.get_result_set('systolic_query').total_results, 100)
+            queries_runner.cleanup()
+            self.assertEqual(os.listdir(results_dir), [])
+        finally:
+            shutil.rmtree(results_dir)
+
     def test_cleanup(self):
         self._build_patients_batch(50, 10, systolic_range=(100, 250), dyastolic_range=(100, 250))
         sys_query = """
@@ -223,6 +327,9 @@ def suite():
     suite.addTest(TestQueriesRunner('test_multiple_queries'))
     suite.addTest(TestQueriesRunner('test_intersection'))
     suite.addTest(TestQueriesRunner('test_union'))
+    suite.addTest(TestQueriesRunner('test_set_algebra'))
+    suite.addTest(TestQueriesRunner('test_bitmap_set_algebra'))
+    suite.addTest(TestQueriesRunner('test_results_on_disk'))
     suite.addTest(TestQueriesRunner('test_cleanup'))
     suite.addTest(TestQueriesRunner('test_remove_query'))
     return suite
@@ -1,9 +1,12 @@
 import unittest, os, sys
 from random import randint
 from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.ehr.services.dbmanager.querymanager.async_manager import AsyncQueryManager
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
 from pyehr.ehr.services.dbmanager.dbservices.wrappers import PatientRecord,\
     ClinicalRecord, ArchetypeInstance
+from pyehr.ehr.services.dbmanager.errors import InvalidPageTokenError, QueryTimeoutError,\
+    QueryCancelledError
 from pyehr.utils.services import get_service_configuration
 
 CONF_FILE = os.getenv('SERVICE_CONFIG_FILE')
@@ -18,6 +21,7 @@ class TestQueryManager(unittest.TestCase):
         if CONF_FILE is None:
             sys.exit('ERROR: no configuration file provided')
         sconf = get_service_configuration(CONF_FILE)
+        self.sconf = sconf
         self.dbs = DBServices(**sconf.get_db_configuration())
         self.dbs.set_index_service(**sconf.get_index_configuration())
         self.qmanager = QueryManager(**sconf.get_db_configuration())
@@ -301,6 +305,175 @@ class TestQueryManager(unittest.TestCase):
         mp_results = self.qmanager.execute_aql_query(query, query_processes=2)
         self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
 
+    def test_workers_pool_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        sp_results = self.qmanager.execute_aql_query(query)
+        self.qmanager.start_workers_pool(2)
+        try:
+            # run the query twice to check that workers can be reused
+            for _ in xrange(2):
+                wp_results = self.qmanager.execute_aql_query(query)
+                self.assertEqual(sp_results.total_results, wp_results.total_results)
+                self.assertEqual(sorted(sp_results.results), sorted(wp_results.results))
+        finally:
+            self.qmanager.stop_workers_pool()
+        self.assertIsNone(self.qmanager.workers_pool)
+
+    def test_aggregate_query_mode(self):
+        if self.sconf.db_driver != 'mongodb':
+            self.skipTest('aggregate query mode is available only for MongoDB')
+        query = """
+        SELECT e/ehr_id/value AS patient_identifier,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 110
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (0, 250), (0, 200))
+        find_results = self.qmanager.execute_aql_query(query)
+        agg_qmanager = QueryManager(driver_options={'aql_query_mode': 'aggregate'},
+                                    **self.sconf.get_db_configuration())
+        agg_qmanager.set_index_service(**self.sconf.get_index_configuration())
+        agg_results = agg_qmanager.execute_aql_query(query)
+        self.assertEqual(find_results.total_results, agg_results.total_results)
+        self.assertEqual(sorted(find_results.results), sorted(agg_results.results))
+
+    def test_results_cache(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        _ = self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        self.qmanager.set_results_cache(10 * 1024 * 1024)
+        results = self.qmanager.execute_aql_query(query)
+        cached_results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(self.qmanager.results_cache.hits, 1)
+        self.assertEqual(sorted(results.results), sorted(cached_results.results))
+        # saving a new record must invalidate cached results
+        bp_arch = ArchetypeInstance(*self._get_blood_pressure_data(120, 80))
+        _, patient, _ = self.dbs.save_ehr_records([ClinicalRecord(bp_arch)], self.patients[0])
+        results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(self.qmanager.results_cache.hits, 1)
+        self.assertEqual(results.total_results, cached_results.total_results + 1)
+        # hiding a record must invalidate cached results as well
+        results_count = self.qmanager.execute_aql_query(query, count_only=True)
+        self.assertEqual(self.qmanager.execute_aql_query(query, count_only=True), results_count)
+        self.assertEqual(self.qmanager.results_cache.hits, 2)
+        self.dbs.hide_ehr_record(patient.ehr_records[-1])
+        self.assertEqual(self.qmanager.execute_aql_query(query, count_only=True), results_count)
+        self.assertEqual(self.qmanager.results_cache.hits, 2)
+
+    def test_paginated_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        _ = self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        results = self.qmanager.execute_aql_query(query)
+        paged_results = list()
+        pages = 0
+        page_token = None
+        while True:
+            page = self.qmanager.execute_aql_query(query, page_size=7, page_token=page_token)
+            self.assertLessEqual(page.total_results, 7)
+            paged_results.extend(page.results)
+            pages += 1
+            page_token = page.next_page_token
+            if page_token is None:
+                break
+        self.assertGreaterEqual(pages, 4)
+        self.assertEqual(sorted(results.results), sorted(paged_results))
+        self.assertRaises(InvalidPageTokenError, self.qmanager.execute_aql_query,
+                          query, page_size=7, page_token='not-a-token')
+
+    def test_execute_many(self):
+        bp_query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        high_bp_query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e [uid=$ehrUid]
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 80
+        """
+        batch_details = self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        queries = {'all_bp': bp_query, 'all_bp_copy': bp_query, 'high_bp': high_bp_query}
+        query_params = {'high_bp': {'ehrUid': batch_details.keys()[0]}}
+        results = self.qmanager.execute_many(queries, query_params, max_threads=2)
+        self.assertEqual(sorted(results.keys()), sorted(queries.keys()))
+        for label, query in queries.iteritems():
+            single_results = self.qmanager.execute_aql_query(query, query_params.get(label))
+            self.assertEqual(sorted(results[label].results), sorted(single_results.results))
+
+    def test_query_timeout(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        with self.assertRaises(QueryTimeoutError):
+            self.qmanager.execute_aql_query(query, timeout=0.000001)
+        with self.assertRaises(QueryTimeoutError):
+            self.qmanager.execute_aql_query(query, count_only=True, timeout=0.000001)
+        self.assertEqual(len(self.qmanager.running_queries), 0)
+        # a generous timeout doesn't change the results
+        results = self.qmanager.execute_aql_query(query, timeout=60, query_id='bp_query')
+        self.assertEqual(results.total_results, 25)
+        self.assertEqual(len(self.qmanager.running_queries), 0)
+
+    def test_cancel_query(self):
+        self.assertFalse(self.qmanager.cancel_query('missing_query'))
+        query_control = self.qmanager._register_query('bp_query', None)
+        with self.assertRaises(ValueError):
+            self.qmanager._register_query('bp_query', None)
+        self.assertTrue(self.qmanager.cancel_query('bp_query'))
+        with self.assertRaises(QueryCancelledError):
+            query_control.check()
+        self.qmanager._unregister_query(query_control)
+        self.assertFalse(self.qmanager.cancel_query('bp_query'))
+
+    def test_async_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e [uid=$ehrUid]
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        batch_details = self._build_patients_batch(10, 10, (50, 100), (50, 100))
+        async_qmanager = AsyncQueryManager(max_concurrent_queries=5, query_threads=2,
+                                           **self.sconf.get_db_configuration())
+        async_qmanager.set_index_service(**self.sconf.get_index_configuration())
+        async_qmanager.start()
+        try:
+            # submit all the queries before waiting for the results
+            async_results = dict((patient_label, async_qmanager.execute_aql_query_async(query,
+                                                                                        {'ehrUid': patient_label}))
+                                 for patient_label in batch_details)
+            for patient_label, records in batch_details.iteritems():
+                res = list(async_results[patient_label].get(timeout=60).results)
+                self.assertEqual(sorted(records), sorted(res))
+        finally:
+            async_qmanager.stop()
+        self.assertFalse(async_qmanager.is_running)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -316,6 +489,14 @@ def suite():
     suite.addTest(TestQueryManager('test_deep_select_query'))
     suite.addTest(TestQueryManager('test_count_query'))
     suite.addTest(TestQueryManager('test_multiprocess_query'))
+    suite.addTest(TestQueryManager('test_workers_pool_query'))
+    suite.addTest(TestQueryManager('test_async_query'))
+    suite.addTest(TestQueryManager('test_aggregate_query_mode'))
+    suite.addTest(TestQueryManager('test_results_cache'))
+    suite.addTest(TestQueryManager('test_paginated_query'))
+    suite.addTest(TestQueryManager('test_execute_many'))
+    suite.addTest(TestQueryManager('test_query_timeout'))
+    suite.addTest(TestQueryManager('test_cancel_query'))
     return suite
 
 if __name__ == '__main__':
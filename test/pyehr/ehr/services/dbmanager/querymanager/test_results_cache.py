@@ -0,0 +1,97 @@
+import unittest
+from pyehr.ehr.services.dbmanager.querymanager.results_cache import ResultsCache
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
+    ResultColumnDef, ResultRow
+
+
+class TestResultsCache(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestResultsCache, self).__init__(label)
+
+    def _build_results_set(self, rows_count):
+        rs = ResultSet()
+        rs.add_column_definition(ResultColumnDef('systolic', 'o/systolic'))
+        for x in xrange(rows_count):
+            rs.add_row(ResultRow({'o/systolic': x}))
+        return rs
+
+    def test_cache_key(self):
+        key_1 = ResultsCache.get_key('SELECT o/systolic\n    FROM Ehr e', {'$b': 2, '$a': 1})
+        key_2 = ResultsCache.get_key('  SELECT o/systolic FROM   Ehr e ', {'$a': 1, '$b': 2})
+        self.assertEqual(key_1, key_2)
+        self.assertNotEqual(key_1, ResultsCache.get_key('SELECT o/systolic FROM Ehr e',
+                                                        {'$a': 1, '$b': 2}, count_only=True))
+
+    def test_get_and_put(self):
+        cache = ResultsCache(1024 * 1024)
+        rs = self._build_results_set(10)
+        key = ResultsCache.get_key('SELECT o/systolic FROM Ehr e')
+        self.assertIsNone(cache.get(key, {'str_1': 1}))
+        cache.put(key, {'str_1': 1}, rs)
+        cached_rs = cache.get(key, {'str_1': 1})
+        self.assertEqual(rs.total_results, cached_rs.total_results)
+        self.assertEqual(list(rs.results), list(cached_rs.results))
+        count_key = ResultsCache.get_key('SELECT o/systolic FROM Ehr e', count_only=True)
+        cache.put(count_key, {'str_1': 1}, 10)
+        self.assertEqual(cache.get(count_key, {'str_1': 1}), 10)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_generations_invalidation(self):
+        cache = ResultsCache(1024 * 1024)
+        key_1 = ResultsCache.get_key('SELECT o/systolic FROM Ehr e CONTAINS Observation o')
+        key_2 = ResultsCache.get_key('SELECT c/name FROM Ehr e CONTAINS Composition c')
+        cache.put(key_1, {'str_1': 1, 'str_2': 4}, self._build_results_set(5))
+        cache.put(key_2, {'str_3': 2}, self._build_results_set(5))
+        # a record with structure str_2 was modified
+        self.assertIsNone(cache.get(key_1, {'str_1': 1, 'str_2': 5}))
+        self.assertEqual(len(cache), 1)
+        # a new structure matching the query was created
+        self.assertIsNone(cache.get(key_2, {'str_3': 2, 'str_4': 0}))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_evict_structures(self):
+        cache = ResultsCache(1024 * 1024)
+        key_1 = ResultsCache.get_key('SELECT o/systolic FROM Ehr e CONTAINS Observation o')
+        key_2 = ResultsCache.get_key('SELECT c/name FROM Ehr e CONTAINS Composition c')
+        cache.put(key_1, {'str_1': 1, 'str_2': 4}, self._build_results_set(5))
+        cache.put(key_2, {'str_3': 2}, self._build_results_set(5))
+        cache.evict_structures(['str_2'])
+        self.assertIsNone(cache.get(key_1, {'str_1': 1, 'str_2': 4}))
+        self.assertIsNotNone(cache.get(key_2, {'str_3': 2}))
+
+    def test_lru_eviction(self):
+        rs = self._build_results_set(50)
+        entry_size = len(ResultsCache(1)._serialize(rs))
+        cache = ResultsCache(entry_size * 2)
+        keys = [ResultsCache.get_key('SELECT o/systolic FROM Ehr e', {'$x': x}) for x in xrange(3)]
+        cache.put(keys[0], {}, rs)
+        cache.put(keys[1], {}, rs)
+        # use first entry, second one becomes the least recently used
+        self.assertIsNotNone(cache.get(keys[0], {}))
+        cache.put(keys[2], {}, rs)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(keys[1], {}))
+        self.assertIsNotNone(cache.get(keys[0], {}))
+        self.assertIsNotNone(cache.get(keys[2], {}))
+        self.assertTrue(cache.size <= cache.max_size)
+        # results bigger than the whole cache are not stored
+        cache.put(keys[1], {}, self._build_results_set(500))
+        self.assertIsNone(cache.get(keys[1], {}))
+        self.assertEqual(len(cache), 2)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestResultsCache('test_cache_key'))
+    suite.addTest(TestResultsCache('test_get_and_put'))
+    suite.addTest(TestResultsCache('test_generations_invalidation'))
+    suite.addTest(TestResultsCache('test_evict_structures'))
+    suite.addTest(TestResultsCache('test_lru_eviction'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
\ No newline at end of file
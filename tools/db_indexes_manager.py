@@ -0,0 +1,83 @@
+import sys, argparse
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from pyehr.ehr.services.dbmanager.dbservices import DBServices
+from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.utils.services import get_service_configuration
+from pyehr.utils import get_logger
+
+
+class DBIndexesManager(object):
+    def __init__(self, conf_file, db_label=None, log_file=None, log_level='INFO'):
+        conf = get_service_configuration(conf_file)
+        db_conf = conf.get_db_configuration()
+        index_conf = conf.get_index_configuration()
+        if db_label:
+            db_conf['database'] = '%s_%s' % (db_conf['database'], db_label)
+            index_conf['database'] = '%s_%s' % (index_conf['database'], db_label)
+        self.logger = get_logger('db_indexes_manager', log_file=log_file, log_level=log_level)
+        self.db_service = DBServices(logger=self.logger, **db_conf)
+        self.query_manager = QueryManager(logger=self.logger, **db_conf)
+        self.query_manager.set_index_service(**index_conf)
+
+    def check(self):
+        missing_structures = self.db_service.check_structures()
+        for structure_def, missing in sorted(missing_structures.iteritems()):
+            for keys in missing:
+                self.logger.warning('Missing index %r for %s repository', keys, structure_def)
+        if not any(missing_structures.values()):
+            self.logger.info('All the required indexes are available')
+        return missing_structures
+
+    def create(self):
+        created_structures = self.db_service.init_structures()
+        for structure_def, created in sorted(created_structures.iteritems()):
+            self.logger.info('Created %d indexes for %s repository', len(created), structure_def)
+        return created_structures
+
+    def create_query_indexes(self, queries_file):
+        with open(queries_file) as f:
+            queries = json.loads(f.read())
+        for label, query in sorted(queries.iteritems()):
+            if isinstance(query, dict):
+                query, query_params = query['query'], query.get('query_params')
+            else:
+                query_params = None
+            created = self.query_manager.ensure_query_indexes(query, query_params)
+            self.logger.info('Created %d partial indexes for query %s', len(created), label)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Create and check the indexes used by the given pyEHR environment')
+    parser.add_argument('--conf-file', type=str, required=True,
+                        help='pyEHR configuration file')
+    parser.add_argument('--db-label', type=str, default=None,
+                        help='A label that will be added to database\'s name specified in conf file')
+    parser.add_argument('--check-only', action='store_true',
+                        help='Only report missing indexes, don\'t create them')
+    parser.add_argument('--hot-queries', type=str, default=None,
+                        help='A JSON file mapping labels to AQL queries (or to objects with query and '
+                             'query_params fields), partial indexes will be created for their WHERE statements')
+    parser.add_argument('--log-file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help='LOG level (default INFO)')
+    return parser
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    indexes_manager = DBIndexesManager(args.conf_file, args.db_label, args.log_file, args.log_level)
+    if args.check_only:
+        missing_structures = indexes_manager.check()
+        sys.exit(1 if any(missing_structures.values()) else 0)
+    indexes_manager.create()
+    if args.hot_queries:
+        indexes_manager.create_query_indexes(args.hot_queries)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])